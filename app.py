@@ -11,55 +11,91 @@ Attributes:
 
 Input:
     Training Data with messages and classification: 
-        database: "../data/DisasterResponse.db": 
+        database: "./data/DisasterResponse.db" (env variable DATABASE_FILEPATH): 
         table: "DisasterMessages"
     
 Output:
     Webpage: https://disaster-response-ble.herokuapp.com/
+    Metrics (Prometheus text format): /metrics
+    Liveness: /healthz, readiness + import times: /ready
 """
-import json, plotly
-from flask import Flask, render_template, request
-import pandas as pd
-import plotly.express as px
-from sqlalchemy import create_engine
-from nltk.tokenize import word_tokenize
+import os, sys
+# the dashboard cache is shared with app/run.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app'))
+# the dashboard reads the summary tables written by data/process_data.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data'))
+from startup import StartupTimer, register_health_routes
+# import times of this worker (reported on /ready and /metrics)
+startup = StartupTimer()
+
+from flask import Flask, render_template, request, jsonify
+from dashboard import DashboardCache, dashboard_response
+from metrics import Metrics, memory_usage
+from instrumentation import instrument_app
+# pandas and plotly are imported by the first dashboard build (first request of /index)
+startup.mark("imports")
 
 app = Flask(__name__)
 app.secret_key = "whatever_blabla"
 
+# request and stage latency histograms on /metrics, profiles of slow requests (PROFILE_SLOW_MS)
+metrics = Metrics({"app": "heroku"})
+instrument_app(app, metrics)
+
 # load message training data
-engine = create_engine('sqlite:///./data/DisasterResponse.db')
-df = pd.read_sql_table('DisasterMessages', engine)
-df["message_length"] = df["message"].str.len()
+database_filepath = os.environ.get('DATABASE_FILEPATH', './data/DisasterResponse.db')
 
-# Create graphs to be displayed in webpage and render to 'master.html'
-@app.route('/')
-@app.route('/index')
-def index():
+
+def load_messages():
+    """ load the training data needed for the graphs: category columns, genre and the length of every message
+    (from the compact, memory-mapped copy of the DisasterMessages table shared by all workers, no message text)
+    Returns: DataFrame
+    """
+    from frame_store import load_frame
+    frame = load_frame(database_filepath)
+    return(frame.categories.assign(genre=frame.genre, message_length=frame.message_length))
+
+
+def load_summary():
+    """ load the statistics plotted by the dashboard: the summary tables of the database (a few small tables),
+    computed from the training data for databases written before process_data.py maintained them
+    Returns: summary_tables.Summary
+    """
+    from summary_tables import Summary, load_summary as read_summary_tables
+    summary = read_summary_tables(database_filepath)
+    if summary is None:
+        summary = Summary.from_frame(load_messages())
+    return(summary)
+
+
+def build_graphs():
+    """ create the dashboard graphs from the summary tables of the training data (called once per database version
+    by the dashboard cache)
+    Returns: list of plotly figures
+    """
+    # plotly is imported by the first dashboard build
+    import plotly.express as px
+    import plotly.graph_objects as go
+    summary = load_summary()
 
     # Create 6 graphs
     graphs = [None]*6
 
     # Graph 1: Correlation matrix to depict relationship between message categories
-    correlation_matrix = df.corr()
+    correlation_matrix = summary.correlation()
     graphs[0] = px.imshow(correlation_matrix)
 
     # Graph 2: Bargraph to depict the categories that go along with the "aid_related" category
     # The correlation matrix depicts that there are several correlations
-    df_line = df[df["aid_related"]==1]
-    df_line = df_line.drop(columns=["id","message","genre","aid_related","message_length"])
-    df_line = df_line.sum()
-    df_line = df_line.reset_index()
-    df_line.columns=(["Category","Count"])
-    df_line = df_line.sort_values(by="Count",ascending=False)
+    df_line = summary.category_counts(given="aid_related")
     graphs[1] = px.bar(df_line,x="Category",y="Count")
 
     # Graph 3: Bargraph depicting the number of messages per 'genre'
-    df_genre_counts = df.groupby('genre', as_index=False).agg(count=('message','count'))   
+    df_genre_counts = summary.genre_counts()
     graphs[2] = px.bar(df_genre_counts, x="genre", y="count", barmode="stack",title="Aid Related correlation")
 
     # Graph 4: Bargraph depicting the number of messages per 'genre', differentiated by "Aid related"
-    df_aid_related = df.groupby(['aid_related','genre'], as_index=False).agg(count=('message','count'))
+    df_aid_related = summary.genre_aid_counts()
     df_aid_related["aid"] = df_aid_related["aid_related"].map({0: "Not Aid Related", 1: "Aid Related",})
     graphs[3] = px.bar(df_aid_related, x="genre", y="count", color="aid", barmode="stack", title="#Aid related")
 
@@ -67,14 +103,41 @@ def index():
     df_aid_related["count2"] = df_aid_related["count"].div(df_aid_related.groupby("genre")["count"].transform("sum"))
     graphs[4] = px.bar(df_aid_related, x="genre", y="count2", color="aid", barmode="stack", title="%Aid related")
     
-    # Graph 6: Boxplot depicting the length of the messages per "genre"
-    df_message_len = df[["genre","message_length"]]
-    graphs[5] = px.box(df_message_len, x="genre", y="message_length", log_y=True, title="message length")
+    # Graph 6: Boxplot depicting the length of the messages per "genre" (drawn from the quartiles, no outlier points)
+    df_message_len = summary.length_boxes()
+    graphs[5] = go.Figure(go.Box(x=df_message_len["genre"], q1=df_message_len["q1"], median=df_message_len["median"],
+        q3=df_message_len["q3"], lowerfence=df_message_len["lowerfence"], upperfence=df_message_len["upperfence"]),
+        layout=dict(title="message length", xaxis_title="genre", yaxis_title="message_length", yaxis_type="log"))
+    return(graphs)
+
+
+# dashboard graphs are built on the first request and rebuilt only when the database changes
+dashboard_cache = DashboardCache(database_filepath, build_graphs, stage=metrics.stage)
+
+metrics.register_callback("startup_phase_seconds", "gauge", "Duration of the startup phases (imports, loads)",
+                          lambda: {(phase,): seconds for phase, seconds in startup.phases.items()}, labels=("phase",))
+# liveness and readiness (the dashboard data is loaded by the first /index request: ready from the start)
+register_health_routes(app, startup)
+
+
+def render(template, **context):
+    """ render a template, timed as the "render" stage """
+    with metrics.stage("render"):
+        return(render_template(template, **context))
+
+
+# Create graphs to be displayed in webpage and render to 'master.html'
+@app.route('/')
+@app.route('/index')
+def index():
+    dashboard = dashboard_cache.get()
 
-    # plot ids for the html id tag
-    ids = ['graph-{}'.format(i) for i, _ in enumerate(graphs)] 
+    # 304 Not Modified when the browser/CDN copy is still valid
+    return dashboard_response(request, dashboard,
+        lambda: render('master.html', ids=dashboard.ids, graphJSON=dashboard.graph_json))
 
-    # Convert the plotly figures to JSON for javascript in html template
-    graphJSON = json.dumps(graphs, cls=plotly.utils.PlotlyJSONEncoder)
 
-    return render_template('master.html', ids=ids, graphJSON=graphJSON)
+# resident memory of this worker (RssFile: memory-mapped pages shared with the other workers)
+@app.route('/api/memory')
+def memory():
+    return jsonify(pid=os.getpid(), **memory_usage())
@@ -0,0 +1,381 @@
+""" async_server:
+
+    Alternative serving mode for the classifier: an asyncio (tornado) HTTP front end that hands the CPU-bound
+    tokenization and prediction to a pool of model processes, so that a slow request does not block the others
+    and one machine uses all its cores.
+    - the model is loaded once before the pool starts: forked workers share it (copy on write), workers started
+      otherwise load it in their initializer; every worker classifies a message before the server accepts requests
+    - backpressure: at most ASYNC_MAX_PENDING messages are queued or being classified, further requests get
+      503 with a Retry-After header
+    - per-request timeout (ASYNC_TIMEOUT_SEC): 504, chunks that did not start yet are cancelled
+    - batches are split into chunks of ASYNC_CHUNK_SIZE messages that are classified in parallel
+    - drop-in for the classification routes of run.py: GET /go (same template) and POST /api/classify
+      (same request and response format), results of repeated messages cached as in run.py
+
+    to run: python async_server.py (or from the top level folder: python app/async_server.py)
+
+Attributes:
+    None
+
+Input:
+    database: ../data/DisasterResponse.db (env variable DATABASE_FILEPATH), for the category names and
+        message length quantiles of models that do not carry them
+    model: ../models/DisasterResponse.pkl (env variable MODEL_FILEPATH) or the export in env variable MODEL_EXPORT_DIR,
+        env variable MODEL_PREDICTOR: "fused" (default) or "pipeline"
+    env variables:
+    - PORT: port to listen on (default 3000)
+    - ASYNC_WORKERS: number of model processes (default: number of cores)
+    - ASYNC_MAX_PENDING: maximum number of messages queued or being classified (default 10000)
+    - ASYNC_TIMEOUT_SEC: time limit of a classification request (default 10)
+    - ASYNC_CHUNK_SIZE: messages per chunk handed to a model process (default 250)
+    - MAX_BATCH_SIZE, PREDICTION_CACHE_SIZE, PREDICTION_CACHE_TTL: as in run.py
+
+Output:
+    Result page: http://127.0.0.1:3000/go?query=...
+    Batch API: POST http://127.0.0.1:3000/api/classify
+    Pool state (workers, pending messages, rejected and timed out requests): http://127.0.0.1:3000/api/pool
+    Prediction cache statistics: http://127.0.0.1:3000/api/cache
+    Metrics (Prometheus text format): http://127.0.0.1:3000/metrics
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+import tornado.web
+from tornado.log import access_log
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+
+from metrics import Metrics
+from prediction_cache import PredictionCache, CachedBatch
+from batch_api import parse_body, batch_response, MODEL_VERSION_HEADER
+# the inference engine and the tokenizer are shared with the scripts in models/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "models"))
+from inference import load_engine
+# models pickled by train_classifier.py as a script refer to __main__.tokenize
+from tokenizer import tokenize
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+DATABASE_FILEPATH = os.environ.get("DATABASE_FILEPATH", os.path.join(APP_DIR, "..", "data", "DisasterResponse.db"))
+MODEL_FILEPATH = os.environ.get("MODEL_FILEPATH", os.path.join(APP_DIR, "..", "models", "DisasterResponse.pkl"))
+MODEL_EXPORT_DIR = os.environ.get("MODEL_EXPORT_DIR")
+MODEL_PREDICTOR = os.environ.get("MODEL_PREDICTOR", "fused")
+PORT = int(os.environ.get("PORT", 3000))
+ASYNC_WORKERS = int(os.environ.get("ASYNC_WORKERS", os.cpu_count() or 1))
+ASYNC_MAX_PENDING = int(os.environ.get("ASYNC_MAX_PENDING", 10000))
+ASYNC_TIMEOUT_SEC = float(os.environ.get("ASYNC_TIMEOUT_SEC", 10))
+ASYNC_CHUNK_SIZE = int(os.environ.get("ASYNC_CHUNK_SIZE", 250))
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", 1000))
+PREDICTION_CACHE_SIZE = int(os.environ.get("PREDICTION_CACHE_SIZE", 10000))
+PREDICTION_CACHE_TTL = float(os.environ.get("PREDICTION_CACHE_TTL", 3600))
+
+# model of the worker processes (loaded before the pool is forked, or by init_worker)
+_engine = None
+
+
+def init_worker(model_filepath, export_dir, predictor, database_filepath):
+    global _engine
+    if _engine is None:
+        _engine = load_engine(model_filepath, export_dir, predictor, database_filepath)
+
+
+def worker_classify(messages, genres):
+    """ classify a chunk in a model process
+    Returns: labels (int8) and probabilities (n_messages x n_categories)
+    """
+    labels, probabilities = _engine.classify(messages, genres)
+    return(labels.astype(np.int8), probabilities)
+
+
+def worker_warm_up():
+    """ classify one message (tokenizer and model pages loaded) Returns: process id """
+    _engine.classify(["warm up"], ["direct"])
+    return(os.getpid())
+
+
+class PoolBusy(Exception):
+    """ the pool has too many pending messages to accept a request """
+
+
+class ModelPool:
+    """ process pool of preloaded models with a bound on the pending messages and a timeout per request
+    Input: number of worker processes, initializer arguments (see init_worker), maximum number of pending messages,
+    timeout in seconds, messages per chunk
+    """
+
+    def __init__(self, workers, initargs, max_pending=10000, timeout=10, chunk_size=250):
+        self.workers = max(1, workers)
+        self.initargs = initargs
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.chunk_size = max(1, chunk_size)
+        self.pids = []
+        self.pending = 0
+        self.requests = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.restarts = 0
+        # done callbacks of the process futures run in the executor's management thread
+        self._lock = threading.Lock()
+        self.executor = self._start()
+
+    def _start(self):
+        return(ProcessPoolExecutor(self.workers, initializer=init_worker, initargs=self.initargs))
+
+    async def warm_up(self):
+        """ start every worker process and run one classification in each """
+        futures = [asyncio.wrap_future(self.executor.submit(worker_warm_up)) for _ in range(self.workers)]
+        self.pids = sorted(set(await asyncio.gather(*futures)))
+
+    def _release(self, n_messages):
+        with self._lock:
+            self.pending -= n_messages
+
+    async def classify(self, messages, genres):
+        """ classify messages in the worker processes (in chunks)
+        Returns: labels and probabilities (n_messages x n_categories)
+        Raises: PoolBusy when the pending messages would exceed the maximum, asyncio.TimeoutError after the timeout
+        """
+        n_messages = len(messages)
+        with self._lock:
+            # a request larger than the maximum is accepted when nothing is pending
+            if self.pending and self.pending + n_messages > self.max_pending:
+                self.rejected += 1
+                raise PoolBusy()
+            self.pending += n_messages
+            self.requests += 1
+
+        chunks = [(messages[start:start + self.chunk_size], genres[start:start + self.chunk_size])
+                  for start in range(0, n_messages, self.chunk_size)]
+        futures = []
+        try:
+            for chunk_messages, chunk_genres in chunks:
+                future = self.executor.submit(worker_classify, chunk_messages, chunk_genres)
+                future.add_done_callback(lambda f, n=len(chunk_messages): self._release(n))
+                futures.append(future)
+        except BrokenProcessPool:
+            # a worker died (e.g. killed for its memory): replace the pool, the request fails
+            self._release(sum(len(chunk_messages) for chunk_messages, _ in chunks[len(futures):]))
+            self.restart()
+            raise
+        try:
+            results = await asyncio.wait_for(asyncio.gather(*(asyncio.wrap_future(f) for f in futures)), self.timeout)
+        except asyncio.TimeoutError:
+            with self._lock:
+                self.timeouts += 1
+            # chunks still queued are dropped, running chunks finish in their worker
+            for future in futures:
+                future.cancel()
+            raise
+        except BrokenProcessPool:
+            self.restart()
+            raise
+        return(np.concatenate([labels for labels, _ in results]), np.concatenate([probabilities for _, probabilities in results]))
+
+    def restart(self):
+        executor, self.executor = self.executor, self._start()
+        executor.shutdown(wait=False, cancel_futures=True)
+        self.restarts += 1
+        self.pids = []
+
+    def stats(self):
+        with self._lock:
+            return({
+                "workers": self.workers,
+                "pids": self.pids,
+                "chunk_size": self.chunk_size,
+                "timeout_sec": self.timeout,
+                "max_pending": self.max_pending,
+                "pending": self.pending,
+                "requests": self.requests,
+                "rejected": self.rejected,
+                "timeouts": self.timeouts,
+                "restarts": self.restarts,
+            })
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class Classifier:
+    """ front end state: the model pool, the prediction cache and the settings of the loaded model
+    Input: ModelPool, InferenceEngine loaded in this process (category names, version), PredictionCache
+    """
+
+    def __init__(self, pool, engine, cache):
+        self.pool = pool
+        self.category_names = engine.category_names
+        self.version = engine.version
+        self.cache = cache
+
+    async def classify(self, messages, genres):
+        """ classify messages, sending only those without a cached result to the pool
+        Returns: labels and probabilities (n_messages x n_categories)
+        """
+        batch = CachedBatch(self.cache, messages, genres, len(self.category_names), self.version)
+        if batch.pending:
+            labels, probabilities = await self.pool.classify([messages[i] for i in batch.pending],
+                                                             [genres[i] for i in batch.pending])
+            batch.complete(labels, probabilities, model_version=self.version)
+        return(batch.labels, batch.probabilities)
+
+
+class BaseHandler(tornado.web.RequestHandler):
+    # endpoint label of the request metrics (route function names of run.py)
+    endpoint = "unmatched"
+
+    def initialize(self, classifier, metrics, templates):
+        self.classifier = classifier
+        self.metrics = metrics
+        self.templates = templates
+
+    def write_json(self, payload, status=200):
+        self.set_status(status)
+        self.set_header("Content-Type", "application/json")
+        self.finish(json.dumps(payload))
+
+    async def run_classification(self, messages, genres):
+        """ classify in the pool, answering 503 (busy) or 504 (timeout) on failure
+        Returns: labels and probabilities, None when the request was answered with an error
+        """
+        try:
+            with self.metrics.stage("pool"):
+                return(await self.classifier.classify(messages, genres))
+        except PoolBusy:
+            self.set_header("Retry-After", "1")
+            self.write_json({"error": "server busy, retry later"}, 503)
+        except asyncio.TimeoutError:
+            self.write_json({"error": "classification timed out after {}s".format(self.classifier.pool.timeout)}, 504)
+        return(None)
+
+
+class GoHandler(BaseHandler):
+    endpoint = "go"
+
+    async def get(self):
+        query = self.get_argument("query", "")
+        result = await self.run_classification([query], ["direct"])
+        if result is None:
+            return
+        classification_results = dict(zip(self.classifier.category_names, result[0][0]))
+        with self.metrics.stage("render"):
+            page = self.templates.get_template("go.html").render(query=query, classification_result=classification_results)
+        self.set_header(MODEL_VERSION_HEADER, self.classifier.version)
+        self.finish(page)
+
+
+class ClassifyHandler(BaseHandler):
+    endpoint = "classify"
+
+    async def post(self):
+        try:
+            messages, genres = parse_body(self.request.body.decode("utf-8", "replace"),
+                                          self.request.headers.get("Content-Type", "").split(";")[0].strip())
+        except ValueError as err:
+            return self.write_json({"error": str(err)}, 400)
+        if len(messages) > MAX_BATCH_SIZE:
+            return self.write_json({"error": "batch of {} messages exceeds the maximum of {}".format(len(messages), MAX_BATCH_SIZE)}, 413)
+
+        start = time.perf_counter()
+        if messages:
+            result = await self.run_classification(messages, genres)
+            if result is None:
+                return
+            labels, probabilities = result
+        else:
+            labels = probabilities = np.zeros((0, len(self.classifier.category_names)))
+        elapsed = time.perf_counter() - start
+        self.set_header(MODEL_VERSION_HEADER, self.classifier.version)
+        self.write_json(batch_response(messages, genres, labels, probabilities, self.classifier.category_names, elapsed,
+                                       self.classifier.version))
+
+
+class PoolHandler(BaseHandler):
+    endpoint = "pool_stats"
+
+    def get(self):
+        self.write_json(self.classifier.pool.stats())
+
+
+class CacheHandler(BaseHandler):
+    endpoint = "cache_stats"
+
+    def get(self):
+        self.write_json(self.classifier.cache.stats())
+
+
+class MetricsHandler(BaseHandler):
+    endpoint = "prometheus_metrics"
+
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.finish(self.metrics.render())
+
+
+def make_app(classifier, metrics):
+    """ Returns: tornado application with the classification routes, request counts and latencies recorded in metrics """
+    templates = Environment(loader=FileSystemLoader(os.path.join(APP_DIR, "templates")),
+                            autoescape=select_autoescape(["html"]))
+
+    def log_request(handler):
+        elapsed = handler.request.request_time()
+        labels = {"endpoint": getattr(handler, "endpoint", "unmatched"), "method": handler.request.method,
+                  "status": handler.get_status()}
+        metrics.inc("http_requests_total", help_text="Number of requests", **labels)
+        metrics.observe("http_request_duration_seconds", elapsed, help_text="Request latency", **labels)
+        access_log.info("%d %s %.2fms", handler.get_status(), handler._request_summary(), 1000 * elapsed)
+
+    settings = {"classifier": classifier, "metrics": metrics, "templates": templates}
+    return(tornado.web.Application([
+        (r"/go", GoHandler, settings),
+        (r"/api/classify", ClassifyHandler, settings),
+        (r"/api/pool", PoolHandler, settings),
+        (r"/api/cache", CacheHandler, settings),
+        (r"/metrics", MetricsHandler, settings),
+    ], log_function=log_request))
+
+
+async def serve(classifier, metrics, port):
+    print("Warming up {} model processes...".format(classifier.pool.workers))
+    await classifier.pool.warm_up()
+    make_app(classifier, metrics).listen(port)
+    print("Listening on http://0.0.0.0:{}".format(port))
+    await asyncio.Event().wait()
+
+
+def main():
+    global _engine
+    # loaded before the pool is created: forked worker processes share the model pages
+    _engine = load_engine(MODEL_FILEPATH, MODEL_EXPORT_DIR, MODEL_PREDICTOR, DATABASE_FILEPATH)
+    pool = ModelPool(ASYNC_WORKERS, (MODEL_FILEPATH, MODEL_EXPORT_DIR, MODEL_PREDICTOR, DATABASE_FILEPATH),
+                     max_pending=ASYNC_MAX_PENDING, timeout=ASYNC_TIMEOUT_SEC, chunk_size=ASYNC_CHUNK_SIZE)
+    # near-duplicate lookups would tokenize in the event loop: exact lookups only
+    cache = PredictionCache(PREDICTION_CACHE_SIZE, ttl=PREDICTION_CACHE_TTL, model_version=_engine.version)
+    classifier = Classifier(pool, _engine, cache)
+
+    metrics = Metrics({"app": "async"})
+    metrics.register_callback("pool_pending_messages", "gauge", "Messages queued or being classified by the model processes",
+                              lambda: pool.stats()["pending"])
+    metrics.register_callback("pool_rejected_total", "counter", "Requests rejected because the pool was full",
+                              lambda: pool.stats()["rejected"])
+    metrics.register_callback("pool_timeouts_total", "counter", "Requests that timed out",
+                              lambda: pool.stats()["timeouts"])
+    metrics.register_callback("prediction_cache_entries", "gauge", "Cached classification results",
+                              lambda: cache.stats()["size"])
+    metrics.register_callback("model_info", "gauge", "Version of the active model (1 for the active version)",
+                              lambda: {(classifier.version,): 1}, labels=("version",))
+    try:
+        asyncio.run(serve(classifier, metrics, PORT))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pool.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+""" batch_api:
+
+    Request and response format of the batch API (/api/classify), shared by run.py and async_server.py.
+
+Attributes:
+    GENRES: genres accepted by the batch API
+    MODEL_VERSION_HEADER: response header with the version of the model that classified the messages
+    parse_body: messages and genres of a request body
+    batch_response: response payload for classified messages
+"""
+import json
+
+import numpy as np
+
+# genres of the training messages (models/features.py GENRES, not imported: this module is loaded before pandas)
+GENRES = ("direct", "news", "social")
+MODEL_VERSION_HEADER = "X-Model-Version"
+
+
+def parse_body(body, mimetype):
+    """ extract messages and genres from a /api/classify request body
+    Input: body text (JSON array, {"messages": [...]} object or NDJSON with one message per line), mimetype
+    Returns: list of messages, list of genres
+    Raises: ValueError when the body cannot be interpreted
+    """
+    if mimetype in ("application/x-ndjson", "application/jsonl"):
+        items = [json.loads(line) for line in body.splitlines() if line.strip()]
+    else:
+        try:
+            items = json.loads(body)
+        except ValueError:
+            items = None
+        if isinstance(items, dict):
+            items = items.get("messages")
+    if not isinstance(items, list):
+        raise ValueError("expected a JSON array of messages, {\"messages\": [...]} or NDJSON")
+
+    messages, genres = [], []
+    for item in items:
+        if isinstance(item, str):
+            item = {"message": item}
+        if not isinstance(item, dict) or not isinstance(item.get("message"), str):
+            raise ValueError("every message must be a string or an object with a \"message\" string")
+        genre = item.get("genre", "direct")
+        if genre not in GENRES:
+            raise ValueError("unknown genre {!r}, expected one of {}".format(genre, ", ".join(GENRES)))
+        messages.append(item["message"])
+        genres.append(genre)
+    return(messages, genres)
+
+
+def batch_response(messages, genres, labels, probabilities, category_names, elapsed, model_version=None):
+    """ Returns: dict with the categories, per-message labels and probabilities, the throughput of a batch and
+    the version of the model that classified it
+    """
+    results = [{
+        "message": message,
+        "genre": genre,
+        "labels": dict(zip(category_names, row_labels.tolist())),
+        "probabilities": dict(zip(category_names, np.round(row_probabilities, 4).tolist())),
+        } for message, genre, row_labels, row_probabilities in zip(messages, genres, labels, probabilities)]
+    return({
+        "categories": category_names,
+        "model_version": model_version,
+        "count": len(results),
+        "elapsed_sec": round(elapsed, 6),
+        "messages_per_sec": round(len(results) / elapsed, 1) if results and elapsed > 0 else None,
+        "results": results,
+    })
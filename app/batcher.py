@@ -0,0 +1,110 @@
+""" batcher:
+
+    Micro-batching request coalescer that sits in front of the model.
+    Requests arriving within a short window (or until the batch is full) are classified
+    with one batched prediction; every caller receives its own row back.
+
+Attributes:
+    MicroBatcher: dispatcher with configurable window/batch limits and queue depth / batch size histograms
+"""
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from metrics import Histogram
+
+
+class MicroBatcher:
+    """ coalesce concurrent single-item predictions into batches
+    Input:
+    - predict_fn: function that takes a list of items and returns a list with one result per item
+    - max_batch_size: maximum number of items in a batch
+    - window_ms: maximum time to wait for additional items once the first one arrived (0: no coalescing)
+    """
+
+    def __init__(self, predict_fn, max_batch_size=32, window_ms=5.0):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.window = max(0.0, float(window_ms)) / 1000.0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+        size_buckets = [1, 2, 4, 8, 16, 32, 64, 128, 256]
+        self.batch_size = Histogram([b for b in size_buckets if b < self.max_batch_size] + [self.max_batch_size])
+        self.queue_depth = Histogram(size_buckets + [512, 1024])
+        self.wait_ms = Histogram([0.5, 1, 2, 5, 10, 20, 50, 100, 250, 500, 1000])
+        self.batch_ms = Histogram([1, 2, 5, 10, 20, 50, 100, 250, 500, 1000, 2500])
+
+    def _ensure_worker(self):
+        # start the dispatcher thread lazily: threads do not survive a fork (e.g. gunicorn --preload)
+        if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive() or self._pid != os.getpid():
+                self._queue = queue.Queue()
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+                self._thread.start()
+
+    def submit(self, item):
+        """ queue an item for the next batch
+        Returns: concurrent.futures.Future resolving to the result for this item
+        """
+        future = Future()
+        if self.window == 0 or self.max_batch_size == 1:
+            # coalescing disabled: predict in the calling thread
+            self._execute([(item, future, time.perf_counter())])
+            return(future)
+        self._ensure_worker()
+        self._queue.put((item, future, time.perf_counter()))
+        return(future)
+
+    def predict(self, item, timeout=None):
+        """ Returns: the result for a single item (blocks until its batch has been processed) """
+        return(self.submit(item).result(timeout))
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            self.queue_depth.observe(self._queue.qsize() + 1)
+            deadline = time.perf_counter() + self.window
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._execute(batch)
+
+    def _execute(self, batch):
+        start = time.perf_counter()
+        for _, _, enqueued in batch:
+            self.wait_ms.observe((start - enqueued) * 1000)
+        self.batch_size.observe(len(batch))
+        try:
+            results = self.predict_fn([item for item, _, _ in batch])
+        except Exception as err:  # hand the failure to every caller of the batch
+            for _, future, _ in batch:
+                future.set_exception(err)
+        else:
+            for (_, future, _), result in zip(batch, results):
+                future.set_result(result)
+        self.batch_ms.observe((time.perf_counter() - start) * 1000)
+
+    def stats(self):
+        """ Returns: dict with the configuration, current queue depth and histograms """
+        return({
+            "window_ms": self.window * 1000,
+            "max_batch_size": self.max_batch_size,
+            "queue_depth_now": self._queue.qsize(),
+            "queue_depth": self.queue_depth.snapshot(),
+            "batch_size": self.batch_size.snapshot(),
+            "wait_ms": self.wait_ms.snapshot(),
+            "batch_ms": self.batch_ms.snapshot(),
+        })
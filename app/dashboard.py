@@ -0,0 +1,112 @@
+""" dashboard:
+
+    Cache for the dashboard graphs shown on the index page (app/run.py and app.py).
+    The plotly figures are built once (on the first request) and their JSON is kept until the
+    training database changes (modification time or number of rows of the DisasterMessages table).
+    Responses carry an ETag and Last-Modified header so that browsers and CDNs can revalidate cheaply.
+
+Attributes:
+    DashboardCache: lazily built, automatically invalidated graph JSON
+    dashboard_response: conditional (304 Not Modified) response for a cached dashboard
+"""
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from contextlib import nullcontext
+from collections import namedtuple
+from datetime import datetime, timezone
+
+import plotly
+from flask import make_response
+from werkzeug.http import is_resource_modified
+
+Dashboard = namedtuple("Dashboard", ["graph_json", "ids", "etag", "last_modified", "version"])
+
+
+class DashboardCache:
+    """ build the dashboard graphs once and rebuild them only when the database changes
+    Input:
+    - database_filepath: SQLite database that holds the training data
+    - build_fn: function without arguments that returns the list of plotly figures
+    - table: table whose row count is part of the database version
+    - check_interval: minimum number of seconds between two checks of the database version
+    - stage: context manager factory timing the build stages (e.g. metrics.Metrics.stage, None: not timed)
+    """
+
+    def __init__(self, database_filepath, build_fn, table="DisasterMessages", check_interval=1.0, stage=None):
+        self.database_filepath = database_filepath
+        self.build_fn = build_fn
+        self.stage = stage or (lambda name: nullcontext())
+        self.table = table
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._dashboard = None
+        self._checked = 0.0
+
+    def version(self):
+        """ Returns: (modification time in ns, number of rows) of the database
+        The write-ahead log is included as appended rows may not have been checkpointed into the main file yet
+        """
+        mtime = os.stat(self.database_filepath).st_mtime_ns
+        wal_filepath = self.database_filepath + "-wal"
+        if os.path.exists(wal_filepath) and os.path.getsize(wal_filepath) > 0:
+            mtime = max(mtime, os.stat(wal_filepath).st_mtime_ns)
+        connection = sqlite3.connect("file:{}?mode=ro".format(self.database_filepath), uri=True)
+        try:
+            row_count = connection.execute('SELECT COUNT(*) FROM "{}"'.format(self.table)).fetchone()[0]
+        finally:
+            connection.close()
+        return((mtime, row_count))
+
+    def get(self):
+        """ Returns: Dashboard with the graph JSON, html ids, ETag and Last-Modified of the current database """
+        dashboard = self._dashboard
+        now = time.monotonic()
+        if dashboard is not None and now - self._checked < self.check_interval:
+            return(dashboard)
+
+        with self._lock:
+            version = self.version()
+            self._checked = time.monotonic()
+            if self._dashboard is None or self._dashboard.version != version:
+                self._dashboard = self._build(version)
+            return(self._dashboard)
+
+    def invalidate(self):
+        with self._lock:
+            self._dashboard = None
+
+    def _build(self, version):
+        with self.stage("build_graphs"):
+            graphs = self.build_fn()
+        # plot ids for the html id tag
+        ids = ["graph-{}".format(i) for i, _ in enumerate(graphs)]
+        # Convert the plotly figures to JSON for javascript in html template
+        with self.stage("plotly_json"):
+            graph_json = json.dumps(graphs, cls=plotly.utils.PlotlyJSONEncoder)
+        etag = hashlib.sha1(graph_json.encode("utf-8")).hexdigest()
+        last_modified = datetime.fromtimestamp(version[0] / 1e9, tz=timezone.utc)
+        return(Dashboard(graph_json, ids, etag, last_modified, version))
+
+
+def dashboard_response(request, dashboard, render):
+    """ answer a dashboard request, skipping the rendering when the client's copy is still valid
+    Input:
+    - request: flask request (If-None-Match / If-Modified-Since headers)
+    - dashboard: Dashboard as returned by DashboardCache.get
+    - render: function without arguments that renders the page
+    Returns: flask response (200 with the page or 304 Not Modified)
+    """
+    if is_resource_modified(request.environ, etag=dashboard.etag, last_modified=dashboard.last_modified):
+        response = make_response(render())
+    else:
+        response = make_response("", 304)
+    response.set_etag(dashboard.etag)
+    response.last_modified = dashboard.last_modified
+    # clients may keep the page but have to revalidate it
+    response.cache_control.public = True
+    response.cache_control.no_cache = True
+    return(response)
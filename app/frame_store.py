@@ -0,0 +1,118 @@
+""" frame_store:
+
+    Compact, shared representation of the DisasterMessages table for the web applications.
+    Only the columns the applications need are extracted (no message text):
+    - categories: uint8 matrix (one column per category)
+    - genre: categorical (int8 codes)
+    - message_length: int32
+    The arrays are written once per database version as .npy files and memory-mapped read-only,
+    so forked workers share the same pages instead of holding their own copy.
+
+Attributes:
+    load_frame: MessageFrame for the current version of the database
+"""
+import os
+import json
+import shutil
+import sqlite3
+import tempfile
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+MessageFrame = namedtuple("MessageFrame", ["categories", "genre", "message_length", "version"])
+
+TEXT_COLUMNS = ("id", "message", "genre")
+FETCH_SIZE = 50000
+
+
+def database_version(database_filepath):
+    """ Returns: string identifying the content of the database (modification time + size of the file and its write-ahead log) """
+    parts = []
+    for filepath in (database_filepath, database_filepath + "-wal"):
+        # readers create an empty write-ahead log: only a log with content changes the version
+        if os.path.exists(filepath) and os.path.getsize(filepath) > 0:
+            stat = os.stat(filepath)
+            parts.append("{}-{}".format(stat.st_mtime_ns, stat.st_size))
+    return("_".join(parts))
+
+
+def export_frame(database_filepath, target_dir, table="DisasterMessages"):
+    """ extract genre, message length and the category columns into .npy files (streamed, the text is never loaded)
+    Input: SQLite database, directory to create
+    """
+    connection = sqlite3.connect("file:{}?mode=ro".format(database_filepath), uri=True)
+    try:
+        columns = [row[1] for row in connection.execute('PRAGMA table_info("{}")'.format(table))]
+        category_names = [c for c in columns if c not in TEXT_COLUMNS]
+        n_rows = connection.execute('SELECT COUNT(*) FROM "{}"'.format(table)).fetchone()[0]
+
+        categories = np.zeros((n_rows, len(category_names)), dtype=np.uint8)
+        message_length = np.zeros(n_rows, dtype=np.int32)
+        genre_codes = np.zeros(n_rows, dtype=np.int8)
+        genres = {}
+
+        query = 'SELECT genre, LENGTH(message), {} FROM "{}"'.format(", ".join('"{}"'.format(c) for c in category_names), table)
+        cursor = connection.execute(query)
+        start = 0
+        while True:
+            rows = cursor.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            end = start + len(rows)
+            genre_codes[start:end] = [genres.setdefault(row[0], len(genres)) for row in rows]
+            message_length[start:end] = [row[1] or 0 for row in rows]
+            categories[start:end] = np.array([row[2:] for row in rows], dtype=np.uint8)
+            start = end
+    finally:
+        connection.close()
+
+    os.makedirs(target_dir)
+    np.save(os.path.join(target_dir, "categories.npy"), categories[:start])
+    np.save(os.path.join(target_dir, "message_length.npy"), message_length[:start])
+    np.save(os.path.join(target_dir, "genre_codes.npy"), genre_codes[:start])
+    with open(os.path.join(target_dir, "meta.json"), "w") as f:
+        json.dump({"categories": category_names, "genres": sorted(genres, key=genres.get)}, f)
+    return
+
+
+def load_frame(database_filepath, cache_dir=None, table="DisasterMessages"):
+    """ load the compact, memory-mapped representation of the table (exported first when the database changed)
+    Input:
+    - database_filepath: SQLite database with the DisasterMessages table
+    - cache_dir: directory for the .npy files (default: <database>.frame next to the database)
+    Returns: MessageFrame with categories (uint8 DataFrame), genre (categorical Series), message_length (int32 Series)
+    """
+    cache_dir = cache_dir or os.path.splitext(database_filepath)[0] + ".frame"
+    version = database_version(database_filepath)
+    version_dir = os.path.join(cache_dir, version)
+
+    if not os.path.exists(version_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+        build_dir = tempfile.mkdtemp(dir=cache_dir, prefix=".build-")
+        try:
+            export_frame(database_filepath, os.path.join(build_dir, "frame"), table)
+            # another worker may have exported the same version in the meantime: keep the first one
+            try:
+                os.rename(os.path.join(build_dir, "frame"), version_dir)
+            except OSError:
+                pass
+        finally:
+            shutil.rmtree(build_dir, ignore_errors=True)
+        # drop older versions: workers that still map them keep their pages until they reload
+        for name in os.listdir(cache_dir):
+            if name != version and not name.startswith(".build-"):
+                shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+
+    with open(os.path.join(version_dir, "meta.json")) as f:
+        meta = json.load(f)
+    categories = np.load(os.path.join(version_dir, "categories.npy"), mmap_mode="r")
+    message_length = np.load(os.path.join(version_dir, "message_length.npy"), mmap_mode="r")
+    genre_codes = np.load(os.path.join(version_dir, "genre_codes.npy"), mmap_mode="r")
+
+    return(MessageFrame(
+        categories=pd.DataFrame(categories, columns=meta["categories"], copy=False),
+        genre=pd.Series(pd.Categorical.from_codes(genre_codes, categories=meta["genres"]), name="genre"),
+        message_length=pd.Series(message_length, name="message_length", copy=False),
+        version=version))
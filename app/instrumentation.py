@@ -0,0 +1,139 @@
+""" instrumentation:
+
+    Request instrumentation for the Flask applications (app/run.py and app.py):
+    - request count and latency histogram per endpoint, method and status
+    - /metrics endpoint with all metrics (including the stage timings recorded by the application)
+      in the Prometheus text format
+    - opt-in sampling profiler: the stacks of the request thread and of the helper threads that do its work
+      (the micro-batcher of /go) are sampled at a fixed interval and requests slower than a threshold are dumped
+      as folded stacks (one "thread;frame;frame;... count" line per stack, the input format of flamegraph.pl /
+      speedscope)
+
+Attributes:
+    instrument_app: register the hooks and the /metrics endpoint on a Flask application
+    SamplingProfiler: stack sampler for a thread and named helper threads
+"""
+import os
+import sys
+import time
+import random
+import threading
+from collections import Counter
+
+from flask import Response, g, request
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# innermost frames of a helper thread that waits for work: such samples are not recorded
+IDLE_FILES = ("threading.py", "queue.py")
+
+
+class SamplingProfiler:
+    """ sample the call stacks of a thread and of helper threads from a background thread
+    Input: id of the thread to sample, sampling interval in seconds, names of helper threads that are sampled
+    while they are busy (e.g. "micro-batcher": /go waits for it while it tokenizes and predicts)
+    Every stack starts with the name of its thread ("request" for the sampled thread).
+    """
+
+    def __init__(self, thread_id, interval=0.005, thread_names=()):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.thread_names = frozenset(thread_names)
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+        return(self)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        return(self)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            threads = {self.thread_id: "request"}
+            if self.thread_names:
+                threads.update({t.ident: t.name for t in threading.enumerate() if t.name in self.thread_names})
+            frames = sys._current_frames()
+            for thread_id, name in threads.items():
+                frame = frames.get(thread_id)
+                if frame is None or (thread_id != self.thread_id and os.path.basename(frame.f_code.co_filename) in IDLE_FILES):
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(name)
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def write(self, filepath):
+        """ write the samples as folded stacks """
+        with open(filepath, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write("{} {}\n".format(stack, count))
+
+
+def instrument_app(app, metrics):
+    """ record request counts and latencies, expose /metrics and profile slow requests
+    Input: Flask application, metrics.Metrics registry
+    Configuration (app.config, from the environment):
+    - PROFILE_SLOW_MS: dump the profile of requests slower than this many ms (0: profiler disabled)
+    - PROFILE_SAMPLE_RATE: fraction of the requests that are profiled (default 1)
+    - PROFILE_INTERVAL_MS: sampling interval (default 5)
+    - PROFILE_DIR: directory for the profiles (default "profiles")
+    - PROFILE_THREADS: comma separated names of the helper threads sampled with the request thread
+      (default "micro-batcher")
+    """
+    app.config.setdefault("PROFILE_SLOW_MS", float(os.environ.get("PROFILE_SLOW_MS", 0)))
+    app.config.setdefault("PROFILE_SAMPLE_RATE", float(os.environ.get("PROFILE_SAMPLE_RATE", 1)))
+    app.config.setdefault("PROFILE_INTERVAL_MS", float(os.environ.get("PROFILE_INTERVAL_MS", 5)))
+    app.config.setdefault("PROFILE_DIR", os.environ.get("PROFILE_DIR", "profiles"))
+    app.config.setdefault("PROFILE_THREADS", [name for name in os.environ.get("PROFILE_THREADS", "micro-batcher").split(",") if name])
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+        g.profiler = None
+        if app.config["PROFILE_SLOW_MS"] > 0 and random.random() < app.config["PROFILE_SAMPLE_RATE"]:
+            g.profiler = SamplingProfiler(threading.get_ident(), app.config["PROFILE_INTERVAL_MS"] / 1000,
+                                          app.config["PROFILE_THREADS"]).start()
+
+    @app.after_request
+    def record_request(response):
+        start = g.pop("request_start", None)
+        if start is None:
+            return(response)
+        elapsed = time.perf_counter() - start
+        endpoint = request.endpoint or "unmatched"
+        labels = {"endpoint": endpoint, "method": request.method, "status": response.status_code}
+        metrics.inc("http_requests_total", help_text="Number of requests", **labels)
+        metrics.observe("http_request_duration_seconds", elapsed, help_text="Request latency", **labels)
+
+        profiler = g.pop("profiler", None)
+        if profiler is not None:
+            profiler.stop()
+            if elapsed * 1000 >= app.config["PROFILE_SLOW_MS"]:
+                os.makedirs(app.config["PROFILE_DIR"], exist_ok=True)
+                filepath = os.path.join(app.config["PROFILE_DIR"], "{}-{}-{:.0f}ms.folded".format(
+                    endpoint, time.strftime("%Y%m%dT%H%M%S"), elapsed * 1000))
+                profiler.write(filepath)
+                metrics.inc("slow_request_profiles_total", help_text="Profiles written for slow requests", endpoint=endpoint)
+        return(response)
+
+    @app.teardown_request
+    def stop_profiler(exc):
+        # requests that failed before after_request ran
+        profiler = g.pop("profiler", None)
+        if profiler is not None:
+            profiler.stop()
+
+    @app.route("/metrics")
+    def prometheus_metrics():
+        return(Response(metrics.render(), content_type=PROMETHEUS_CONTENT_TYPE))
+
+    return
@@ -0,0 +1,217 @@
+""" metrics:
+
+    Lightweight, thread-safe instrumentation for the web applications.
+
+Attributes:
+    Histogram: cumulative bucket counts + sum/count of observed values
+    Metrics: labelled histograms, counters and callback gauges, rendered in the Prometheus text format
+    memory_usage: resident memory of the current process
+"""
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+# latency buckets in seconds
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+
+class Histogram:
+    """ histogram with fixed upper bounds (the last bucket is +Inf), safe to update from several threads
+    Input: sorted list of bucket upper bounds
+    """
+
+    def __init__(self, buckets):
+        self.buckets = sorted(buckets)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counts = [0] * (len(self.buckets) + 1)
+            self.count = 0
+            self.sum = 0.0
+
+    def observe(self, value):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[idx] += 1
+            self.count += 1
+            self.sum += value
+
+    def quantile(self, q):
+        """ estimate a quantile as the upper bound of the bucket that contains it
+        Input: q between 0 and 1
+        Returns: bucket upper bound (float('inf') for the overflow bucket), None when empty
+        """
+        with self._lock:
+            counts, count = list(self.counts), self.count
+        if count == 0:
+            return(None)
+        rank = q * count
+        cumulative = 0
+        for upper, bucket_count in zip(self.buckets + [float("inf")], counts):
+            cumulative += bucket_count
+            if cumulative >= rank:
+                return(upper)
+        return(float("inf"))
+
+    def values(self):
+        """ Returns: copy of the per-bucket counts, count and sum """
+        with self._lock:
+            return(list(self.counts), self.count, self.sum)
+
+    def snapshot(self):
+        """ Returns: dict with count, sum, mean, p50/p99 estimates and the per-bucket counts """
+        counts, count, total = self.values()
+        labels = [str(b) for b in self.buckets] + ["+Inf"]
+
+        def json_bound(value):
+            return("+Inf" if value == float("inf") else value)
+
+        return({
+            "count": count,
+            "sum": total,
+            "mean": total / count if count else None,
+            "p50": json_bound(self.quantile(0.5)),
+            "p99": json_bound(self.quantile(0.99)),
+            "buckets": dict(zip(labels, counts)),
+        })
+
+
+def escape_label(value):
+    return(str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+
+
+def format_labels(labels, extra=None):
+    """ Returns: {name="value",...} for a tuple of (name, value) pairs (empty string without labels) """
+    pairs = list(labels) + (list(extra) if extra else [])
+    if not pairs:
+        return("")
+    return("{" + ",".join('{}="{}"'.format(name, escape_label(value)) for name, value in pairs) + "}")
+
+
+def format_value(value):
+    if value == float("inf"):
+        return("+Inf")
+    return(repr(float(value)) if isinstance(value, float) else str(value))
+
+
+class Metrics:
+    """ registry of labelled histograms and counters + gauges/counters read from callbacks at scrape time
+    Input: labels added to every sample (e.g. {"app": "run"})
+    """
+
+    def __init__(self, const_labels=None):
+        self.const_labels = tuple(sorted((const_labels or {}).items()))
+        self._lock = threading.Lock()
+        self._families = {} # name -> (type, help, buckets)
+        self._histograms = {} # (name, labels) -> Histogram
+        self._counters = {} # (name, labels) -> value
+        self._callbacks = [] # (name, type, help, fn, label names)
+
+    def _register(self, name, metric_type, help_text, buckets=None):
+        family = self._families.get(name)
+        if family is None:
+            self._families[name] = (metric_type, help_text, buckets)
+        elif family[0] != metric_type:
+            raise ValueError("metric {} is already registered as a {}".format(name, family[0]))
+
+    def observe(self, name, value, help_text="", buckets=LATENCY_BUCKETS, **labels):
+        """ add an observation to the histogram name with the given labels """
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                self._register(name, "histogram", help_text, buckets)
+                histogram = self._histograms.setdefault(key, Histogram(self._families[name][2]))
+        histogram.observe(value)
+
+    def inc(self, name, amount=1, help_text="", **labels):
+        """ increase the counter name with the given labels """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._register(name, "counter", help_text)
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def register_callback(self, name, metric_type, help_text, fn, labels=()):
+        """ expose a value computed at scrape time
+        Input: metric name, "gauge" or "counter", help text, function without arguments returning a number
+        (or, with label names, a dict of {tuple of label values: number})
+        """
+        with self._lock:
+            self._callbacks.append((name, metric_type, help_text, fn, tuple(labels)))
+
+    @contextmanager
+    def stage(self, stage):
+        """ time a block of code as stage_duration_seconds{stage=...} """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("stage_duration_seconds", time.perf_counter() - start,
+                         help_text="Duration of the processing stages of a request", stage=stage)
+
+    def render(self):
+        """ Returns: all metrics in the Prometheus text exposition format (version 0.0.4) """
+        lines = []
+        with self._lock:
+            families = dict(self._families)
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+            callbacks = list(self._callbacks)
+
+        for name, (metric_type, help_text, _) in sorted(families.items()):
+            lines.append("# HELP {} {}".format(name, help_text or name))
+            lines.append("# TYPE {} {}".format(name, metric_type))
+            if metric_type == "histogram":
+                for (metric, labels), histogram in histograms:
+                    if metric != name:
+                        continue
+                    counts, count, total = histogram.values()
+                    cumulative = 0
+                    for upper, bucket_count in zip(histogram.buckets + [float("inf")], counts):
+                        cumulative += bucket_count
+                        lines.append("{}_bucket{} {}".format(
+                            name, format_labels(self.const_labels + labels, [("le", format_value(upper))]), cumulative))
+                    lines.append("{}_sum{} {}".format(name, format_labels(self.const_labels + labels), format_value(total)))
+                    lines.append("{}_count{} {}".format(name, format_labels(self.const_labels + labels), count))
+            else:
+                for (metric, labels), value in counters:
+                    if metric == name:
+                        lines.append("{}{} {}".format(name, format_labels(self.const_labels + labels), format_value(value)))
+
+        for name, metric_type, help_text, fn, label_names in callbacks:
+            lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} {}".format(name, metric_type))
+            value = fn()
+            if label_names:
+                for label_values, v in sorted(value.items()):
+                    labels = tuple(zip(label_names, label_values))
+                    lines.append("{}{} {}".format(name, format_labels(self.const_labels + labels), format_value(v)))
+            elif value is not None:
+                lines.append("{}{} {}".format(name, format_labels(self.const_labels), format_value(value)))
+        return("\n".join(lines) + "\n")
+
+
+def memory_usage():
+    """ resident memory of the current process, split into anonymous (private) and file-backed (shareable) pages
+    Returns: dict with the sizes in bytes (Linux: VmRSS, RssAnon, RssFile, RssShmem, VmHWM; other Unix systems only
+    the peak, Windows: empty)
+    """
+    usage = {}
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in ("VmRSS", "RssAnon", "RssFile", "RssShmem", "VmHWM"):
+                    usage[key] = int(value.split()[0]) * 1024
+    except OSError:
+        try:
+            # Unix only (not available on Windows)
+            import resource
+        except ImportError:
+            return(usage)
+        # ru_maxrss is in kilobytes on Linux, bytes on macOS
+        usage["VmHWM"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return(usage)
@@ -0,0 +1,162 @@
+""" model_registry:
+
+    Hot reload of the model of a serving process: a watcher thread polls the version (modification time and size)
+    of the model artifact, loads a new version in the background, classifies a short warm-up batch with it and then
+    swaps it in with a single reference assignment. Requests that already hold the previous model finish on it; its
+    memory is released when the last of them returns, so two models are resident only during the load and the swap.
+    A version that fails to load or to warm up is skipped and the previous model keeps serving.
+
+Attributes:
+    WARM_UP_MESSAGES: (message, genre) pairs classified by a new model before it is swapped in
+    ModelRegistry: watcher of the model artifact of a Resource (see startup.py)
+"""
+import gc
+import os
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+WARM_UP_MESSAGES = [
+    ("We need water and food, please help", "direct"),
+    ("The earthquake destroyed several buildings and roads", "news"),
+    ("Heavy rain and floods expected tonight #storm", "social"),
+]
+
+
+def warm_up(engine):
+    """ classify WARM_UP_MESSAGES (tokenizer, features and model pages loaded before the first request) """
+    messages, genres = zip(*WARM_UP_MESSAGES)
+    engine.classify(list(messages), list(genres))
+
+
+class ModelRegistry:
+    """ replace the InferenceEngine held by a Resource when its artifact changes
+    Input:
+    - resource: Resource that loads the first engine (startup.py)
+    - loader: function without arguments that loads the current artifact (InferenceEngine)
+    - artifact_path: model pickle or export directory that is watched
+    - interval: seconds between two checks (0: no watcher, reload only on demand)
+    - on_swap: function called with the new engine after the swap (e.g. to invalidate cached results)
+    A new version is loaded once it has been seen unchanged by two consecutive checks (the artifact may still be
+    being written at the first one).
+    """
+
+    def __init__(self, resource, loader, artifact_path, interval=10, on_swap=None):
+        self.resource = resource
+        self.loader = loader
+        self.artifact_path = artifact_path
+        self.interval = interval
+        self.on_swap = on_swap
+        self.reloads = 0
+        self.failures = 0
+        self.last_error = None
+        self.last_reload_sec = None
+        self.swapped_at = None
+        self._candidate = None
+        self._failed_version = None
+        self._reload_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    @property
+    def version(self):
+        """ version of the active model (None before the first load) """
+        engine = self.resource.value
+        return(engine.version if engine is not None else None)
+
+    def start(self):
+        """ start the watcher thread when it is not running in this process (no-op when the interval is 0)
+        Called on first use, not at import: threads do not survive a fork (e.g. gunicorn --preload), so every
+        forked worker starts its own watcher.
+        """
+        if self.interval <= 0 or (self._thread is not None and self._thread.is_alive() and self._pid == os.getpid()):
+            return(self)
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive() or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name="model-watcher", daemon=True)
+                self._thread.start()
+        return(self)
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.check()
+            except Exception:
+                logger.exception("model reload check failed")
+
+    def check(self):
+        """ reload when the artifact has a new version that did not change since the previous check
+        Returns: True when a new model was swapped in
+        """
+        if not self.resource.ready:
+            return(False)
+        # imported with the model (inference imports the scientific stack)
+        from inference import artifact_version
+        try:
+            version = artifact_version(self.artifact_path)
+        except OSError:
+            # the artifact is being replaced
+            return(False)
+        if version == self.version or version == self._failed_version:
+            self._candidate = None
+            return(False)
+        if version != self._candidate:
+            self._candidate = version
+            return(False)
+        return(self.reload())
+
+    def reload(self):
+        """ load the artifact, warm it up and swap it in (the active model keeps serving when this fails)
+        Returns: True when the new model was swapped in
+        """
+        from inference import artifact_version
+        with self._reload_lock:
+            start = time.perf_counter()
+            version = None
+            try:
+                version = artifact_version(self.artifact_path)
+                engine = self.loader()
+                # the version of what was actually loaded (the artifact may have been replaced meanwhile)
+                version = engine.version
+                warm_up(engine)
+            except Exception as err:
+                self.failures += 1
+                self.last_error = "{}: {}".format(type(err).__name__, err)
+                self._failed_version = version
+                logger.exception("loading model %s failed, keeping version %s", self.artifact_path, self.version)
+                return(False)
+            previous = self.version
+            self.resource.replace(engine)
+            if self.on_swap is not None:
+                self.on_swap(engine)
+            self.reloads += 1
+            self.last_error = None
+            self._candidate = self._failed_version = None
+            self.last_reload_sec = time.perf_counter() - start
+            self.swapped_at = time.time()
+            logger.info("model %s: version %s replaced by %s in %.2fs", self.artifact_path, previous, engine.version,
+                        self.last_reload_sec)
+        del engine
+        # the previous model is freed once the requests using it return (reference cycles: by the collector)
+        gc.collect()
+        return(True)
+
+    def stats(self):
+        return({
+            "artifact": self.artifact_path,
+            "version": self.version,
+            "check_interval_sec": self.interval,
+            "reloads": self.reloads,
+            "failures": self.failures,
+            "last_error": self.last_error,
+            "last_reload_sec": round(self.last_reload_sec, 4) if self.last_reload_sec is not None else None,
+            "swapped_at": self.swapped_at,
+        })
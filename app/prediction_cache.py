@@ -0,0 +1,268 @@
+""" prediction_cache:
+
+    Cache of classification results for repeated messages (forwards, retweets) in front of the model.
+    - exact entries: keyed on (model version, genre, normalized message text, message length), bounded LRU with an
+      optional TTL; the length is the raw one, as the "len" feature of the model (messages that differ only in case
+      or whitespace give the same tokens, but not always the same "len" quantile)
+    - near duplicates (optional): MinHash signature of the message tokens, looked up through LSH bands,
+      so that a message differing from a cached one in a few words reuses its result (an approximation: its
+      length and punctuation features may differ too)
+    All entries belong to one model version: setting another version (new model loaded) empties the cache.
+
+Attributes:
+    PredictionCache: thread-safe LRU/TTL cache of (labels, probabilities) with hit/miss/eviction counters
+    CachedBatch: results of a batch of messages, filled from the cache and completed with the predicted ones
+    normalize: cache key text of a message
+"""
+import re
+import time
+import zlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+WHITESPACE = re.compile(r"\s+")
+# Mersenne prime 2**61 - 1 for the MinHash permutations (a * h + b) mod p
+MERSENNE_PRIME = (1 << 61) - 1
+
+
+def normalize(text):
+    """ Returns: message text as cache key: lower case, surrounding whitespace removed, inner whitespace collapsed """
+    return(WHITESPACE.sub(" ", text).strip().lower())
+
+
+class MinHash:
+    """ MinHash signatures of token sets
+    Input: number of hash permutations, seed
+    """
+
+    def __init__(self, num_perm=32, seed=0):
+        rng = np.random.RandomState(seed)
+        self.num_perm = num_perm
+        self.a = rng.randint(1, 1 << 31, size=num_perm).astype(np.uint64)
+        self.b = rng.randint(0, 1 << 31, size=num_perm).astype(np.uint64)
+
+    def signature(self, tokens):
+        """ Returns: uint64 array with the minimum permuted hash per permutation (None for an empty token set) """
+        if not tokens:
+            return(None)
+        hashes = np.fromiter((zlib.crc32(t.encode("utf-8")) for t in set(tokens)), dtype=np.uint64)
+        # 32 bit hashes and 31 bit coefficients: the products stay below 2**63
+        return(((np.outer(hashes, self.a) + self.b) % MERSENNE_PRIME).min(axis=0))
+
+
+class PredictionCache:
+    """ LRU/TTL cache of classification results
+    Input:
+    - maxsize: maximum number of cached messages (0 disables the cache)
+    - ttl: seconds an entry stays valid (0: until evicted)
+    - model_version: version of the model whose results are cached
+    - tokenizer: tokenize function for near-duplicate lookups (None: exact lookups only)
+    - threshold: minimum estimated Jaccard similarity of the token sets for a near-duplicate hit
+    - num_perm / bands: MinHash permutations and LSH bands (num_perm must be a multiple of bands)
+    """
+
+    def __init__(self, maxsize=10000, ttl=0, model_version=None, tokenizer=None, threshold=0.9, num_perm=32, bands=8):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.maxsize = max(0, int(maxsize))
+        self.ttl = max(0.0, float(ttl))
+        self.model_version = model_version
+        self.tokenizer = tokenizer
+        self.threshold = threshold
+        self.bands = bands
+        self.minhash = MinHash(num_perm) if tokenizer is not None else None
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # key -> (expires, labels, probabilities, signature)
+        self._buckets = {} # (genre, band, band signature) -> set of keys
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = 0
+            self.near_duplicate_hits = 0
+            self.misses = 0
+            self.evictions = 0
+            self.expirations = 0
+            self.invalidations = 0
+
+    def set_model_version(self, model_version):
+        """ drop all entries when the results were computed by another model version """
+        with self._lock:
+            if model_version != self.model_version:
+                self.model_version = model_version
+                self._clear()
+
+    def clear(self):
+        with self._lock:
+            self._clear()
+
+    def _clear(self):
+        if self._entries:
+            self.invalidations += 1
+        self._entries.clear()
+        self._buckets.clear()
+
+    def _band_keys(self, genre, signature):
+        rows = len(signature) // self.bands
+        return([(genre, band, signature[band * rows:(band + 1) * rows].tobytes()) for band in range(self.bands)])
+
+    def _remove(self, key):
+        _, _, _, signature = self._entries.pop(key)
+        if signature is not None:
+            for band_key in self._band_keys(key[0], signature):
+                bucket = self._buckets.get(band_key)
+                if bucket is not None:
+                    bucket.discard(key)
+                    if not bucket:
+                        del self._buckets[band_key]
+
+    def _valid(self, key, now):
+        """ Returns: entry for key when present and not expired (expired entries are removed) """
+        entry = self._entries.get(key)
+        if entry is None:
+            return(None)
+        if entry[0] is not None and entry[0] < now:
+            self._remove(key)
+            self.expirations += 1
+            return(None)
+        self._entries.move_to_end(key)
+        return(entry)
+
+    def _near_duplicate(self, genre, signature, now):
+        """ Returns: cached entry of the most similar message sharing an LSH band (None below the threshold) """
+        candidates = set()
+        for band_key in self._band_keys(genre, signature):
+            candidates.update(self._buckets.get(band_key, ()))
+        ranked = []
+        for key in candidates:
+            similarity = np.mean(self._entries[key][3] == signature)
+            if similarity >= self.threshold:
+                ranked.append((similarity, key))
+        # most similar first: expired entries are evicted and the next candidate above the threshold is tried
+        for _, key in sorted(ranked, key=lambda candidate: candidate[0], reverse=True):
+            entry = self._valid(key, now)
+            if entry is not None:
+                return(entry)
+        return(None)
+
+    def lookup(self, messages, genres, model_version=None):
+        """ look up a batch of messages
+        Input: list of messages, list of genres, version of the model that classifies the misses (when the cache
+        holds the results of another version, e.g. during a model swap, every message misses)
+        Returns: list with (labels, probabilities) per message (None when not cached), list of cache keys,
+        list of MinHash signatures (None without near-duplicate lookups)
+        """
+        keys = [(genre, normalize(message), len(message)) for message, genre in zip(messages, genres)]
+        signatures = [None] * len(keys)
+        results = [None] * len(keys)
+        if self.maxsize == 0:
+            return(results, keys, signatures)
+
+        now = time.monotonic()
+        with self._lock:
+            for i, key in enumerate(keys):
+                entry = self._valid(key, now) if self._current(model_version) else None
+                if entry is not None:
+                    self.hits += 1
+                    results[i] = entry[1:3]
+        if self.minhash is not None:
+            # tokenize outside of the lock: the signature is kept for the insertion of misses
+            for i, key in enumerate(keys):
+                if results[i] is None:
+                    signatures[i] = self.minhash.signature(self.tokenizer(key[1]))
+        with self._lock:
+            for i, key in enumerate(keys):
+                if results[i] is not None:
+                    continue
+                entry = (self._near_duplicate(key[0], signatures[i], now)
+                         if signatures[i] is not None and self._current(model_version) else None)
+                if entry is not None:
+                    self.near_duplicate_hits += 1
+                    results[i] = entry[1:3]
+                else:
+                    self.misses += 1
+        return(results, keys, signatures)
+
+    def _current(self, model_version):
+        """ Returns: whether the entries were computed by model_version (True when it is not given) """
+        return(model_version is None or model_version == self.model_version)
+
+    def store(self, keys, signatures, labels, probabilities, model_version=None):
+        """ cache the results of the messages that missed
+        Input: cache keys and signatures as returned by lookup, label and probability row per message,
+        model version that computed them (results of another version than the cache's are not stored)
+        """
+        if self.maxsize == 0:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            if not self._current(model_version):
+                return
+            for key, signature, row_labels, row_probabilities in zip(keys, signatures, labels, probabilities):
+                if key in self._entries:
+                    self._remove(key)
+                self._entries[key] = (expires, row_labels, row_probabilities, signature)
+                if signature is not None:
+                    for band_key in self._band_keys(key[0], signature):
+                        self._buckets.setdefault(band_key, set()).add(key)
+                while len(self._entries) > self.maxsize:
+                    self._remove(next(iter(self._entries)))
+                    self.evictions += 1
+
+    def stats(self):
+        """ Returns: dict with size, configuration and hit/miss/eviction counters """
+        with self._lock:
+            lookups = self.hits + self.near_duplicate_hits + self.misses
+            return({
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "ttl_sec": self.ttl,
+                "near_duplicates": self.minhash is not None,
+                "model_version": self.model_version,
+                "hits": self.hits,
+                "near_duplicate_hits": self.near_duplicate_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.hits + self.near_duplicate_hits) / lookups, 4) if lookups else None,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            })
+
+
+class CachedBatch:
+    """ results of a batch of messages: rows found in the cache are filled in, the others are pending
+    Input: PredictionCache, list of messages, list of genres, number of categories, version of the model that
+    predicts the pending messages (only results of that version are taken from the cache)
+    Attributes: labels / probabilities (n_messages x n_categories), pending: indices of the messages to predict
+    (copies within the batch are predicted once)
+    """
+
+    def __init__(self, cache, messages, genres, n_categories, model_version=None):
+        cached, self.keys, self.signatures = cache.lookup(messages, genres, model_version)
+        self.cache = cache
+        self.labels = np.zeros((len(messages), n_categories), dtype=int)
+        self.probabilities = np.zeros((len(messages), n_categories))
+        self._first = {} # key -> index of the first message with that key
+        self._misses = []
+        for i, result in enumerate(cached):
+            if result is not None:
+                self.labels[i], self.probabilities[i] = result
+            else:
+                self._misses.append(i)
+                self._first.setdefault(self.keys[i], i)
+        self.pending = list(self._first.values())
+
+    def complete(self, labels, probabilities, model_version=None):
+        """ fill in (and cache) the predictions of the pending messages
+        Input: label and probability rows for the pending messages (in the order of pending), model version that computed them
+        """
+        if not self.pending:
+            return
+        self.labels[self.pending], self.probabilities[self.pending] = labels, probabilities
+        self.cache.store([self.keys[i] for i in self.pending], [self.signatures[i] for i in self.pending],
+                         self.labels[self.pending], self.probabilities[self.pending], model_version=model_version)
+        for i in self._misses:
+            first = self._first[self.keys[i]]
+            self.labels[i], self.probabilities[i] = self.labels[first], self.probabilities[first]
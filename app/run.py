@@ -11,93 +11,243 @@ Attributes:
 
 Input:
     Training Data with messages and classification: 
-        database: "../data/DisasterResponse.db": 
+        database: "../data/DisasterResponse.db" (env variable DATABASE_FILEPATH): 
         table: "DisasterMessages"
-    ML model to classify messages into different categories: ../models/DisasterResponse.pkl
+    ML model to classify messages into different categories: ../models/DisasterResponse.pkl (env variable MODEL_FILEPATH)
+        or the export of that model (models/export_model.py) when env variable MODEL_EXPORT_DIR is set
+        env variable MODEL_PREDICTOR: "fused" (default, all category classifiers scored with one matrix product)
+        or "pipeline" (the pickled pipeline as trained)
     
 Output:
     Webpage: http://127.0.0.1:3000/
+    Batch API: POST http://127.0.0.1:3000/api/classify
+        body: JSON array of messages (strings or {"message": ..., "genre": ...} objects),
+              {"messages": [...]} or NDJSON (one message per line)
+        returns: per-message category labels and probabilities + throughput (messages/sec) + model version
+        (/go and /api/classify: header X-Model-Version)
+    Model version and reloads: http://127.0.0.1:3000/api/model
+        a new version of the model artifact is loaded, warmed up and swapped in without a restart; env variable
+        MODEL_RELOAD_INTERVAL_SEC: seconds between two checks of the artifact (default 10, 0 disables the reload)
+    Prediction cache statistics: http://127.0.0.1:3000/api/cache
+    Metrics (Prometheus text format): http://127.0.0.1:3000/metrics
+        request counts/latencies and stage timings (build_features, tokenize, features, classifiers,
+        build_graphs, plotly_json, render); env variable PROFILE_SLOW_MS dumps a sampling profile of slower requests
+    Liveness: http://127.0.0.1:3000/healthz, readiness + import/load times: http://127.0.0.1:3000/ready
+        env variable STARTUP_MODE: "eager" (default, model loaded before serving),
+        "background" (loaded in a thread, /ready answers 503 until done) or "lazy" (loaded by the first request)
 """
 
 #%%
-import json
-import plotly
-import pandas as pd
-import joblib
-import string
-import nltk
+import os
+import time
+import sys
 # from scipy import stats - Remove as not running on Heroku
 
-from nltk.stem import WordNetLemmatizer
-from nltk.tokenize import word_tokenize
-from nltk.corpus import stopwords
+from startup import StartupTimer, Resource, NotReady, register_health_routes, STARTUP_MODES
+# import and load times of this worker (reported on /ready and /metrics)
+startup = StartupTimer()
 
+import numpy as np
 from flask import Flask
-from flask import render_template, request, jsonify
-from plotly.graph_objs import Bar
-import plotly.express as px
-from sqlalchemy import create_engine
+from flask import render_template, request, jsonify, make_response
+
+from batcher import MicroBatcher
+from dashboard import DashboardCache, dashboard_response
+from metrics import Metrics, memory_usage
+from instrumentation import instrument_app
+from prediction_cache import PredictionCache, CachedBatch
+from batch_api import parse_body, batch_response, MODEL_VERSION_HEADER
+from model_registry import ModelRegistry
+
+# the inference engine and the tokenizer are shared with the scripts in models/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "models"))
+# the dashboard reads the summary tables written by data/process_data.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data"))
+# tokenize must be available in this module: models pickled by train_classifier.py as a script refer to __main__.tokenize
+from tokenizer import tokenize
+# the scientific stack (pandas, scipy, scikit-learn, plotly.express) is imported when the model, the training data
+# and the graphs are loaded, not here
+startup.mark("imports")
 #%%
 
 # Initiate Flask application
 app = Flask(__name__)
 app.secret_key = "whatever_blabla"
+# maximum number of messages accepted in a single /api/classify call
+app.config["MAX_BATCH_SIZE"] = int(os.environ.get("MAX_BATCH_SIZE", 1000))
+# micro-batching of concurrent /go requests: collection window (0 disables coalescing) and batch limit
+app.config["COALESCE_WINDOW_MS"] = float(os.environ.get("COALESCE_WINDOW_MS", 5))
+app.config["COALESCE_MAX_BATCH"] = int(os.environ.get("COALESCE_MAX_BATCH", 64))
+# "fused": score the pickled pipeline with its stacked coefficients (models/predictor.py), "pipeline": as trained
+app.config["MODEL_PREDICTOR"] = os.environ.get("MODEL_PREDICTOR", "fused")
+# cache of classification results for repeated messages: size (0 disables), time to live in seconds (0: no expiry),
+# near-duplicate lookups through MinHash signatures of the tokens (1 enables)
+app.config["PREDICTION_CACHE_SIZE"] = int(os.environ.get("PREDICTION_CACHE_SIZE", 10000))
+app.config["PREDICTION_CACHE_TTL"] = float(os.environ.get("PREDICTION_CACHE_TTL", 3600))
+app.config["PREDICTION_CACHE_NEAR_DUPLICATES"] = os.environ.get("PREDICTION_CACHE_NEAR_DUPLICATES", "0") == "1"
+# model: loaded at import ("eager"), in a background thread ("background") or by the first request that needs it
+# ("lazy"); requests wait at most STARTUP_WAIT_SEC for a background load before answering 503
+app.config["STARTUP_MODE"] = os.environ.get("STARTUP_MODE", "eager")
+app.config["STARTUP_WAIT_SEC"] = float(os.environ.get("STARTUP_WAIT_SEC", 30))
+# seconds between two checks of the model artifact for a new version (loaded, warmed up and swapped in without
+# a restart), 0 disables the reload
+app.config["MODEL_RELOAD_INTERVAL_SEC"] = float(os.environ.get("MODEL_RELOAD_INTERVAL_SEC", 10))
+if app.config["STARTUP_MODE"] not in STARTUP_MODES:
+    raise ValueError("STARTUP_MODE must be one of {}".format(", ".join(STARTUP_MODES)))
+
+# request and stage latency histograms on /metrics, profiles of slow requests (PROFILE_SLOW_MS)
+metrics = Metrics({"app": "run"})
+instrument_app(app, metrics)
 
 
-def tokenize(text):
-    """ tokenize, convert text to lowercase, remove stopwords and punctuation and lemmatize
-    Input: text string
-    Returns: list of tokens
+# load message training data
+database_filepath = os.environ.get("DATABASE_FILEPATH", "../data/DisasterResponse.db")
+
+
+def load_messages():
+    """ load the training data needed for the graphs: category columns, genre and the length of every message
+    (from the compact, memory-mapped copy of the DisasterMessages table shared by all workers, no message text)
+    Returns: DataFrame
     """
-    stop = set(stopwords.words('english') + list(string.punctuation))
-    nltk_tokens = nltk.word_tokenize(text.lower())
-    tokens = [w for w in nltk_tokens if not w in stop]
-    lemmatizer = WordNetLemmatizer()
-    tokens = [lemmatizer.lemmatize(w) for w in tokens]
-    return(tokens)
+    frame = frame_resource.get()
+    return(frame.categories.assign(genre=frame.genre, message_length=frame.message_length))
 
-# load message training data
-engine = create_engine('sqlite:///../data/DisasterResponse.db')
-df = pd.read_sql_table('DisasterMessages', engine)
-df["message_length"] = df["message"].str.len()
 
-# load trained model
-model = joblib.load("../models/DisasterResponse.pkl")
+def load_summary():
+    """ load the statistics plotted by the dashboard: the summary tables of the database (a few small tables),
+    computed from the training data for databases written before process_data.py maintained them
+    Returns: summary_tables.Summary
+    """
+    from summary_tables import Summary, load_summary as read_summary_tables
+    summary = read_summary_tables(database_filepath)
+    if summary is None:
+        summary = Summary.from_frame(load_messages())
+    return(summary)
 
 
-# index webpage displays cool visuals and receives user input text for model
-@app.route('/')
-@app.route('/index')
-def index():
-    
-    # extract data needed for visuals
-    
-    genre_counts = df.groupby('genre').count()['message']
-    genre_names = list(genre_counts.index)
+def load_data():
+    """ Returns: MessageFrame of the training database (compact, memory-mapped copy, see frame_store.py) """
+    from frame_store import load_frame
+    return(load_frame(database_filepath))
+
+
+# trained model: the memory-mapped export loads in milliseconds and its pages are shared between workers
+model_export_dir = os.environ.get("MODEL_EXPORT_DIR")
+model_filepath = os.environ.get("MODEL_FILEPATH", "../models/DisasterResponse.pkl")
+
+# results are cached per model version: loading another model artifact empties the cache
+prediction_cache = PredictionCache(app.config["PREDICTION_CACHE_SIZE"], ttl=app.config["PREDICTION_CACHE_TTL"],
+    tokenizer=tokenize if app.config["PREDICTION_CACHE_NEAR_DUPLICATES"] else None)
+
+
+def read_model():
+    """ Returns: inference.InferenceEngine of the current model artifact """
+    from inference import load_engine
+    return(load_engine(model_filepath, model_export_dir, app.config["MODEL_PREDICTOR"], database_filepath, stage=metrics.stage))
+
+
+def load_model():
+    """ import the inference stack and load the model
+    Returns: inference.InferenceEngine
+    """
+    with startup.phase("import_inference"):
+        import inference
+    engine = read_model()
+    prediction_cache.set_model_version(engine.version)
+    return(engine)
+
+
+# the copy of the training data is loaded on demand (dashboard of a database without summary tables): the model
+# carries its categories and length quantiles, so neither the start nor /ready waits for every message
+frame_resource = Resource("data", load_data, startup)
+engine_resource = Resource("model", load_model, startup)
+# a new model artifact is loaded and warmed up in the background, then swapped in: requests in flight finish on
+# the previous model, cached results of the previous model are dropped
+model_registry = ModelRegistry(engine_resource, read_model, model_export_dir or model_filepath,
+    interval=app.config["MODEL_RELOAD_INTERVAL_SEC"], on_swap=lambda engine: prediction_cache.set_model_version(engine.version))
+if app.config["STARTUP_MODE"] != "lazy":
+    engine_resource.start(background=app.config["STARTUP_MODE"] == "background")
+    # eager: a model that cannot be loaded stops the start as before
+    if app.config["STARTUP_MODE"] == "eager":
+        engine_resource.get()
+
+
+def get_engine():
+    """ Returns: loaded InferenceEngine (waits for a background load, loads it on first use in lazy mode)
+    Raises: NotReady when the model is not loaded within STARTUP_WAIT_SEC
+    """
+    # the watcher is started by the first request of every process (not at import: lost when a preloading server forks)
+    model_registry.start()
+    return(engine_resource.get(app.config["STARTUP_WAIT_SEC"]))
+
+
+def classify_messages(messages, genres):
+    """ classify messages, predicting only those without a cached result (in one batch)
+    Input: list of messages, list of genres
+    Returns: labels (n_messages x n_categories, int), probabilities of the positive class (same shape) and
+    the InferenceEngine used (the whole batch is classified by one model, also when it is replaced meanwhile)
+    """
+    engine = get_engine()
+    # results cached by another model version (the model may be swapped meanwhile) are not mixed in
+    batch = CachedBatch(prediction_cache, messages, genres, len(engine.category_names), engine.version)
+    if batch.pending:
+        # copies within the batch are predicted once
+        batch.complete(*engine.classify([messages[i] for i in batch.pending], [genres[i] for i in batch.pending]),
+                       model_version=engine.version)
+    return(batch.labels, batch.probabilities, engine)
+
+
+def classify_items(items):
+    """ classify the (message, genre) items collected by the micro-batcher as one batch
+    Input: list of (message, genre) tuples
+    Returns: list with (label row (array of 0/1 per category), InferenceEngine used) for every item
+    """
+    queries, genres = zip(*items)
+    labels, _, engine = classify_messages(list(queries), list(genres))
+    return([(row, engine) for row in labels])
+
+
+# concurrent /go requests share batched predictions
+batcher = MicroBatcher(classify_items, max_batch_size=app.config["COALESCE_MAX_BATCH"], window_ms=app.config["COALESCE_WINDOW_MS"])
+
+
+def parse_batch(req):
+    """ extract messages and genres from a /api/classify request
+    Input: flask request with a JSON array, a {"messages": [...]} object or NDJSON (one message per line)
+    Returns: list of messages, list of genres
+    Raises: ValueError when the body cannot be interpreted
+    """
+    return(parse_body(req.get_data(as_text=True), req.mimetype))
+
 
-    # Create 6 graphs
+def build_graphs():
+    """ create the dashboard graphs from the summary tables of the training data (called once per database version
+    by the dashboard cache)
+    Returns: list of plotly figures
+    """
+    # plotly is imported by the first dashboard build
+    import plotly.express as px
+    import plotly.graph_objects as go
+    summary = load_summary()
+
+    # Create 7 graphs
     graphs = [None]*7
 
     # Graph 1: Correlation matrix to depict relationship between message categories
-    correlation_matrix = df.corr()
+    correlation_matrix = summary.correlation()
     graphs[0] = px.imshow(correlation_matrix)
 
     # Graph 2: Bargraph to depict the categories that go along with the "aid_related" category
     # The correlation matrix depicts that there are several correlations
-    df_line = df[df["aid_related"]==1]
-    df_line = df_line.drop(columns=["id","message","genre","aid_related","message_length"])
-    df_line = df_line.sum()
-    df_line = df_line.reset_index()
-    df_line.columns=(["Category","Count"])
-    df_line = df_line.sort_values(by="Count",ascending=False)
+    df_line = summary.category_counts(given="aid_related")
     graphs[1] = px.bar(df_line,x="Category",y="Count")
 
     # Graph 3: Bargraph depicting the number of messages per 'genre'
-    df_genre_counts = df.groupby('genre', as_index=False).agg(count=('message','count'))   
+    df_genre_counts = summary.genre_counts()
     graphs[2] = px.bar(df_genre_counts, x="genre", y="count", barmode="stack",title="Aid Related correlation")
 
     # Graph 4: Bargraph depicting the number of messages per 'genre', differentiated by "Aid related"
-    df_aid_related = df.groupby(['aid_related','genre'], as_index=False).agg(count=('message','count'))
+    df_aid_related = summary.genre_aid_counts()
     df_aid_related["aid"] = df_aid_related["aid_related"].map({0: "Not Aid Related", 1: "Aid Related",})
     graphs[3] = px.bar(df_aid_related, x="genre", y="count", color="aid", barmode="stack", title="#Aid related")
 
@@ -105,25 +255,67 @@ def index():
     df_aid_related["count2"] = df_aid_related["count"].div(df_aid_related.groupby("genre")["count"].transform("sum"))
     graphs[4] = px.bar(df_aid_related, x="genre", y="count2", color="aid", barmode="stack", title="%Aid related")
     
-    # Graph 6: Boxplot depicting the length of the messages per "genre"
-    df_message_len = df[["genre","message_length"]]
-    graphs[5] = px.box(df_message_len, x="genre", y="message_length", log_y=True, title="message length")
+    # Graph 6: Boxplot depicting the length of the messages per "genre" (drawn from the quartiles, no outlier points)
+    df_message_len = summary.length_boxes()
+    graphs[5] = go.Figure(go.Box(x=df_message_len["genre"], q1=df_message_len["q1"], median=df_message_len["median"],
+        q3=df_message_len["q3"], lowerfence=df_message_len["lowerfence"], upperfence=df_message_len["upperfence"]),
+        layout=dict(title="message length", xaxis_title="genre", yaxis_title="message_length", yaxis_type="log"))
 
     # Graph 7: Bargraph to depict the number of category occurences in the database
-    df_categories = df
-    df_categories = df_categories.drop(columns=["id","message","genre","message_length"])
-    df_categories = df_categories.sum()
-    df_categories = df_categories.reset_index()
-    df_categories.columns=(["Category","Count"])
-    df_categories = df_categories.sort_values(by="Count",ascending=False)
+    df_categories = summary.category_counts()
     graphs[6] = px.bar(df_categories,x="Category",y="Count",title="Number of category occurences in training set")
+    return(graphs)
+
+
+# dashboard graphs are built on the first request and rebuilt only when the database changes
+dashboard_cache = DashboardCache(database_filepath, build_graphs, stage=metrics.stage)
+
+# state of the micro-batcher and the prediction cache, read when /metrics is scraped
+metrics.register_callback("batcher_queue_depth", "gauge", "Requests waiting for the micro-batcher",
+                          lambda: batcher.stats()["queue_depth_now"])
+metrics.register_callback("prediction_cache_entries", "gauge", "Cached classification results",
+                          lambda: prediction_cache.stats()["size"])
+metrics.register_callback("prediction_cache_lookups_total", "counter", "Prediction cache lookups by result",
+                          lambda: {(result,): prediction_cache.stats()[result] for result in ("hits", "near_duplicate_hits", "misses")},
+                          labels=("result",))
+metrics.register_callback("prediction_cache_evictions_total", "counter", "Entries evicted from the prediction cache",
+                          lambda: prediction_cache.stats()["evictions"])
+metrics.register_callback("startup_phase_seconds", "gauge", "Duration of the startup phases (imports, loads)",
+                          lambda: {(phase,): seconds for phase, seconds in startup.phases.items()}, labels=("phase",))
+metrics.register_callback("model_info", "gauge", "Version of the active model (1 for the active version)",
+                          lambda: {(model_registry.version,): 1} if model_registry.version else {}, labels=("version",))
+metrics.register_callback("model_reloads_total", "counter", "Model reloads by result",
+                          lambda: {("success",): model_registry.reloads, ("failure",): model_registry.failures}, labels=("result",))
+metrics.register_callback("startup_ready", "gauge", "1 when the model is loaded",
+                          lambda: int(engine_resource.ready))
+
+# liveness (/healthz) and readiness (/ready: 503 until the model is loaded)
+register_health_routes(app, startup, [engine_resource])
+
+
+@app.errorhandler(NotReady)
+def not_ready(err):
+    response = jsonify(error=str(err))
+    response.status_code = 503
+    response.headers["Retry-After"] = "1"
+    return(response)
 
-    # encode plotly graphs in JSON
-    graphJSON = json.dumps(graphs, cls=plotly.utils.PlotlyJSONEncoder)
 
-    # render web page with plotly graphs
-    ids = ["graph-{}".format(i) for i, _ in enumerate(graphs)]
-    return render_template('master.html', ids=ids, graphJSON=graphJSON)
+def render(template, **context):
+    """ render a template, timed as the "render" stage """
+    with metrics.stage("render"):
+        return(render_template(template, **context))
+
+
+# index webpage displays cool visuals and receives user input text for model
+@app.route('/')
+@app.route('/index')
+def index():
+    dashboard = dashboard_cache.get()
+
+    # render web page with plotly graphs (304 Not Modified when the browser/CDN copy is still valid)
+    return dashboard_response(request, dashboard,
+        lambda: render('master.html', ids=dashboard.ids, graphJSON=dashboard.graph_json))
 
 
 # web page that handles user query and displays model results
@@ -131,34 +323,73 @@ def index():
 def go():
     # save user input in query
     query = request.args.get('query', '') 
-    # Transform the message length
-    # mess_length = stats.percentileofscore(df["message_length"],len(query))  Remove as not running on Heroku
-    mess_length = 0.2 # Replace with constant (short sentence)
-    # Check for availability of Question and Exclamation mark
-    if '\?' in query:
-        question_mark = 1
-    else:
-        question_mark = 0
-
-    if '\!' in query:
-        exclamation_mark = 1
-    else:
-        exclamation_mark = 0 
-
-    # Create dataframe to serve as input to the ML model
-    X_query = pd.DataFrame(data = [[query,"direct",mess_length,question_mark,exclamation_mark]], columns=["message","genre","len","question_mark","exclamation_mark"])
-
-    # use model to predict classification for query
-    classification_labels = model.predict(X_query)[0]
-    # classification_labels = model.predict(query)
-    classification_results = dict(zip(df.columns[4:], classification_labels))
+    # use model to predict classification for query (coalesced with concurrent requests)
+    classification_labels, engine = batcher.predict((query, "direct"))
+    classification_results = dict(zip(engine.category_names, classification_labels))
 
     # This will render the go.html 
-    return render_template(
+    response = make_response(render(
         'go.html',
         query=query,
         classification_result=classification_results
-    )
+    ))
+    response.headers[MODEL_VERSION_HEADER] = engine.version
+    return response
+
+
+# batch API: classify many messages with one vectorized prediction
+@app.route('/api/classify', methods=['POST'])
+def classify():
+    try:
+        messages, genres = parse_batch(request)
+    except ValueError as err:
+        return jsonify(error=str(err)), 400
+
+    max_batch_size = app.config["MAX_BATCH_SIZE"]
+    if len(messages) > max_batch_size:
+        return jsonify(error="batch of {} messages exceeds the maximum of {}".format(len(messages), max_batch_size)), 413
+
+    start = time.perf_counter()
+    if messages:
+        labels, probabilities, engine = classify_messages(messages, genres)
+    else:
+        engine = get_engine()
+        labels = probabilities = np.zeros((0, len(engine.category_names)))
+    elapsed = time.perf_counter() - start
+
+    response = jsonify(batch_response(messages, genres, labels, probabilities, engine.category_names, elapsed, engine.version))
+    response.headers[MODEL_VERSION_HEADER] = engine.version
+    return response
+
+
+# micro-batcher configuration, queue depth and batch size histograms (to tune latency versus throughput)
+@app.route('/api/batcher')
+def batcher_stats():
+    return jsonify(batcher.stats())
+
+
+# active model version, reload counters and last reload error
+@app.route('/api/model')
+def model_stats():
+    return jsonify(model_registry.stats())
+
+
+# prediction cache size, hit/miss/eviction counters
+@app.route('/api/cache')
+def cache_stats():
+    return jsonify(prediction_cache.stats())
+
+
+# resident memory of this worker (RssFile: memory-mapped pages shared with the other workers)
+@app.route('/api/memory')
+def memory():
+    # the copy of the training data is reported when it is loaded, not loaded here: it would inflate the measured memory
+    usage = dict(pid=os.getpid(), frame_state=frame_resource.state)
+    if frame_resource.ready:
+        frame = frame_resource.value
+        usage.update(frame_version=frame.version, frame_bytes=int(frame.categories.memory_usage(index=False).sum()
+            + frame.genre.memory_usage(index=False) + frame.message_length.memory_usage(index=False)))
+    return jsonify(**usage, **memory_usage())
 
 
 def main():
@@ -0,0 +1,181 @@
+""" startup:
+
+    Fast cold start of the web applications: the heavy resources (e.g. the model) are loaded when the
+    application module is imported (eager), in a background thread (background) or on first use (lazy),
+    while liveness (/healthz) and readiness (/ready) endpoints answer from the first request on.
+    Import and load times are recorded per phase and reported on /ready and /metrics.
+
+Attributes:
+    STARTUP_MODES: "eager", "background" or "lazy"
+    Resource: value loaded once (eagerly, in a background thread or on first use) with its state and load time
+    StartupTimer: duration of the startup phases and time from process start to the first response
+    NotReady: raised when a resource is not loaded (yet)
+    register_health_routes: /healthz and /ready on a Flask application
+    process_uptime: seconds since the process started
+"""
+import os
+import time
+import threading
+from contextlib import contextmanager
+
+from flask import jsonify
+
+STARTUP_MODES = ("eager", "background", "lazy")
+
+
+def process_uptime():
+    """ Returns: seconds since the start of the process (from /proc, None where it is not available) """
+    try:
+        with open("/proc/self/stat") as f:
+            # fields after the command name: starttime (field 22) in clock ticks since boot
+            start_ticks = int(f.read().rpartition(")")[2].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return(None)
+    return(max(0.0, uptime - start_ticks / os.sysconf("SC_CLK_TCK")))
+
+
+class NotReady(Exception):
+    """ a resource is still loading or failed to load """
+
+
+class StartupTimer:
+    """ record the duration of the startup phases (imports, loads) and the time to the first response
+    Create it first thing in the application module: phase "before_import" is the age of the process at that point
+    (interpreter startup, server imports).
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        uptime = process_uptime()
+        self.phases = {"before_import": uptime} if uptime is not None else {}
+        self.first_response = None
+
+    def elapsed(self):
+        """ Returns: seconds since the process started (since the timer was created when unknown) """
+        return(self.phases.get("before_import", 0.0) + time.perf_counter() - self.started)
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = time.perf_counter() - start
+
+    def mark(self, name):
+        """ record the time since the timer was created as phase name (e.g. "imports" at the end of the imports) """
+        self.phases[name] = time.perf_counter() - self.started
+
+    def record_response(self):
+        if self.first_response is None:
+            self.first_response = self.elapsed()
+
+    def report(self):
+        return({
+            "phases_sec": {name: round(seconds, 4) for name, seconds in self.phases.items()},
+            "first_response_sec": round(self.first_response, 4) if self.first_response is not None else None,
+            "uptime_sec": round(self.elapsed(), 3),
+        })
+
+
+class Resource:
+    """ value that is loaded once
+    Input: name, function without arguments that returns the value, StartupTimer (records "load_<name>")
+    """
+
+    def __init__(self, name, loader, timer=None):
+        self.name = name
+        self.loader = loader
+        self.timer = timer
+        self.state = "pending"
+        self.value = None
+        self.error = None
+        self.load_time = None
+        self._exception = None
+        self._lock = threading.Lock()
+        self._loaded = threading.Event()
+
+    @property
+    def ready(self):
+        return(self.state == "ready")
+
+    def start(self, background=True):
+        """ start loading (once): in a background thread or in the calling thread """
+        with self._lock:
+            if self.state != "pending":
+                return(self)
+            self.state = "loading"
+        if background:
+            threading.Thread(target=self._load, name="load-" + self.name, daemon=True).start()
+        else:
+            self._load()
+        return(self)
+
+    def _load(self):
+        start = time.perf_counter()
+        try:
+            self.value = self.loader()
+            self.state = "ready"
+        except Exception as err:
+            self._exception = err
+            self.error = "{}: {}".format(type(err).__name__, err)
+            self.state = "failed"
+        finally:
+            self.load_time = time.perf_counter() - start
+            if self.timer is not None:
+                self.timer.phases["load_" + self.name] = self.load_time
+            self._loaded.set()
+
+    def get(self, timeout=None):
+        """ Returns: the loaded value (loaded in the calling thread when loading has not started)
+        Raises: NotReady when still loading after timeout seconds or when loading failed
+        """
+        self.start(background=False)
+        if not self._loaded.wait(timeout):
+            raise NotReady("{} is still loading".format(self.name))
+        if self.state == "failed":
+            raise NotReady("{} failed to load: {}".format(self.name, self.error)) from self._exception
+        return(self.value)
+
+    def replace(self, value):
+        """ swap in a new value (e.g. a reloaded model): callers that got the previous value keep using it """
+        self.value = value
+        self.state = "ready"
+        self._loaded.set()
+
+    def status(self):
+        return({"state": self.state, "load_sec": round(self.load_time, 4) if self.load_time is not None else None,
+                "error": self.error})
+
+
+def register_health_routes(app, timer, resources=()):
+    """ add /healthz (liveness: the process answers) and /ready (readiness: every resource loaded, 503 before)
+    to a Flask application; /ready starts loading the resources that have not started (lazy mode)
+    Input: Flask application, StartupTimer, list of Resources
+    """
+
+    @app.after_request
+    def record_first_response(response):
+        timer.record_response()
+        return(response)
+
+    @app.route("/healthz")
+    def healthz():
+        return(jsonify(status="ok"))
+
+    @app.route("/ready")
+    def ready():
+        for resource in resources:
+            resource.start()
+        is_ready = all(resource.ready for resource in resources)
+        failed = any(resource.state == "failed" for resource in resources)
+        response = jsonify(status="ready" if is_ready else "failed" if failed else "loading",
+                           resources={resource.name: resource.status() for resource in resources}, startup=timer.report())
+        if not is_ready:
+            response.status_code = 503
+            response.headers["Retry-After"] = "1"
+        return(response)
+
+    return
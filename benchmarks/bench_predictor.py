@@ -0,0 +1,82 @@
+""" bench_predictor
+
+    Compares the latency of the pickled pipeline (MultiOutputClassifier: one LogisticRegression per category)
+    with the fused predictor (models/predictor.py: all coefficients stacked into one matrix) for batches of
+    1, 100 and 10000 messages, and checks that both produce the same probabilities and labels.
+
+    to run: python benchmarks/bench_predictor.py data/DisasterResponse.db models/DisasterResponse.pkl [repeats]
+
+Attributes:
+    name of database that includes the DisasterMessages table, pickle file created by train_classifier.py,
+    optional number of timed runs per batch size (default 5, the best run is reported)
+
+Output:
+    latency (ms) per batch size, end to end (tokenization + features + scoring) and scoring only
+    (classifier step on the already computed features), speedup and maximum probability difference
+"""
+
+import os
+import sys
+import time
+
+import joblib
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "models"))
+# models pickled by train_classifier.py as a script refer to __main__.tokenize
+from tokenizer import tokenize
+from predictor import Predictor, compare_with_pipeline
+from train_classifier import load_data
+
+BATCH_SIZES = (1, 100, 10000)
+
+
+def best_time(fn, repeats):
+    """ Returns: shortest elapsed seconds of repeats calls of fn """
+    elapsed = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        elapsed.append(time.perf_counter() - start)
+    return(min(elapsed))
+
+
+def main():
+    if len(sys.argv) not in (3, 4):
+        print('Please provide the filepath of the disaster messages database as the first argument, '\
+              'the filepath of the pickled model as the second argument and optionally the number of '\
+              'timed runs as the third argument. \n\nExample: python benchmarks/bench_predictor.py '\
+              'data/DisasterResponse.db models/DisasterResponse.pkl 5')
+        return
+
+    X, _, _, _ = load_data(sys.argv[1])
+    model = joblib.load(sys.argv[2])
+    repeats = int(sys.argv[3]) if len(sys.argv) == 4 else 5
+    pipeline = getattr(model, "best_estimator_", model)
+    clmn, mo = pipeline.named_steps["clmn"], pipeline.named_steps["mo"]
+
+    start = time.perf_counter()
+    predictor = Predictor.from_pipeline(model)
+    print('Fused {} categories x {} features in {:.1f} ms'.format(
+        predictor.coef.shape[1], predictor.n_features, (time.perf_counter() - start) * 1000))
+
+    print('{:>8}{:>16}{:>16}{:>9}{:>16}{:>16}{:>9}{:>12}'.format(
+        'batch', 'pipeline ms', 'fused ms', 'speedup', 'scoring ms', 'fused scoring', 'speedup', 'max diff'))
+    for batch_size in BATCH_SIZES:
+        # repeat the corpus when it has fewer messages than the batch
+        batch = X.iloc[np.arange(batch_size) % len(X)]
+        max_diff, n_label_diff = compare_with_pipeline(predictor, model, batch)
+        assert n_label_diff == 0, "fused predictor and pipeline disagree on {} labels".format(n_label_diff)
+
+        features = clmn.transform(batch)
+        elapsed_pipeline = best_time(lambda: model.predict_proba(batch), repeats)
+        elapsed_fused = best_time(lambda: predictor.predict_proba(batch), repeats)
+        elapsed_scoring = best_time(lambda: mo.predict_proba(features), repeats)
+        elapsed_fused_scoring = best_time(lambda: predictor.predict_proba(batch, features), repeats)
+        print('{:>8}{:>16.2f}{:>16.2f}{:>8.1f}x{:>16.3f}{:>16.3f}{:>8.1f}x{:>12.1e}'.format(
+            batch_size, elapsed_pipeline * 1000, elapsed_fused * 1000, elapsed_pipeline / elapsed_fused,
+            elapsed_scoring * 1000, elapsed_fused_scoring * 1000, elapsed_scoring / elapsed_fused_scoring, max_diff))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+""" bench_tokenizer
+
+    Compares the throughput (documents/sec) of the shared tokenizer (models/tokenizer.py)
+    against the original per-call implementation on the DisasterMessages corpus.
+
+    to run: python benchmarks/bench_tokenizer.py data/DisasterResponse.db [number of messages]
+
+Attributes:
+    name of database that includes the DisasterMessages table, optional limit on the number of messages
+
+Output:
+    docs/sec for the original tokenize, the cached tokenize and tokenize_batch + lemma cache statistics
+"""
+
+import os
+import sys
+import time
+import string
+import sqlite3
+
+import nltk
+from nltk.corpus import stopwords
+from nltk.stem import WordNetLemmatizer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "models"))
+import tokenizer
+
+
+def tokenize_original(text):
+    """ tokenizer as originally implemented: rebuilds the stopword set and the lemmatizer on every call """
+    stop = set(stopwords.words('english') + list(string.punctuation))
+    nltk_tokens = nltk.word_tokenize(text.lower())
+    tokens = [w for w in nltk_tokens if not w in stop]
+    lemmatizer = WordNetLemmatizer()
+    tokens = [lemmatizer.lemmatize(w) for w in tokens]
+    return(tokens)
+
+
+def load_messages(database_filepath, limit=None):
+    """ Returns: list of messages from the DisasterMessages table """
+    connection = sqlite3.connect(database_filepath)
+    query = "SELECT message FROM DisasterMessages"
+    if limit:
+        query += " LIMIT {:d}".format(limit)
+    messages = [row[0] for row in connection.execute(query)]
+    connection.close()
+    return(messages)
+
+
+def time_docs(fn, messages):
+    """ Returns: result of fn(messages), elapsed seconds """
+    start = time.perf_counter()
+    result = fn(messages)
+    return(result, time.perf_counter() - start)
+
+
+def main():
+    if len(sys.argv) not in (2, 3):
+        print('Please provide the filepath of the disaster messages database as the first argument '\
+              'and optionally the number of messages as the second argument. \n\nExample: python '\
+              'benchmarks/bench_tokenizer.py data/DisasterResponse.db 5000')
+        return
+
+    messages = load_messages(sys.argv[1], int(sys.argv[2]) if len(sys.argv) == 3 else None)
+    print('Benchmarking {} messages'.format(len(messages)))
+
+    # warm up the NLTK corpora so that their one-off load time is not attributed to either implementation
+    tokenize_original(messages[0])
+
+    expected, elapsed_original = time_docs(lambda docs: [tokenize_original(m) for m in docs], messages)
+    cold, elapsed_cold = time_docs(lambda docs: [tokenizer.tokenize(m) for m in docs], messages)
+    warm, elapsed_warm = time_docs(lambda docs: [tokenizer.tokenize(m) for m in docs], messages)
+    batch, elapsed_batch = time_docs(tokenizer.tokenize_batch, messages)
+
+    assert cold == expected and warm == expected and batch == expected, "tokenizers produce different tokens"
+
+    n = len(messages)
+    print('{:<32}{:>12}{:>10}'.format('implementation', 'docs/sec', 'speedup'))
+    for name, elapsed in (('original tokenize', elapsed_original),
+                          ('tokenize (cold lemma cache)', elapsed_cold),
+                          ('tokenize (warm lemma cache)', elapsed_warm),
+                          ('tokenize_batch', elapsed_batch)):
+        print('{:<32}{:>12.0f}{:>9.1f}x'.format(name, n / elapsed, elapsed_original / elapsed))
+    print('lemma cache: {}'.format(tokenizer.cache_info()))
+
+
+if __name__ == '__main__':
+    main()
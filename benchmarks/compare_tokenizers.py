@@ -0,0 +1,115 @@
+""" compare_tokenizers
+
+    Compares the tokenizer backends of models/tokenizer.py on the DisasterMessages corpus:
+    - throughput (docs/sec) of the NLTK backend (tokenize_batch, cold lemma cache) and of the regex backend
+      (RegexTokenizer.tokenize_series, per document call), + the time to build the lemma table
+    - quality: the model of train_classifier.py is trained on the same train/test split (train_classifier.split_data,
+      default: the held-out messages, as train_classifier.py --split holdout) with the tokens of every backend and evaluated with evaluate_model (same report as training), followed by the f1-score per category
+      of both backends side by side
+
+    to run: python benchmarks/compare_tokenizers.py data/DisasterResponse.db
+            python benchmarks/compare_tokenizers.py data/DisasterResponse.db --messages 10000 --n-jobs -1 --output f1.csv
+
+Attributes:
+    name of database that includes the DisasterMessages table
+    --messages: limit on the number of messages (default: all)
+    --n-jobs: worker processes for the grid search (default 1, -1: all cores)
+    --split: "holdout" (default, test set: id divisible by 5) or "random" (as train_classifier.py --split)
+    --output: CSV file for the per-category comparison
+
+Output:
+    docs/sec and speedup per backend, classification report per backend, f1-score per category (nltk, regex, difference)
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "models"))
+import tokenizer
+import train_classifier
+
+
+def time_docs(fn, texts):
+    """ Returns: result of fn(texts), elapsed seconds """
+    start = time.perf_counter()
+    result = fn(texts)
+    return(result, time.perf_counter() - start)
+
+
+def tokenized(X, tokens):
+    """ Returns: copy of X with the space separated tokens in the "message" column """
+    X = X.copy()
+    X["message"] = [" ".join(doc_tokens) for doc_tokens in tokens]
+    return(X)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Compare the NLTK and regex tokenizer backends (speed and category f1).')
+    parser.add_argument('database_filepath', help='filepath of the disaster messages database')
+    parser.add_argument('--messages', type=int, default=None, help='limit on the number of messages')
+    parser.add_argument('--n-jobs', type=int, default=None, help='worker processes for the grid search (-1: all cores)')
+    parser.add_argument('--split', choices=train_classifier.SPLITS, default='holdout',
+                        help='test set: held-out messages (id divisible by 5) or drawn at random, as train_classifier.py')
+    parser.add_argument('--output', default=None, help='CSV file for the f1-score per category of both backends')
+    return(parser.parse_args(argv))
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+    X, Y, category_names, _ = train_classifier.load_data(args.database_filepath)
+    if args.messages:
+        X, Y = X.iloc[:args.messages], Y[:args.messages]
+    X_train, X_test, Y_train, Y_test = train_classifier.split_data(X, Y, args.split)
+
+    # the tokenizers receive the text as the vectorizer passes it
+    preprocess = train_classifier.vectorizer_preprocessor()
+    texts_train = [preprocess(m) for m in X_train["message"]]
+    texts_test = [preprocess(m) for m in X_test["message"]]
+    texts = texts_train + texts_test
+    print('Tokenizing {} messages ({} train, {} test)'.format(len(texts), len(texts_train), len(texts_test)))
+
+    # lemma table of the training vocabulary (needs WordNet, like the NLTK backend)
+    lemmas, elapsed_table = time_docs(tokenizer.build_lemma_table, texts_train)
+    regex_tokenizer = tokenizer.RegexTokenizer(lemmas)
+    print('    lemma table: {} entries built in {:.1f}s'.format(len(lemmas), elapsed_table))
+
+    tokenizer.lemmatize.cache_clear()
+    nltk_tokens, elapsed_nltk = time_docs(tokenizer.tokenize_batch, texts)
+    regex_tokens, elapsed_regex = time_docs(regex_tokenizer.tokenize_series, texts)
+    _, elapsed_regex_call = time_docs(lambda docs: [regex_tokenizer(doc) for doc in docs], texts)
+
+    n = len(texts)
+    print('{:<40}{:>12}{:>10}'.format('backend', 'docs/sec', 'speedup'))
+    for name, elapsed in (('nltk tokenize_batch (cold lemma cache)', elapsed_nltk),
+                          ('regex tokenize_series', elapsed_regex),
+                          ('regex per document', elapsed_regex_call)):
+        print('{:<40}{:>12.0f}{:>9.1f}x'.format(name, n / elapsed, elapsed_nltk / elapsed))
+    identical = sum(a == b for a, b in zip(nltk_tokens, regex_tokens))
+    print('    identical token lists: {} of {} messages'.format(identical, n))
+
+    reports = {}
+    for backend, tokens in (('nltk', nltk_tokens), ('regex', regex_tokens)):
+        print('\nTraining and evaluating the model with the {} tokens...'.format(backend))
+        X_train_tokens, X_test_tokens = tokenized(X_train, tokens[:len(texts_train)]), tokenized(X_test, tokens[len(texts_train):])
+        model = train_classifier.build_model(n_jobs=args.n_jobs, tokenizer=tokenizer.split_tokens)
+        with train_classifier.timed('grid search (including refit)'):
+            model.fit(X_train_tokens, Y_train)
+        reports[backend] = train_classifier.evaluate_model(model, X_test_tokens, Y_test, category_names)
+
+    comparison = pd.DataFrame({'nltk': reports['nltk']['f1-score'], 'regex': reports['regex']['f1-score']})
+    comparison['difference'] = comparison['regex'] - comparison['nltk']
+    print('\nf1-score per category (weighted average)')
+    print(comparison.round(4).to_string())
+    print('mean f1-score: nltk {:.4f}, regex {:.4f}'.format(comparison['nltk'].mean(), comparison['regex'].mean()))
+    print('tokenizer speedup (regex tokenize_series versus nltk): {:.1f}x'.format(elapsed_nltk / elapsed_regex))
+    if args.output:
+        comparison.to_csv(args.output, index_label='category')
+        print('Comparison saved to {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
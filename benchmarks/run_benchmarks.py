@@ -0,0 +1,298 @@
+""" run_benchmarks
+
+    Benchmark suite for the ETL, training and serving stages on a synthetic corpus with the schema of the
+    disaster messages / categories files (works offline, without the real CSVs):
+    - etl: process_data.load_data, clean_data and save_data (rows/sec)
+    - etl_chunked: process_data.process_chunked on the same files (both sorted by id, chunks ending on the same ids),
+      checked to save the same rows as the etl stage
+    - tokenize: tokenize throughput with a cold and a warm lemma cache, tokenize_batch (docs/sec)
+    - tfidf: TfidfVectorizer fit as configured in train_classifier.build_model
+    - grid_search: fit and score time per GridSearchCV candidate + the total fit (including refit)
+    - serving: latency of /go and of /api/classify batches through the Flask test client (app/run.py)
+    Results are written to a JSON file (with the git commit and library versions) to track regressions.
+
+    to run: python benchmarks/run_benchmarks.py --messages 5000 --output benchmarks/results.json
+
+Attributes:
+    --messages: number of synthetic messages (default 5000)
+    --requests: number of timed requests per serving benchmark (default 50)
+    --seed: seed of the synthetic corpus (default 0)
+    --output: JSON file for the results (default: printed only)
+    --keep: directory to keep the synthetic corpus, database and model in (default: temporary directory)
+
+Output:
+    JSON document with one entry per stage
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import random
+import platform
+import tempfile
+import argparse
+import datetime
+import subprocess
+
+import numpy as np
+import pandas as pd
+import sklearn
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "models"))
+sys.path.insert(0, os.path.join(ROOT, "data"))
+import tokenizer
+import process_data
+import train_classifier
+
+CATEGORIES = ["related", "request", "offer", "aid_related", "medical_help", "medical_products", "search_and_rescue",
+              "security", "military", "child_alone", "water", "food", "shelter", "clothing", "money", "missing_people",
+              "refugees", "death", "other_aid", "infrastructure_related", "transport", "buildings", "electricity",
+              "tools", "hospitals", "shops", "aid_centers", "other_infrastructure", "weather_related", "floods",
+              "storm", "fire", "earthquake", "cold", "other_weather", "direct_report"]
+GENRES = ["direct", "news", "social"]
+# words that make a category likely (the other categories are set at random)
+TOPICS = {
+    "water": ["water", "drink", "thirsty", "wells"], "food": ["food", "hungry", "rice", "eat"],
+    "shelter": ["tent", "shelter", "homeless", "roof"], "medical_help": ["doctor", "injured", "medicine", "sick"],
+    "floods": ["flood", "flooded", "river", "rain"], "storm": ["storm", "hurricane", "wind", "cyclone"],
+    "earthquake": ["earthquake", "aftershock", "collapsed", "rubble"], "fire": ["fire", "burning", "smoke"],
+    "death": ["dead", "died", "bodies", "killed"], "transport": ["road", "bridge", "truck", "blocked"],
+}
+FILLER = ("we need help please the people in our village are waiting for news from the government since "
+          "yesterday there is no electricity and the children are afraid send information about the situation "
+          "in the city hospital school church market port airport camp").split()
+
+
+def git_commit():
+    """ Returns: commit hash of the working tree (None outside of a git checkout) """
+    try:
+        return(subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT, stderr=subprocess.DEVNULL).decode().strip())
+    except (OSError, subprocess.CalledProcessError):
+        return(None)
+
+
+def timer(fn, *args, **kwargs):
+    """ Returns: result of fn(*args, **kwargs), elapsed seconds """
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return(result, time.perf_counter() - start)
+
+
+def latency_summary(elapsed):
+    """ Returns: dict with the mean / p50 / p95 / max latency in ms of a list of durations in seconds """
+    ms = np.array(elapsed) * 1000
+    return({"n": len(ms), "mean_ms": round(float(ms.mean()), 3), "p50_ms": round(float(np.percentile(ms, 50)), 3),
+            "p95_ms": round(float(np.percentile(ms, 95)), 3), "max_ms": round(float(ms.max()), 3)})
+
+
+def synthetic_corpus(directory, n_messages, seed=0):
+    """ write messages.csv and categories.csv with the schema of the disaster response files
+    (~1% of the rows are duplicated, as in the original files)
+    Returns: filepaths of the messages and categories files
+    """
+    rng = random.Random(seed)
+    topics = list(TOPICS)
+    messages, categories = [], []
+    for i in range(n_messages):
+        message_id = 2 + i * 3
+        message_topics = rng.sample(topics, rng.choice([0, 1, 1, 2]))
+        words = [rng.choice(FILLER) for _ in range(rng.randint(3, 40))]
+        words += [rng.choice(TOPICS[t]) for t in message_topics for _ in range(rng.randint(1, 3))]
+        rng.shuffle(words)
+        text = " ".join(words).capitalize() + rng.choice([".", ".", "!", "?", ""])
+        values = {c: int(rng.random() < 0.05) for c in CATEGORIES}
+        values.update({t: 1 for t in message_topics})
+        values["child_alone"] = 0
+        values["aid_related"] = int(bool(message_topics) or values["aid_related"])
+        values["related"] = 1 if message_topics else rng.choice([0, 1, 2])
+        messages.append((message_id, text, text.upper(), rng.choice(GENRES)))
+        categories.append((message_id, ";".join("{}-{}".format(c, values[c]) for c in CATEGORIES)))
+        if rng.random() < 0.01:
+            messages.append(messages[-1])
+            categories.append(categories[-1])
+
+    messages_filepath = os.path.join(directory, "disaster_messages.csv")
+    categories_filepath = os.path.join(directory, "disaster_categories.csv")
+    pd.DataFrame(messages, columns=["id", "message", "original", "genre"]).to_csv(messages_filepath, index=False)
+    pd.DataFrame(categories, columns=["id", "categories"]).to_csv(categories_filepath, index=False)
+    return(messages_filepath, categories_filepath)
+
+
+def bench_etl(messages_filepath, categories_filepath, database_filepath):
+    df, load_time = timer(process_data.load_data, messages_filepath, categories_filepath)
+    df, clean_time = timer(process_data.clean_data, df)
+    _, save_time = timer(process_data.save_data, df, database_filepath)
+    n = len(df)
+    return({"rows": n,
+            "load_data_sec": round(load_time, 4), "clean_data_sec": round(clean_time, 4), "save_data_sec": round(save_time, 4),
+            "rows_per_sec": round(n / (load_time + clean_time + save_time), 1)})
+
+
+def bench_etl_chunked(messages_filepath, categories_filepath, database_filepath, chunksize):
+    """ stream the files through process_data.process_chunked into a separate database and check that it saves
+    the same messages as the etl stage (database_filepath: database of the etl stage)
+    """
+    chunked_filepath = database_filepath + ".chunked"
+    (n_rows, _, save_time), elapsed = timer(process_data.process_chunked, messages_filepath, categories_filepath,
+                                            chunked_filepath, chunksize)
+    query = 'SELECT * FROM "{}" ORDER BY id'.format(process_data.TABLE)
+    with sqlite3.connect(database_filepath) as full, sqlite3.connect(chunked_filepath) as chunked:
+        expected, saved = pd.read_sql(query, full), pd.read_sql(query, chunked)
+    if not expected.equals(saved):
+        raise AssertionError("process_chunked saved {} rows, load_data + clean_data {}".format(len(saved), len(expected)))
+    return({"rows": n_rows, "chunksize": chunksize, "total_sec": round(elapsed, 4), "save_data_sec": round(save_time, 4),
+            "rows_per_sec": round(n_rows / elapsed, 1)})
+
+
+def select_tokenizer(messages):
+    """ Returns: tokenize function to use for the training benchmarks + name
+    (NLTK tokenize when its corpora are installed, whitespace split tokens otherwise)
+    """
+    try:
+        tokenizer.tokenize(messages[0])
+        return(tokenizer.tokenize, "tokenize")
+    except LookupError:
+        return(tokenizer.split_tokens, "split_tokens (NLTK data not installed)")
+
+
+def bench_tokenize(messages):
+    try:
+        tokenizer.tokenize(messages[0])
+    except LookupError:
+        return({"skipped": "NLTK data not installed"})
+    tokenizer.lemmatize.cache_clear()
+    _, cold = timer(lambda: [tokenizer.tokenize(m) for m in messages])
+    _, warm = timer(lambda: [tokenizer.tokenize(m) for m in messages])
+    _, batch = timer(tokenizer.tokenize_batch, messages)
+    n = len(messages)
+    return({"docs": n, "cold_docs_per_sec": round(n / cold, 1), "warm_docs_per_sec": round(n / warm, 1),
+            "batch_docs_per_sec": round(n / batch, 1)})
+
+
+def bench_tfidf(messages, tokenize_fn):
+    vectorizer = TfidfVectorizer(tokenizer=tokenize_fn, strip_accents="unicode", sublinear_tf=True)
+    _, elapsed = timer(vectorizer.fit, messages)
+    return({"docs": len(messages), "fit_sec": round(elapsed, 4), "docs_per_sec": round(len(messages) / elapsed, 1),
+            "vocabulary": len(vectorizer.vocabulary_)})
+
+
+def bench_grid_search(database_filepath, tokenize_fn, model_filepath):
+    """ fit the model of train_classifier.build_model and save it for the serving benchmarks """
+    X, Y, category_names, length_quantiles = train_classifier.load_data(database_filepath)
+    model = train_classifier.build_model(tokenizer=tokenize_fn)
+    _, elapsed = timer(model.fit, X, Y)
+    model.category_names_ = category_names
+    model.length_quantiles_ = length_quantiles
+    train_classifier.save_model(model, model_filepath)
+
+    results = model.cv_results_
+    candidates = [{
+        "params": {k: (v.item() if hasattr(v, "item") else v) for k, v in params.items()},
+        "mean_fit_sec": round(float(fit_time), 4),
+        "mean_score_sec": round(float(score_time), 4),
+        "mean_test_score": round(float(score), 4)}
+        for params, fit_time, score_time, score in zip(results["params"], results["mean_fit_time"],
+                                                       results["mean_score_time"], results["mean_test_score"])]
+    return({"messages": len(X), "categories": len(category_names), "total_fit_sec": round(elapsed, 3),
+            "refit_sec": round(float(getattr(model, "refit_time_", 0.0)), 4), "candidates": candidates})
+
+
+def bench_serving(database_filepath, model_filepath, messages, n_requests):
+    """ latency of /go and /api/classify through the Flask test client of app/run.py """
+    os.environ["DATABASE_FILEPATH"] = database_filepath
+    os.environ["MODEL_FILEPATH"] = model_filepath
+    # measure the model, not the cache of repeated messages
+    os.environ["PREDICTION_CACHE_SIZE"] = "0"
+    # sequential requests: the coalescing window of the micro-batcher would only add its wait to every /go
+    os.environ["COALESCE_WINDOW_MS"] = "0"
+    sys.path.insert(0, os.path.join(ROOT, "app"))
+    _, import_time = timer(__import__, "run")
+    run = sys.modules["run"]
+    client = run.app.test_client()
+
+    def go(query):
+        response = client.get("/go", query_string={"query": query})
+        assert response.status_code == 200, response.status_code
+
+    def classify(batch):
+        response = client.post("/api/classify", json=batch)
+        assert response.status_code == 200, response.status_code
+
+    go(messages[0]) # warm up
+    results = {"app_import_sec": round(import_time, 3), "startup_phases_sec": run.startup.report()["phases_sec"],
+               "model": "fused" if type(run.get_engine().model).__name__ == "Predictor" else "pipeline",
+               "coalesce_window_ms": run.batcher.stats()["window_ms"]}
+    results["go"] = latency_summary([timer(go, messages[i % len(messages)])[1] for i in range(n_requests)])
+    for batch_size in (1, 100, 1000):
+        elapsed = []
+        for i in range(max(1, n_requests // 10) if batch_size > 100 else n_requests):
+            batch = [messages[(i * batch_size + j) % len(messages)] for j in range(batch_size)]
+            elapsed.append(timer(classify, batch)[1])
+        summary = latency_summary(elapsed)
+        summary["messages_per_sec"] = round(batch_size * 1000 / summary["mean_ms"], 1)
+        results["classify_batch_{}".format(batch_size)] = summary
+    return(results)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the ETL, training and serving stages on a synthetic corpus.',
+                                     epilog='Example: python benchmarks/run_benchmarks.py --messages 5000 --output results.json')
+    parser.add_argument('--messages', type=int, default=5000, help='number of synthetic messages')
+    parser.add_argument('--requests', type=int, default=50, help='number of timed requests per serving benchmark')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic corpus')
+    parser.add_argument('--output', default=None, help='JSON file to write the results to')
+    parser.add_argument('--keep', default=None, help='directory to keep the corpus, database and model in')
+    return(parser.parse_args(argv))
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+    directory = args.keep or tempfile.mkdtemp(prefix="disaster_bench_")
+    os.makedirs(directory, exist_ok=True)
+    database_filepath = os.path.join(directory, "DisasterResponse.db")
+    model_filepath = os.path.join(directory, "DisasterResponse.pkl")
+
+    report = {
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "versions": {"numpy": np.__version__, "pandas": pd.__version__, "sklearn": sklearn.__version__},
+        "config": {"messages": args.messages, "requests": args.requests, "seed": args.seed},
+        "results": {},
+    }
+    results = report["results"]
+    try:
+        print('Generating {} synthetic messages...\n    DIRECTORY: {}'.format(args.messages, directory))
+        messages_filepath, categories_filepath = synthetic_corpus(directory, args.messages, args.seed)
+        messages = pd.read_csv(messages_filepath)["message"].tolist()
+        tokenize_fn, tokenizer_name = select_tokenizer(messages)
+        report["config"]["tokenizer"] = tokenizer_name
+
+        for stage, fn in (
+                ("etl", lambda: bench_etl(messages_filepath, categories_filepath, database_filepath)),
+                ("etl_chunked", lambda: bench_etl_chunked(messages_filepath, categories_filepath, database_filepath,
+                                                          max(1, args.messages // 4))),
+                ("tokenize", lambda: bench_tokenize(messages)),
+                ("tfidf", lambda: bench_tfidf(messages, tokenize_fn)),
+                ("grid_search", lambda: bench_grid_search(database_filepath, tokenize_fn, model_filepath)),
+                ("serving", lambda: bench_serving(database_filepath, model_filepath, messages, args.requests))):
+            print('Benchmarking {}...'.format(stage))
+            results[stage] = fn()
+            print('    ' + json.dumps(results[stage]))
+    finally:
+        if args.keep is None:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print('Results saved!\n    OUTPUT: {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
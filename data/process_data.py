@@ -4,9 +4,12 @@
     Reads the datasets, cleans the data, and then stores it in a SQLite database. 
 
     to run: python data/process_data.py data/disaster_messages.csv data/disaster_categories.csv data/DisasterResponse.db
+            python data/process_data.py data/disaster_messages.csv data/disaster_categories.csv data/DisasterResponse.db --chunksize 100000
 
 Attributes:
     message file, categories file, name of database to be created
+    --chunksize: stream both files in chunks of this many rows (files sorted by id) to keep memory bounded
+    --upsert: insert new messages and update changed ones instead of replacing the table
 
 Input:
     disaster_messages.csv (individual text messages)
@@ -17,10 +20,17 @@ Output:
 """
 
 # import libraries
-import sys
+import time
+import sqlite3
+import argparse
 import pandas as pd
 import numpy as np
-from sqlalchemy import create_engine
+
+import summary_tables
+
+TABLE = 'DisasterMessages'
+# categories that are filtered/grouped on by the web applications get an index (next to genre)
+HOT_CATEGORIES = ['related', 'aid_related', 'weather_related', 'direct_report']
 
 #%%
 
@@ -44,35 +54,112 @@ def load_data(messages_filepath, categories_filepath):
     return (df)
 
 
-def clean_data(df):
+def iter_id_chunks(reader, name):
     """ 
-    Split the categories from 1 column into separate columns
-    Remove duplicate rows
-    Ensure binary classification (limited to value 0 and 1): map value 2 to 1 + make type integer
-    input: dataframe
-    output: dataframe
+    deduplicate the chunks of a CSV reader on id, also across chunk boundaries (requires the file to be sorted by id)
+    input: pandas TextFileReader (read_csv with chunksize), name of the file for error messages
+    output: generator of dataframes with strictly increasing ids
+    """ 
+    last_id = None
+    for chunk in reader:
+        ids = chunk["id"]
+        if not ids.is_monotonic_increasing or (last_id is not None and len(ids) and ids.iloc[0] < last_id):
+            raise ValueError("{} is not sorted by id: sort it or run without --chunksize".format(name))
+        chunk = chunk.drop_duplicates(subset="id")
+        if last_id is not None:
+            chunk = chunk[chunk["id"] > last_id] # duplicate of the last id of the previous chunk
+        if len(chunk):
+            last_id = chunk["id"].iloc[-1]
+            yield chunk
+
+
+def load_data_chunked(messages_filepath, categories_filepath, chunksize=100000):
+    """ 
+    stream messages and category datasets in id order and merge them on ID chunk by chunk, removes the original language
+    input: location of both CV files (both sorted by id), number of messages per chunk
+    output: generator of dataframes with merged data (same columns as load_data)
+    """ 
+    messages = iter_id_chunks(pd.read_csv(messages_filepath, chunksize=chunksize), messages_filepath)
+    categories = iter_id_chunks(pd.read_csv(categories_filepath, chunksize=chunksize), categories_filepath)
+    categories_buffer = None
+    categories_exhausted = False
+
+    for messages_chunk in messages:
+        messages_chunk = messages_chunk.drop(columns = "original") # Don't need the original language
+        max_id = messages_chunk["id"].iloc[-1]
+
+        # read categories until all ids up to the last id of the message chunk are available
+        # (the buffer is empty when the previous category chunk ended on the last id of the previous message chunk)
+        while not categories_exhausted and (categories_buffer is None or categories_buffer.empty
+                                            or categories_buffer["id"].iloc[-1] < max_id):
+            try:
+                categories_chunk = next(categories)
+            except StopIteration:
+                categories_exhausted = True
+                break
+            categories_buffer = categories_chunk if categories_buffer is None else pd.concat([categories_buffer, categories_chunk])
+        if categories_buffer is None or (categories_exhausted and categories_buffer.empty):
+            return
+
+        in_chunk = categories_buffer["id"] <= max_id
+        df = pd.merge(messages_chunk, categories_buffer[in_chunk], on="id", how="inner")
+        categories_buffer = categories_buffer[~in_chunk]
+        if len(df):
+            yield df.reset_index(drop=True)
+
+
+def category_names(categories):
+    """ 
+    construct meaningful column names based on a categories string ('related-1;request-0;...' -> related, request, ...)
+    input: categories string
+    output: list of category names
     """ 
-    
-    categories = df['categories'].str.split(';', expand=True)
-    firstrow = categories.head(1).values[0] #retain the first row of the categories to construct column names
-    
     def strip_last_2(s):
         return s[:-2]
 
-    category_colnames = np.array(list(map(strip_last_2, firstrow)))
-    categories.columns = category_colnames
+    return(list(map(strip_last_2, categories.split(';'))))
 
-    categories['related'] = categories['related'].astype('str').str.replace('2', '1') # combine 2 with 1 to ensure binary categorization
 
-    # set each category value to be the last character of the string
-    for column in categories:
-        categories[column] = categories[column].str[-1]
+def parse_categories(categories, category_colnames=None):
+    """ 
+    vectorized parser for the categories column ('related-1;request-0;...') into a compact uint8 matrix
+    input: series with category strings, column names (default: derived from the first row)
+    output: dataframe with one uint8 column per category (same index as the input)
+    """ 
+    if category_colnames is None:
+        category_colnames = category_names(categories.iloc[0])
+    elif category_names(categories.iloc[0]) != list(category_colnames):
+        raise ValueError("categories do not match the expected categories: {}".format(categories.iloc[0]))
+
+    # keep the single digit values only: 'related-1;request-0' -> '1;0'
+    values = categories.str.replace(r'[^;]*-', '', regex=True)
+    width = 2 * len(category_colnames) - 1
+    if len(values) and (values.str.len() != width).any():
+        raise ValueError("every row should contain {} single digit categories".format(len(category_colnames)))
+
+    # all rows have the same layout: view the characters as a (rows x width) byte matrix and keep every other column
+    buffer = np.frombuffer(''.join(values.tolist()).encode('ascii'), dtype=np.uint8)
+    matrix = buffer.reshape(len(values), width)[:, ::2] - np.uint8(ord('0'))
+    if (matrix > 9).any():
+        raise ValueError("category values should be digits")
+
+    return(pd.DataFrame(matrix, columns=category_colnames, index=categories.index))
+
+
+def clean_data(df, category_colnames=None):
+    """ 
+    Split the categories from 1 column into separate columns
+    Remove duplicate rows
+    Ensure binary classification (limited to value 0 and 1): map value 2 to 1 + make type integer
+    input: dataframe, optional category names (when cleaning chunks: the names of the first chunk)
+    output: dataframe
+    """ 
     
-        # convert column from string to numeric
-        categories[column] = categories[column].astype(int)
+    categories = parse_categories(df['categories'], category_colnames)
+    categories['related'] = np.minimum(categories['related'], 1) # combine 2 with 1 to ensure binary categorization
     
     # drop original column "categories" as now split
-    df.drop(columns="categories", inplace=True)
+    df = df.drop(columns="categories")
 
     # Concatenate the split categories with the original dataframe, remove na's, make integer and drop duplicates
     df = pd.concat([df, categories], axis=1)
@@ -83,47 +170,214 @@ def clean_data(df):
     return(df)
 
 
-def save_data(df, database_filename):
+def connect(database_filename):
     """ 
-    saves dataframe to specified SQLite database (table: DisasterMessages)
-    input: dataframe
+    opens the SQLite database tuned for bulk loading: write-ahead log, fewer fsyncs and a larger page cache
+    input: name of the database
+    output: sqlite3 connection
+    """ 
+    connection = sqlite3.connect(database_filename)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    connection.execute('PRAGMA cache_size=-65536') # 64 MB
+    connection.execute('PRAGMA temp_store=MEMORY')
+    return(connection)
+
+
+def column_values(series):
+    """ 
+    converts a column to python values that sqlite3 can bind (numpy/pandas integers are not accepted)
+    input: series
+    output: list
+    """ 
+    if pd.api.types.is_integer_dtype(series.dtype) or pd.api.types.is_bool_dtype(series.dtype):
+        return(series.to_numpy(dtype=np.int64).tolist())
+    return(series.astype(object).where(series.notna(), None).tolist())
+
+
+def create_table(connection, columns):
+    """ 
+    creates the DisasterMessages table with a primary key on id (text columns: message and genre, others integer)
+    input: connection, column names
+    output: none
+    """ 
+    definitions = ['"{}" {}'.format(c, 'INTEGER PRIMARY KEY' if c == 'id' else 'TEXT' if c in ('message', 'genre') else 'INTEGER')
+                   for c in columns]
+    connection.execute('CREATE TABLE IF NOT EXISTS "{}" ({})'.format(TABLE, ', '.join(definitions)))
+    return
+
+
+def create_indexes(connection, columns):
+    """ 
+    indexes genre and the hot category columns
+    input: connection, column names of the table
     output: none
     """ 
-    engine = create_engine('sqlite:///'+database_filename)
-    df.to_sql('DisasterMessages', engine, index=False, if_exists='replace')
+    for column in ['genre'] + HOT_CATEGORIES:
+        if column in columns:
+            connection.execute('CREATE INDEX IF NOT EXISTS "ix_{0}_{1}" ON "{0}" ("{1}")'.format(TABLE, column))
     return
 
 
+def table_columns(connection):
+    """ 
+    output: list of (column name, is part of the primary key) of the DisasterMessages table, empty when it does not exist
+    """ 
+    return([(row[1], row[5] > 0) for row in connection.execute('PRAGMA table_info("{}")'.format(TABLE))])
+
+
+def ensure_primary_key(connection, columns):
+    """ 
+    rebuilds a DisasterMessages table created without primary key (e.g. by an earlier version of this script),
+    keeping the last row of every id
+    input: connection, column names of the new data (must match the existing table)
+    output: none
+    """ 
+    existing = table_columns(connection)
+    if [name for name, _ in existing] != list(columns):
+        raise ValueError('{} has different columns than the new data: run without --upsert to replace it'.format(TABLE))
+    if any(pk for name, pk in existing if name == 'id'):
+        return
+    connection.execute('ALTER TABLE "{0}" RENAME TO "{0}_old"'.format(TABLE))
+    for (name,) in connection.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = '{}_old'".format(TABLE)).fetchall():
+        connection.execute('DROP INDEX "{}"'.format(name))
+    create_table(connection, columns)
+    connection.execute('INSERT OR REPLACE INTO "{0}" SELECT * FROM "{0}_old" ORDER BY rowid'.format(TABLE))
+    connection.execute('DROP TABLE "{}_old"'.format(TABLE))
+    return
+
+
+def save_data(df, database_filename, mode='replace', indexes=True):
+    """ 
+    saves dataframe to specified SQLite database (table: DisasterMessages) in a single transaction with executemany,
+    the summary tables read by the web applications (summary_tables.py) are updated in the same transaction
+    input: dataframe, mode:
+    - 'replace': recreate the table
+    - 'append': insert the rows (ids must be new)
+    - 'upsert': insert new ids, update the rows of existing ids that changed (unchanged rows are not rewritten)
+    indexes: build the indexes after the insert (False when more chunks follow: see save_indexes)
+    output: number of rows inserted or updated
+    """ 
+    columns = list(df.columns)
+    column_list = ', '.join('"{}"'.format(c) for c in columns)
+    insert = 'INSERT INTO "{}" ({}) VALUES ({})'.format(TABLE, column_list, ', '.join('?' * len(columns)))
+    if mode == 'upsert':
+        others = [c for c in columns if c != 'id']
+        insert += ' ON CONFLICT(id) DO UPDATE SET {} WHERE {}'.format(
+            ', '.join('"{0}" = excluded."{0}"'.format(c) for c in others),
+            ' OR '.join('"{0}" IS NOT excluded."{0}"'.format(c) for c in others))
+    elif mode not in ('replace', 'append'):
+        raise ValueError("mode should be 'replace', 'append' or 'upsert'")
+
+    rows = zip(*[column_values(df[c]) for c in columns])
+
+    connection = connect(database_filename)
+    try:
+        with connection:
+            if mode == 'replace':
+                connection.execute('DROP TABLE IF EXISTS "{}"'.format(TABLE))
+            elif table_columns(connection):
+                ensure_primary_key(connection, columns)
+            create_table(connection, columns)
+            # stored version of the rows that the upsert may change: taken out of the summary before adding df
+            old_rows = summary_tables.stored_rows(connection, df['id'], summary_tables.table_categories(connection)) if mode == 'upsert' else None
+            changes = connection.total_changes
+            connection.executemany(insert, rows)
+            changes = connection.total_changes - changes
+            # indexes are cheaper to build once after a bulk insert than to maintain row by row
+            if indexes:
+                create_indexes(connection, columns)
+            summary_tables.update_summary(connection, df, mode, old_rows)
+    finally:
+        connection.close()
+    return(changes)
+
+
+def save_indexes(database_filename):
+    """ 
+    builds the indexes of the DisasterMessages table once the last chunk is saved
+    input: name of the database
+    output: none
+    """ 
+    connection = connect(database_filename)
+    try:
+        with connection:
+            create_indexes(connection, [name for name, _ in table_columns(connection)])
+    finally:
+        connection.close()
+    return
+
+
+def process_chunked(messages_filepath, categories_filepath, database_filepath, chunksize, upsert=False):
+    """ 
+    Runs loading, cleaning and saving chunk by chunk: memory is bounded by the chunk size, not by the input size
+    parameters: message file, categories file (both sorted by id), name of database to be created, rows per chunk,
+    upsert (update the existing table instead of replacing it)
+    output: number of rows saved, number of rows inserted/updated, seconds spent saving
+    """ 
+    category_colnames = None
+    n_rows = 0
+    n_changed = 0
+    save_time = 0.0
+    for i, df in enumerate(load_data_chunked(messages_filepath, categories_filepath, chunksize)):
+        if category_colnames is None:
+            category_colnames = category_names(df['categories'].iloc[0])
+        df = clean_data(df, category_colnames)
+        start = time.perf_counter()
+        # without indexes: they would be maintained row by row by the inserts of the next chunks
+        n_changed += save_data(df, database_filepath, mode='upsert' if upsert else 'replace' if i == 0 else 'append',
+                               indexes=False)
+        save_time += time.perf_counter() - start
+        n_rows += len(df)
+        print('    chunk {}: {} rows saved ({} in total)'.format(i + 1, len(df), n_rows))
+    if n_rows:
+        start = time.perf_counter()
+        save_indexes(database_filepath)
+        save_time += time.perf_counter() - start
+    return(n_rows, n_changed, save_time)
+
+
 def main():
     """ 
     Checks and requires for the availabilty of 3 parameters
     Runs the different steps: loading, cleaning and saving to db
-    parameters: message file, categories file, name of database to be created
+    parameters: message file, categories file, name of database to be created, optional --chunksize
     output: creates and load message data to to the specified database
     """ 
-    if len(sys.argv) == 4:
+    parser = argparse.ArgumentParser(
+        description='Load, clean and merge the messages and categories datasets and save them to a SQLite database.',
+        epilog='Example: python process_data.py disaster_messages.csv disaster_categories.csv DisasterResponse.db')
+    parser.add_argument('messages_filepath', help='filepath of the messages dataset')
+    parser.add_argument('categories_filepath', help='filepath of the categories dataset')
+    parser.add_argument('database_filepath', help='filepath of the database to save the cleaned data to')
+    parser.add_argument('--chunksize', type=int, default=None,
+                        help='stream both files (sorted by id) in chunks of this many rows to bound memory usage')
+    parser.add_argument('--upsert', action='store_true',
+                        help='insert new messages and update changed ones instead of replacing the table')
+    args = parser.parse_args()
+    messages_filepath, categories_filepath, database_filepath = args.messages_filepath, args.categories_filepath, args.database_filepath
 
-        messages_filepath, categories_filepath, database_filepath = sys.argv[1:]
+    print('Loading data...\n    MESSAGES: {}\n    CATEGORIES: {}'
+          .format(messages_filepath, categories_filepath))
+    if args.chunksize:
+        print('Cleaning and saving data in chunks of {} rows...\n    DATABASE: {}'.format(args.chunksize, database_filepath))
+        n_rows, n_changed, save_time = process_chunked(messages_filepath, categories_filepath, database_filepath, args.chunksize, args.upsert)
 
-        print('Loading data...\n    MESSAGES: {}\n    CATEGORIES: {}'
-              .format(messages_filepath, categories_filepath))
+    else:
         df = load_data(messages_filepath, categories_filepath)
 
         print('Cleaning data...')
         df = clean_data(df)
         
         print('Saving data...\n    DATABASE: {}'.format(database_filepath))
-        save_data(df, database_filepath)
+        start = time.perf_counter()
+        n_changed = save_data(df, database_filepath, mode='upsert' if args.upsert else 'replace')
+        save_time = time.perf_counter() - start
+        n_rows = len(df)
         
-        print('Cleaned data saved to database!')
-    
-    else:
-        print('Please provide the filepaths of the messages and categories '\
-              'datasets as the first and second argument respectively, as '\
-              'well as the filepath of the database to save the cleaned data '\
-              'to as the third argument. \n\nExample: python process_data.py '\
-              'disaster_messages.csv disaster_categories.csv '\
-              'DisasterResponse.db')
+    print('    {} rows saved ({} inserted/updated) in {:.2f}s: {:.0f} rows/sec'
+          .format(n_rows, n_changed, save_time, n_rows / save_time if save_time else 0))
+    print('Cleaned data saved to database!')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,278 @@
+""" summary_tables:
+
+    Aggregate statistics of the DisasterMessages table, written by process_data.py next to it and read by the
+    dashboards (app/run.py, app.py) instead of the messages. All tables are additive, so appended or updated rows
+    are folded in without reading the table again:
+    - category_stats: per category its position, number of positive messages and total length of those messages
+    - category_cooccurrence: number of messages positive for both categories (category_a <= category_b by position)
+    - genre_stats: per genre and aid_related value the number of messages, sum and sum of squares of their length
+    - genre_length_counts: number of messages per genre and message length
+    - genre_length_quantiles: message length quantiles per genre (rewritten from genre_length_counts)
+    The category correlation matrix of the dashboard is derived from these counts.
+
+Attributes:
+    Summary: additive statistics of a set of messages, with the DataFrames plotted by the dashboards
+    update_summary: fold inserted / updated rows into the tables (within the transaction that writes the rows)
+    load_summary: Summary stored in a database (None when it has no summary tables)
+"""
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+TABLE = "DisasterMessages"
+TEXT_COLUMNS = ("id", "message", "genre")
+SUMMARY_TABLES = ("category_stats", "category_cooccurrence", "genre_stats", "genre_length_counts", "genre_length_quantiles")
+QUANTILES = (0.0, 0.25, 0.5, 0.75, 1.0)
+FETCH_SIZE = 50000
+
+
+def quantile(lengths, cumulative, q):
+    """ Returns: quantile q of a distribution given as sorted distinct values and cumulative counts
+    (linear interpolation between the neighbouring messages, as numpy.quantile on the expanded values)
+    """
+    position = q * (cumulative[-1] - 1)
+    lower, upper = (lengths[np.searchsorted(cumulative, rank, side="right")] for rank in (np.floor(position), np.ceil(position)))
+    return(float(lower + (position - np.floor(position)) * (upper - lower)))
+
+
+class Summary:
+    """ additive statistics of a set of messages
+    Input:
+    - categories: category names
+    - positives / length_sum: per category the number of positive messages and their total length
+    - cooccurrence: (n_categories x n_categories) number of messages positive for both categories
+    - genre_stats: DataFrame indexed by (genre, aid_related) with columns messages, length_sum, length_sq_sum
+    - length_counts: Series indexed by (genre, message_length) with the number of messages
+    """
+
+    def __init__(self, categories, positives, length_sum, cooccurrence, genre_stats, length_counts):
+        self.categories = list(categories)
+        self.positives = np.asarray(positives, dtype=np.int64)
+        self.length_sum = np.asarray(length_sum, dtype=np.int64)
+        self.cooccurrence = np.asarray(cooccurrence, dtype=np.int64)
+        self.genre_stats = genre_stats
+        self.length_counts = length_counts
+
+    @classmethod
+    def from_frame(cls, df, categories=None):
+        """ Input: DataFrame with genre, the category columns and message or message_length, category names
+        (default: every column except id, message, genre and message_length)
+        Returns: Summary of the rows
+        """
+        if categories is None:
+            categories = [c for c in df.columns if c not in TEXT_COLUMNS + ("message_length",)]
+        X = df[list(categories)].to_numpy(dtype=np.int64)
+        length = (df["message_length"] if "message_length" in df else df["message"].str.len()).fillna(0).to_numpy(dtype=np.int64)
+        genre = df["genre"].astype(object).fillna("").astype(str).to_numpy()
+
+        frame = pd.DataFrame({"genre": genre, "aid_related": df["aid_related"].to_numpy(dtype=np.int64) if "aid_related" in df else 0,
+                              "length": length})
+        frame["length_sq"] = frame["length"] ** 2
+        genre_stats = frame.groupby(["genre", "aid_related"]).agg(
+            messages=("length", "size"), length_sum=("length", "sum"), length_sq_sum=("length_sq", "sum"))
+        length_counts = frame.groupby(["genre", "length"]).size().rename("messages")
+        length_counts.index = length_counts.index.set_names(["genre", "message_length"])
+        return(cls(categories, X.sum(axis=0), X.T @ length, X.T @ X, genre_stats.astype(np.int64), length_counts.astype(np.int64)))
+
+    @classmethod
+    def empty(cls, categories):
+        k = len(categories)
+        genre_stats = pd.DataFrame(columns=["messages", "length_sum", "length_sq_sum"], dtype=np.int64,
+                                   index=pd.MultiIndex.from_arrays([[], []], names=["genre", "aid_related"]))
+        length_counts = pd.Series([], dtype=np.int64, name="messages",
+                                  index=pd.MultiIndex.from_arrays([[], []], names=["genre", "message_length"]))
+        return(cls(categories, np.zeros(k), np.zeros(k), np.zeros((k, k)), genre_stats, length_counts))
+
+    def combine(self, other, sign=1):
+        """ Returns: Summary of the messages of both (sign=-1: of self without the messages of other) """
+        if other.categories != self.categories:
+            raise ValueError("summaries of different categories cannot be combined")
+        genre_stats = self.genre_stats.add(sign * other.genre_stats, fill_value=0).astype(np.int64)
+        length_counts = self.length_counts.add(sign * other.length_counts, fill_value=0).astype(np.int64)
+        return(Summary(self.categories, self.positives + sign * other.positives, self.length_sum + sign * other.length_sum,
+                       self.cooccurrence + sign * other.cooccurrence,
+                       genre_stats[genre_stats["messages"] != 0], length_counts[length_counts != 0].rename("messages")))
+
+    @property
+    def n_messages(self):
+        return(int(self.genre_stats["messages"].sum()))
+
+    def length_quantiles(self):
+        """ Returns: DataFrame with genre, quantile and message_length (linear interpolation, as pandas' quantile) """
+        rows = []
+        for genre, (lengths, cumulative) in self._length_distributions():
+            for q in QUANTILES:
+                rows.append((genre, q, quantile(lengths, cumulative, q)))
+        return(pd.DataFrame(rows, columns=["genre", "quantile", "message_length"]))
+
+    def length_boxes(self):
+        """ Returns: DataFrame with genre, q1, median, q3, lowerfence and upperfence of the message length
+        (fences: most extreme lengths within 1.5 IQR of the quartiles, as plotly draws the whiskers)
+        """
+        rows = []
+        for genre, (lengths, cumulative) in self._length_distributions():
+            q1, median, q3 = (quantile(lengths, cumulative, q) for q in (0.25, 0.5, 0.75))
+            iqr = q3 - q1
+            rows.append((genre, q1, median, q3, int(lengths[lengths >= q1 - 1.5 * iqr].min()),
+                         int(lengths[lengths <= q3 + 1.5 * iqr].max())))
+        return(pd.DataFrame(rows, columns=["genre", "q1", "median", "q3", "lowerfence", "upperfence"]))
+
+    def _length_distributions(self):
+        """ Returns: list of (genre, (sorted distinct lengths, cumulative number of messages)) """
+        distributions = []
+        for genre, counts in self.length_counts.sort_index().groupby(level="genre"):
+            distributions.append((genre, (counts.index.get_level_values("message_length").to_numpy(),
+                                          np.cumsum(counts.to_numpy()))))
+        return(distributions)
+
+    def correlation(self):
+        """ Returns: Pearson correlation matrix of the category columns and message_length (NaN for constant columns),
+        as DataFrame.corr on the messages
+        """
+        n = self.n_messages
+        length_sum = float(self.genre_stats["length_sum"].sum())
+        length_sq_sum = float(self.genre_stats["length_sq_sum"].sum())
+        # second moments of [categories | message_length]
+        k = len(self.categories)
+        sums = np.append(self.positives, length_sum).astype(np.float64)
+        products = np.empty((k + 1, k + 1))
+        products[:k, :k] = self.cooccurrence
+        products[:k, k] = products[k, :k] = self.length_sum
+        products[k, k] = length_sq_sum
+        covariance = products / n - np.outer(sums, sums) / n ** 2
+        std = np.sqrt(np.clip(np.diag(covariance), 0, None))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            corr = covariance / np.outer(std, std)
+        corr[:, std == 0] = np.nan
+        corr[std == 0, :] = np.nan
+        columns = self.categories + ["message_length"]
+        return(pd.DataFrame(np.clip(corr, -1, 1), index=columns, columns=columns))
+
+    def category_counts(self, given=None):
+        """ Returns: DataFrame with Category and Count (descending): positive messages per category,
+        or per category among the messages positive for category given (which is left out)
+        """
+        if given is None:
+            counts = pd.Series(self.positives, index=self.categories)
+        else:
+            counts = pd.Series(self.cooccurrence[self.categories.index(given)], index=self.categories).drop(given)
+        df = counts.reset_index()
+        df.columns = ["Category", "Count"]
+        return(df.sort_values(by="Count", ascending=False))
+
+    def genre_counts(self):
+        """ Returns: DataFrame with genre and count """
+        return(self.genre_stats["messages"].groupby(level="genre").sum().rename("count").reset_index())
+
+    def genre_aid_counts(self):
+        """ Returns: DataFrame with aid_related, genre and count """
+        df = self.genre_stats["messages"].rename("count").reset_index()
+        return(df[["aid_related", "genre", "count"]].sort_values(["aid_related", "genre"]).reset_index(drop=True))
+
+
+def table_categories(connection, table=TABLE):
+    """ Returns: category columns of the messages table (empty when it does not exist) """
+    return([row[1] for row in connection.execute('PRAGMA table_info("{}")'.format(table)) if row[1] not in TEXT_COLUMNS])
+
+
+def read_summary(connection):
+    """ Returns: Summary stored in the database, None when the summary tables are missing """
+    existing = {row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    if not set(SUMMARY_TABLES) <= existing:
+        return(None)
+    stats = pd.read_sql('SELECT category, positives, length_sum FROM category_stats ORDER BY position', connection)
+    categories = stats["category"].tolist()
+    position = {c: i for i, c in enumerate(categories)}
+    cooccurrence = np.zeros((len(categories), len(categories)), dtype=np.int64)
+    for a, b, count in connection.execute("SELECT category_a, category_b, messages FROM category_cooccurrence"):
+        cooccurrence[position[a], position[b]] = cooccurrence[position[b], position[a]] = count
+    genre_stats = pd.read_sql("SELECT genre, aid_related, messages, length_sum, length_sq_sum FROM genre_stats", connection)
+    length_counts = pd.read_sql("SELECT genre, message_length, messages FROM genre_length_counts", connection)
+    return(Summary(categories, stats["positives"], stats["length_sum"], cooccurrence,
+                   genre_stats.set_index(["genre", "aid_related"]).astype(np.int64),
+                   length_counts.set_index(["genre", "message_length"])["messages"].astype(np.int64)))
+
+
+def write_summary(connection, summary):
+    """ replace the content of the summary tables (call within a transaction) """
+    connection.execute("CREATE TABLE IF NOT EXISTS category_stats (category TEXT PRIMARY KEY, position INTEGER, "
+                       "positives INTEGER, length_sum INTEGER)")
+    connection.execute("CREATE TABLE IF NOT EXISTS category_cooccurrence (category_a TEXT, category_b TEXT, messages INTEGER, "
+                       "PRIMARY KEY (category_a, category_b))")
+    connection.execute("CREATE TABLE IF NOT EXISTS genre_stats (genre TEXT, aid_related INTEGER, messages INTEGER, "
+                       "length_sum INTEGER, length_sq_sum INTEGER, PRIMARY KEY (genre, aid_related))")
+    connection.execute("CREATE TABLE IF NOT EXISTS genre_length_counts (genre TEXT, message_length INTEGER, messages INTEGER, "
+                       "PRIMARY KEY (genre, message_length))")
+    connection.execute("CREATE TABLE IF NOT EXISTS genre_length_quantiles (genre TEXT, quantile REAL, message_length REAL, "
+                       "PRIMARY KEY (genre, quantile))")
+    for table in SUMMARY_TABLES:
+        connection.execute('DELETE FROM "{}"'.format(table))
+
+    categories = summary.categories
+    connection.executemany("INSERT INTO category_stats VALUES (?, ?, ?, ?)",
+                           [(c, i, int(p), int(s)) for i, (c, p, s) in enumerate(zip(categories, summary.positives, summary.length_sum))])
+    connection.executemany("INSERT INTO category_cooccurrence VALUES (?, ?, ?)",
+                           [(categories[i], categories[j], int(summary.cooccurrence[i, j]))
+                            for i in range(len(categories)) for j in range(i, len(categories))])
+    connection.executemany("INSERT INTO genre_stats VALUES (?, ?, ?, ?, ?)",
+                           [(genre, int(aid), int(row.messages), int(row.length_sum), int(row.length_sq_sum))
+                            for (genre, aid), row in summary.genre_stats.iterrows()])
+    connection.executemany("INSERT INTO genre_length_counts VALUES (?, ?, ?)",
+                           [(genre, int(length), int(count)) for (genre, length), count in summary.length_counts.items()])
+    connection.executemany("INSERT INTO genre_length_quantiles VALUES (?, ?, ?)",
+                           summary.length_quantiles().itertuples(index=False, name=None))
+    return
+
+
+def summarize_table(connection, categories):
+    """ Returns: Summary of all rows of the messages table (read in chunks, without the message text) """
+    summary = Summary.empty(categories)
+    query = 'SELECT genre, LENGTH(message) AS message_length, {} FROM "{}"'.format(
+        ", ".join('"{}"'.format(c) for c in categories), TABLE)
+    for chunk in pd.read_sql(query, connection, chunksize=FETCH_SIZE):
+        summary = summary.combine(Summary.from_frame(chunk, categories))
+    return(summary)
+
+
+def stored_rows(connection, ids, categories):
+    """ Returns: DataFrame with genre, message_length and the categories of the stored rows with these ids """
+    connection.execute("CREATE TEMP TABLE IF NOT EXISTS summary_ids (id INTEGER PRIMARY KEY)")
+    connection.execute("DELETE FROM summary_ids")
+    connection.executemany("INSERT OR IGNORE INTO summary_ids VALUES (?)", [(int(i),) for i in ids])
+    query = 'SELECT genre, LENGTH(message) AS message_length, {} FROM "{}" WHERE id IN (SELECT id FROM summary_ids)'.format(
+        ", ".join('"{}"'.format(c) for c in categories), TABLE)
+    return(pd.read_sql(query, connection))
+
+
+def update_summary(connection, df, mode, old_rows=None):
+    """ fold rows written to the messages table into the summary tables (call within the same transaction)
+    Input:
+    - connection: database connection
+    - df: DataFrame of the rows that were written (id, message, genre, categories)
+    - mode: "replace" (the table holds exactly df), "append" (df was inserted) or "upsert"
+    - old_rows: for "upsert", stored version of the rows of df before the write (see stored_rows)
+    Tables missing or written for other categories are rebuilt from the messages table.
+    """
+    categories = table_categories(connection)
+    if mode == "replace":
+        summary = Summary.from_frame(df, categories)
+    else:
+        summary = read_summary(connection)
+        if summary is None or summary.categories != categories:
+            summary = summarize_table(connection, categories)
+        else:
+            summary = summary.combine(Summary.from_frame(df, categories))
+            if old_rows is not None and len(old_rows):
+                summary = summary.combine(Summary.from_frame(old_rows, categories), sign=-1)
+    write_summary(connection, summary)
+    return(summary)
+
+
+def load_summary(database_filepath):
+    """ Returns: Summary of the database (None when process_data.py did not write the summary tables) """
+    connection = sqlite3.connect("file:{}?mode=ro".format(database_filepath), uri=True)
+    try:
+        return(read_summary(connection))
+    finally:
+        connection.close()
@@ -0,0 +1,146 @@
+""" export_model
+
+    Exports the parts of a trained model (pickle created by train_classifier.py) that are needed for prediction,
+    so that the web application can load them in milliseconds and share them between workers (see predictor.py):
+    - terms.npy / term_index.npy: vocabulary of the TF-IDF vectorizer as a sorted array + column of every term
+    - idf.npy: idf weights
+    - coef.npy / intercept.npy: coefficients of the per-category logistic regressions stacked into one
+      (n_features x n_categories) matrix + intercept vector
+    - manifest.json: vectorizer settings, genres, passthrough columns, categories, message length quantiles,
+      best parameters and file list
+    The CV results and the rest of the GridSearchCV object are not exported.
+
+    to run: python models/export_model.py models/DisasterResponse.pkl models/DisasterResponse.export --database data/DisasterResponse.db
+
+Attributes:
+    pickle file of the trained model, export directory to create
+    --database: database the model was trained on, used for the category names when the model does not carry them
+
+Output:
+    Export directory with the .npy arrays and manifest.json
+"""
+
+# import libraries
+import os
+import json
+import time
+import shutil
+import sqlite3
+import argparse
+import datetime
+
+import joblib
+import numpy as np
+import sklearn
+
+# models pickled by train_classifier.py as a script refer to __main__.tokenize
+from tokenizer import tokenize
+from predictor import MANIFEST, FORMAT_VERSION, Predictor
+
+
+def function_spec(fn):
+    """ Returns: "module:qualified_name" reference of a function (or class) """
+    return("{}:{}".format(fn.__module__, fn.__qualname__))
+
+
+def tokenizer_spec(tokenizer):
+    """ Returns: manifest entries of the tokenizer: function reference, or class reference + state of a tokenizer object """
+    if hasattr(tokenizer, "to_dict"):
+        return({"tokenizer": function_spec(type(tokenizer)), "tokenizer_state": tokenizer.to_dict()})
+    return({"tokenizer": function_spec(tokenizer)})
+
+
+def database_categories(database_filepath, n_categories):
+    """ category names as selected by train_classifier.load_data (categories with more than 50 positive values)
+    Returns: list of names, None when they do not match the number of categories of the model
+    """
+    connection = sqlite3.connect(database_filepath)
+    try:
+        columns = [row[1] for row in connection.execute('PRAGMA table_info("DisasterMessages")')][3:]
+        sums = connection.execute('SELECT {} FROM "DisasterMessages"'.format(
+            ', '.join('SUM("{}")'.format(c) for c in columns))).fetchone()
+    finally:
+        connection.close()
+    categories = [c for c, total in zip(columns, sums) if (total or 0) > 50]
+    return(categories if len(categories) == n_categories else None)
+
+
+def export_model(model, export_dir, categories=None, source=None):
+    """ write the export (arrays + manifest) to a new directory, replacing an existing export atomically
+    Input: fitted model, export directory, category names (optional), path of the pickle file (for the manifest)
+    Returns: manifest (dict)
+    """
+    predictor = Predictor.from_pipeline(model, categories)
+    arrays = {"terms": predictor.terms, "term_index": predictor.term_index, "idf": predictor.idf,
+              "coef": predictor.coef, "intercept": predictor.intercept}
+    manifest = {
+        "format_version": FORMAT_VERSION,
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "source": source,
+        "sklearn_version": sklearn.__version__,
+        "best_params": {k: v.item() if hasattr(v, "item") else v for k, v in getattr(model, "best_params_", {}).items()},
+        "categories": predictor.categories,
+        "genres": predictor.genres,
+        "passthrough": predictor.passthrough,
+        "length_quantiles": predictor.length_quantiles.to_dict() if predictor.length_quantiles else None,
+        "n_features": predictor.n_features,
+        "tfidf": {
+            **tokenizer_spec(predictor.tokenizer),
+            "sublinear_tf": predictor.sublinear_tf,
+            "norm": predictor.norm,
+            "lowercase": predictor.lowercase,
+            "strip_accents": predictor.strip_accents,
+        },
+        "files": {name: name + ".npy" for name in arrays},
+        "shapes": {name: list(a.shape) for name, a in arrays.items()},
+    }
+
+    # write next to the target and swap directories, so readers never see a partial export
+    build_dir = export_dir.rstrip(os.sep) + ".tmp"
+    shutil.rmtree(build_dir, ignore_errors=True)
+    os.makedirs(build_dir)
+    for name, a in arrays.items():
+        np.save(os.path.join(build_dir, manifest["files"][name]), a)
+    with open(os.path.join(build_dir, MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=2)
+    old_dir = export_dir.rstrip(os.sep) + ".old"
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.exists(export_dir):
+        os.rename(export_dir, old_dir)
+    os.rename(build_dir, export_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    return(manifest)
+
+
+def main():
+    """ load the pickled model, export it and check that the export loads """
+    parser = argparse.ArgumentParser(
+        description='Export the parts of a trained model needed for prediction as memory-mappable arrays.',
+        epilog='Example: python export_model.py DisasterResponse.pkl DisasterResponse.export --database ../data/DisasterResponse.db')
+    parser.add_argument('model_filepath', help='pickle file created by train_classifier.py')
+    parser.add_argument('export_dir', help='directory to write the export to')
+    parser.add_argument('--database', default=None, help='database the model was trained on (category names)')
+    args = parser.parse_args()
+
+    print('Loading model...\n    MODEL: {}'.format(args.model_filepath))
+    model = joblib.load(args.model_filepath)
+
+    categories = getattr(model, 'category_names_', None)
+    n_categories = len(getattr(model, 'best_estimator_', model).named_steps['mo'].estimators_)
+    if categories is None and args.database:
+        categories = database_categories(args.database, n_categories)
+    if categories is None:
+        print('    category names unknown (provide --database): the export refers to categories by position')
+
+    print('Exporting model...\n    EXPORT: {}'.format(args.export_dir))
+    manifest = export_model(model, args.export_dir, categories=categories, source=os.path.abspath(args.model_filepath))
+    print('    {} terms, {} features, {} categories'.format(manifest["shapes"]["terms"][0], manifest["n_features"], n_categories))
+
+    start = time.perf_counter()
+    Predictor.load(args.export_dir)
+    print('    export loads in {:.1f} ms'.format((time.perf_counter() - start) * 1000))
+    print('Model exported!')
+
+
+if __name__ == '__main__':
+    main()
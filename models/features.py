@@ -0,0 +1,89 @@
+""" features
+
+    Derived input features shared by training (train_classifier.py) and serving (app/run.py, predictor.py):
+    - len: quantile of the message length within the training messages (QuantileTransformer, 10 quantiles)
+    - question_mark / exclamation_mark: 1 when the message contains a "?" / "!"
+    The fitted length quantiles are a small table (LengthQuantiles) saved with the model, so serving computes
+    the same "len" as training with a vectorized binary search instead of scanning the training messages.
+
+Attributes:
+    FEATURE_COLUMNS: input columns of the training pipeline
+    GENRES: genres of the training messages (categories of the "genre" one-hot encoding)
+    LengthQuantiles: quantile table of the message length
+    build_features: model input for a batch of messages
+"""
+
+import numpy as np
+import pandas as pd
+
+# input columns of the training pipeline (train_classifier.load_data)
+FEATURE_COLUMNS = ["message", "genre", "len", "question_mark", "exclamation_mark"]
+GENRES = ("direct", "news", "social")
+N_QUANTILES = 10
+# same tolerance as QuantileTransformer for values on the first or last quantile
+BOUNDS_THRESHOLD = 1e-7
+
+
+class LengthQuantiles:
+    """ uniform quantile transformation of the message length, as QuantileTransformer(n_quantiles=10) fitted in training
+    Input:
+    - quantiles: message lengths at the quantiles (increasing)
+    - references: quantile of every entry of quantiles (0 .. 1)
+    """
+
+    def __init__(self, quantiles, references):
+        self.quantiles = np.asarray(quantiles, dtype=np.float64)
+        self.references = np.asarray(references, dtype=np.float64)
+
+    @classmethod
+    def fit(cls, lengths, n_quantiles=N_QUANTILES):
+        """ Input: message lengths of the training messages
+        Returns: LengthQuantiles of the fitted QuantileTransformer
+        """
+        from sklearn.preprocessing import QuantileTransformer
+        qt = QuantileTransformer(n_quantiles=n_quantiles, random_state=0)
+        qt.fit(np.asarray(lengths, dtype=np.float64).reshape(-1, 1))
+        return(cls.from_transformer(qt))
+
+    @classmethod
+    def from_transformer(cls, qt):
+        """ Returns: LengthQuantiles with the table of a QuantileTransformer fitted on the message length """
+        return(cls(qt.quantiles_[:, 0], qt.references_))
+
+    def transform(self, lengths):
+        """ Input: message lengths (array-like)
+        Returns: float array with the quantile of every length (interpolated as QuantileTransformer.transform)
+        """
+        x = np.asarray(lengths, dtype=np.float64)
+        # average of the interpolation from both sides: repeated quantiles map to the middle of their references
+        y = 0.5 * (np.interp(x, self.quantiles, self.references)
+                   - np.interp(-x, -self.quantiles[::-1], -self.references[::-1]))
+        y[x + BOUNDS_THRESHOLD > self.quantiles[-1]] = 1
+        y[x - BOUNDS_THRESHOLD < self.quantiles[0]] = 0
+        return(y)
+
+    def to_dict(self):
+        return({"quantiles": self.quantiles.tolist(), "references": self.references.tolist()})
+
+    @classmethod
+    def from_dict(cls, d):
+        return(cls(d["quantiles"], d["references"]))
+
+
+def build_features(queries, genres="direct", length_quantiles=None):
+    """ build the model input for a batch of messages in one go (same derived fields as train_classifier.load_data)
+    Input:
+    - queries: list of message strings
+    - genres: single genre applied to all messages or list with one genre per message
+    - length_quantiles: LengthQuantiles of the training messages (None: "len" is the constant 0.2 used before)
+    Returns: DataFrame with columns "message", "genre", "len", "question_mark" and "exclamation_mark"
+    """
+    X = pd.DataFrame({"message": pd.Series(queries, dtype=object).fillna("").astype(str)})
+    X["genre"] = genres
+    if length_quantiles is None:
+        X["len"] = 0.2
+    else:
+        X["len"] = length_quantiles.transform(X["message"].str.len())
+    X["question_mark"] = X["message"].str.contains("?", regex=False).astype(int)
+    X["exclamation_mark"] = X["message"].str.contains("!", regex=False).astype(int)
+    return(X[FEATURE_COLUMNS])
@@ -0,0 +1,150 @@
+""" inference:
+
+    Inference core shared by the web applications (app/run.py, app/async_server.py) and the bulk scoring
+    CLI (score_messages.py):
+    - load_engine: load the model (pickle or export) with its category names and message length quantiles
+    - InferenceEngine: feature construction + batched prediction of labels and probabilities
+    Importing this module imports the scientific stack (numpy, pandas, scipy): the web application imports it
+    when it loads the model (see app/startup.py).
+
+Attributes:
+    None
+"""
+import os
+import sqlite3
+from contextlib import nullcontext
+
+import numpy as np
+
+# models pickled by train_classifier.py as a script refer to __main__.tokenize: the serving scripts import it
+from tokenizer import tokenize
+from predictor import Predictor
+from features import GENRES, LengthQuantiles, build_features
+
+# reads of an artifact that is replaced while it is loaded
+LOAD_ATTEMPTS = 3
+
+
+def artifact_version(filepath):
+    """ Returns: version of a model file or export directory (modification time and size of the file / manifest) """
+    if os.path.isdir(filepath):
+        filepath = os.path.join(filepath, "manifest.json")
+    stat = os.stat(filepath)
+    return("{}-{}".format(stat.st_mtime_ns, stat.st_size))
+
+
+def check_genres(genres):
+    """ Raises: ValueError when a genre is not one of the training genres (the pipeline's OneHotEncoder would fail) """
+    unknown = set(genres) - set(GENRES)
+    if unknown:
+        raise ValueError("unknown genre(s) {}, expected one of {}".format(", ".join(sorted(map(repr, unknown))), ", ".join(GENRES)))
+
+
+def training_length_quantiles(database_filepath, table="DisasterMessages"):
+    """ Returns: LengthQuantiles of the training messages (as fitted by train_classifier.load_data) """
+    connection = sqlite3.connect("file:{}?mode=ro".format(database_filepath), uri=True)
+    try:
+        lengths = np.array([row[0] or 0 for row in connection.execute('SELECT LENGTH(message) FROM "{}"'.format(table))])
+    finally:
+        connection.close()
+    return(LengthQuantiles.fit(lengths))
+
+
+class InferenceEngine:
+    """ classify batches of messages with a loaded model
+    Input:
+    - model: Predictor or fitted pipeline (GridSearchCV / Pipeline)
+    - category_names: name of every predicted category
+    - length_quantiles: LengthQuantiles of the training messages ("len" feature)
+    - version: version of the model artifact
+    - stage: context manager factory timing the stages (e.g. metrics.Metrics.stage, None: not timed)
+    """
+
+    def __init__(self, model, category_names, length_quantiles=None, version=None, stage=None):
+        self.model = model
+        self.category_names = list(category_names)
+        self.length_quantiles = length_quantiles
+        self.version = version
+        self.stage = stage or (lambda name: nullcontext())
+
+    def classify_batch(self, X):
+        """ classify a batch of messages with a single pass through the model
+        Input: DataFrame as returned by build_features
+        Returns: labels (n_messages x n_categories, int) and probabilities of the positive class (same shape)
+        """
+        model = self.model
+        if isinstance(model, Predictor):
+            with self.stage("tokenize"):
+                tokens = model.analyze(X["message"])
+            with self.stage("features"):
+                features = model.transform(X, tokens)
+            with self.stage("classifiers"):
+                probabilities = model.predict_proba(X, features)
+        else:
+            pipeline = getattr(model, "best_estimator_", model)
+            # the vectorizer tokenizes while transforming: "features" includes the tokenization
+            with self.stage("features"):
+                features = pipeline.named_steps["clmn"].transform(X)
+            with self.stage("classifiers"):
+                # MultiOutputClassifier returns one (n_messages x 2) array per category
+                probabilities = np.column_stack([p[:, 1] for p in pipeline.named_steps["mo"].predict_proba(features)])
+        # LogisticRegression predicts the positive class when its probability exceeds 0.5
+        labels = (probabilities > 0.5).astype(int)
+        return(labels, probabilities)
+
+    def classify(self, messages, genres):
+        """ Input: list of messages, list of genres
+        Returns: labels and probabilities (n_messages x n_categories)
+        """
+        with self.stage("build_features"):
+            X = build_features(messages, genres, self.length_quantiles)
+        return(self.classify_batch(X))
+
+
+def load_engine(model_filepath, export_dir=None, predictor="fused", database_filepath=None, stage=None):
+    """ load the model and the settings needed to classify messages as in training
+    Input:
+    - model_filepath: pickle file created by train_classifier.py
+    - export_dir: export created by export_model.py (used instead of the pickle when given)
+    - predictor: "fused" (stacked coefficients of the pickled pipeline, see models/predictor.py) or "pipeline"
+    - database_filepath: training database, for the category names and length quantiles of models without them
+      (read with SQL aggregates, the messages are not loaded)
+    - stage: context manager factory timing the stages
+    Returns: InferenceEngine
+    """
+    # joblib (and scikit-learn when unpickling) is imported only to load a model
+    import joblib
+    from export_model import database_categories
+
+    filepath = export_dir or model_filepath
+    # the version is the one the artifact had before and after it was read: an artifact replaced meanwhile is
+    # read again, so the model is never stamped with the version of another artifact
+    for _ in range(LOAD_ATTEMPTS):
+        version = artifact_version(filepath)
+        if export_dir:
+            model = Predictor.load(export_dir)
+        else:
+            model = joblib.load(model_filepath)
+            if predictor == "fused":
+                model = Predictor.from_pipeline(model)
+        if artifact_version(filepath) == version:
+            break
+    else:
+        raise OSError("model {} changed while it was loaded ({} attempts)".format(filepath, LOAD_ATTEMPTS))
+    if isinstance(model, Predictor):
+        category_names, length_quantiles = model.categories, model.length_quantiles
+        n_categories = model.coef.shape[1]
+    else:
+        category_names = getattr(model, "category_names_", None)
+        length_quantiles = getattr(model, "length_quantiles_", None)
+        n_categories = len(getattr(model, "best_estimator_", model).named_steps["mo"].estimators_)
+
+    if category_names is None and database_filepath:
+        # train_classifier only retains categories with more than 50 positive values
+        category_names = database_categories(database_filepath, n_categories)
+    if length_quantiles is None and database_filepath:
+        # models trained before the quantiles were saved: same fit as train_classifier.load_data
+        length_quantiles = training_length_quantiles(database_filepath)
+    if category_names is None:
+        raise ValueError("category names of {} unknown: provide the training database".format(filepath))
+    return(InferenceEngine(model, category_names, length_quantiles, version=version, stage=stage))
@@ -0,0 +1,242 @@
+""" predictor
+
+    Lightweight predictor rebuilt from a model export (see export_model.py) or fused from the pickled GridSearchCV:
+    - vocabulary as a sorted array (binary search lookup), idf weights, genres and passthrough columns
+    - stacked coefficient matrix (n_features x n_categories) + intercepts of the per-category logistic regressions,
+      so a batch is scored with one sparse-dense product and a vectorized sigmoid instead of one product per category
+    Exported arrays are memory-mapped read-only, so loading takes milliseconds and forked workers share the pages.
+
+    Features are computed as the fitted ColumnTransformer does:
+    [tfidf('message') | onehot('genre') | passthrough columns ('len', 'question_mark', 'exclamation_mark')]
+
+Attributes:
+    Predictor: predict / predict_proba for DataFrames with the training input columns
+    compare_with_pipeline: maximum difference between the predictor and the pipeline it was built from
+"""
+
+import os
+import json
+import importlib
+import unicodedata
+
+import numpy as np
+from scipy import sparse
+from scipy.special import expit
+
+from features import FEATURE_COLUMNS, LengthQuantiles
+
+MANIFEST = "manifest.json"
+FORMAT_VERSION = 1
+
+
+def strip_accents_unicode(s):
+    """ remove accents as the vectorizer does for strip_accents="unicode" """
+    normalized = unicodedata.normalize('NFKD', s)
+    if normalized == s:
+        return(s)
+    return(''.join([c for c in normalized if not unicodedata.combining(c)]))
+
+
+def resolve_function(spec):
+    """ Returns: function referenced as "module:qualified_name" """
+    module_name, _, name = spec.partition(":")
+    return(getattr(importlib.import_module(module_name), name))
+
+
+class Predictor:
+    """ multi-category logistic regression on TF-IDF features, computed from plain arrays
+    Input:
+    - terms: sorted array with the vocabulary, term_index: column of every term in the TF-IDF block, idf: idf per column
+    - genres: genres of the onehot block, passthrough: names of the passthrough columns
+    - coef: (n_features x n_categories) coefficients, intercept: (n_categories) intercepts
+    - categories: name of every category (None when unknown)
+    - tokenizer: tokenizer of the vectorizer, sublinear_tf/norm/lowercase/strip_accents: vectorizer settings
+    - length_quantiles: LengthQuantiles of the training messages ("len" feature, None when unknown)
+    - manifest: export manifest (metadata)
+    """
+
+    def __init__(self, terms, term_index, idf, genres, passthrough, coef, intercept, categories=None,
+                 tokenizer=None, sublinear_tf=True, norm="l2", lowercase=True, strip_accents="unicode",
+                 length_quantiles=None, manifest=None):
+        self.terms = terms
+        self.term_index = term_index
+        self.idf = idf
+        self.genres = list(genres)
+        self.passthrough = list(passthrough)
+        self.coef = coef
+        self.intercept = intercept
+        self.categories = categories
+        self.tokenizer = tokenizer
+        self.sublinear_tf = sublinear_tf
+        self.norm = norm
+        self.lowercase = lowercase
+        self.strip_accents = strip_accents
+        self.length_quantiles = length_quantiles
+        self.manifest = manifest or {}
+        self._genre_index = {genre: i for i, genre in enumerate(self.genres)}
+
+    @classmethod
+    def load(cls, export_dir, mmap=True):
+        """ rebuild the predictor from an export directory
+        Input: directory written by export_model.py, mmap: memory-map the arrays (read-only) instead of reading them
+        Returns: Predictor
+        """
+        with open(os.path.join(export_dir, MANIFEST)) as f:
+            manifest = json.load(f)
+        if manifest.get("format_version") != FORMAT_VERSION:
+            raise ValueError("unsupported model export format: {}".format(manifest.get("format_version")))
+
+        def array(name):
+            return(np.load(os.path.join(export_dir, manifest["files"][name]), mmap_mode="r" if mmap else None))
+
+        vectorizer = manifest["tfidf"]
+        tokenizer = resolve_function(vectorizer["tokenizer"])
+        if vectorizer.get("tokenizer_state") is not None:
+            # tokenizer object (RegexTokenizer with its lemma table)
+            tokenizer = tokenizer.from_dict(vectorizer["tokenizer_state"])
+        length_quantiles = manifest.get("length_quantiles")
+        return(cls(array("terms"), array("term_index"), array("idf"), manifest["genres"], manifest["passthrough"],
+                   array("coef"), array("intercept"), categories=manifest.get("categories"),
+                   tokenizer=tokenizer, sublinear_tf=vectorizer["sublinear_tf"],
+                   norm=vectorizer["norm"], lowercase=vectorizer["lowercase"], strip_accents=vectorizer["strip_accents"],
+                   length_quantiles=LengthQuantiles.from_dict(length_quantiles) if length_quantiles else None,
+                   manifest=manifest))
+
+    @classmethod
+    def from_pipeline(cls, model, categories=None):
+        """ fuse the fitted pipeline: the coefficients of all category classifiers are stacked into one matrix
+        Input:
+        - model: fitted GridSearchCV (or Pipeline) with steps 'clmn' (ColumnTransformer) and 'mo' (MultiOutputClassifier)
+        - categories: category names (default: model.category_names_ as saved by train_classifier.py)
+        The length quantiles saved by train_classifier.py (model.length_quantiles_) are taken over.
+        Returns: Predictor (arrays in memory)
+        Raises: ValueError when the pipeline cannot be expressed with plain arrays
+        """
+        pipeline = getattr(model, "best_estimator_", model)
+        clmn, mo = pipeline.named_steps["clmn"], pipeline.named_steps["mo"]
+        tfidf = clmn.named_transformers_["tfidf"]
+        onehot = clmn.named_transformers_["onehot"]
+        # the idf settings live in the fitted TfidfTransformer (vectorizers pickled by older scikit-learn versions
+        # only have them there, with the idf weights as a diagonal matrix)
+        tfidf_transformer = tfidf._tfidf
+        if (tuple(tfidf.ngram_range) != (1, 1) or tfidf.analyzer != "word" or tfidf.preprocessor is not None
+                or tfidf.tokenizer is None or tfidf.binary or not tfidf_transformer.use_idf or tfidf.stop_words is not None):
+            raise ValueError("only word unigram vectorizers with idf and a custom tokenizer can be fused")
+        idf = tfidf_transformer.idf_ if hasattr(tfidf_transformer, "idf_") else tfidf_transformer._idf_diag.diagonal()
+        passthrough = []
+        for name, transformer, columns in clmn.transformers_:
+            if name == "remainder" and transformer == "passthrough":
+                passthrough = [FEATURE_COLUMNS[c] if isinstance(c, (int, np.integer)) else c for c in columns]
+
+        # vocabulary as a sorted array: the column of every term is kept separately
+        terms = np.array(sorted(tfidf.vocabulary_), dtype=str)
+        term_index = np.array([tfidf.vocabulary_[t] for t in terms], dtype=np.int32)
+        genres = [str(g) for g in onehot.categories_[0]]
+        # one column per category: (n_features x n_categories)
+        coef = np.ascontiguousarray(np.vstack([estimator.coef_[0] for estimator in mo.estimators_]).T)
+        intercept = np.array([estimator.intercept_[0] for estimator in mo.estimators_])
+        if coef.shape[0] != len(terms) + len(genres) + len(passthrough):
+            raise ValueError("feature layout does not match the coefficients of the model")
+
+        if categories is None:
+            categories = getattr(model, "category_names_", None)
+        return(cls(terms, term_index, np.asarray(idf, dtype=np.float64), genres, passthrough, coef, intercept,
+                   categories=list(categories) if categories is not None else None, tokenizer=tfidf.tokenizer,
+                   sublinear_tf=bool(tfidf_transformer.sublinear_tf), norm=tfidf_transformer.norm, lowercase=bool(tfidf.lowercase),
+                   strip_accents=tfidf.strip_accents, length_quantiles=getattr(model, "length_quantiles_", None)))
+
+    @property
+    def n_features(self):
+        return(self.coef.shape[0])
+
+    def preprocess(self, doc):
+        if self.lowercase:
+            doc = doc.lower()
+        if self.strip_accents == "unicode":
+            doc = strip_accents_unicode(doc)
+        return(doc)
+
+    def analyze(self, docs):
+        """ Returns: list with the tokens of every document (preprocessing + tokenizer, as the vectorizer) """
+        tokenize_series = getattr(self.tokenizer, "tokenize_series", None)
+        if tokenize_series is not None:
+            return(tokenize_series([self.preprocess(doc) for doc in docs]))
+        return([self.tokenizer(self.preprocess(doc)) for doc in docs])
+
+    def tfidf(self, token_lists):
+        """ TF-IDF block for tokenized documents
+        Input: list with the tokens of every document
+        Returns: csr matrix (n_documents x n_terms)
+        """
+        n_docs, n_terms = len(token_lists), len(self.idf)
+        lengths = np.fromiter((len(tokens) for tokens in token_lists), dtype=np.int64, count=n_docs)
+        # (the array gets the width of the longest token: a vocabulary-width dtype would truncate longer tokens)
+        flat = np.array([token for tokens in token_lists for token in tokens], dtype=str)
+
+        # vocabulary lookup by binary search, out-of-vocabulary tokens are dropped
+        position = np.searchsorted(self.terms, flat)
+        position[position == len(self.terms)] = 0
+        known = self.terms[position] == flat if len(flat) else np.zeros(0, dtype=bool)
+        rows = np.repeat(np.arange(n_docs), lengths)[known]
+        cols = self.term_index[position[known]]
+
+        # term counts (duplicates are summed), then sublinear tf, idf weighting and row normalization
+        tf = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(n_docs, n_terms))
+        tf.sum_duplicates()
+        if self.sublinear_tf:
+            np.log(tf.data, tf.data)
+            tf.data += 1
+        tf.data *= np.asarray(self.idf)[tf.indices]
+        if self.norm == "l2":
+            norms = np.sqrt(np.asarray(tf.multiply(tf).sum(axis=1)).ravel())
+            norms[norms == 0] = 1
+            tf.data /= np.repeat(norms, np.diff(tf.indptr))
+        elif self.norm == "l1":
+            norms = np.asarray(abs(tf).sum(axis=1)).ravel()
+            norms[norms == 0] = 1
+            tf.data /= np.repeat(norms, np.diff(tf.indptr))
+        return(tf)
+
+    def transform(self, X, token_lists=None):
+        """ feature matrix as produced by the fitted ColumnTransformer
+        Input: DataFrame with the training input columns, optionally the already tokenized messages
+        Returns: csr matrix (n_messages x n_features)
+        """
+        if token_lists is None:
+            token_lists = self.analyze(X["message"])
+        tfidf = self.tfidf(token_lists)
+        n_docs = len(X)
+
+        genre_cols = np.array([self._genre_index.get(genre, -1) for genre in X["genre"]], dtype=np.int64)
+        known = genre_cols >= 0 # unknown genres get no onehot column
+        onehot = sparse.csr_matrix((np.ones(known.sum()), (np.arange(n_docs)[known], genre_cols[known])),
+                                   shape=(n_docs, len(self.genres)))
+        passthrough = sparse.csr_matrix(X[self.passthrough].to_numpy(dtype=np.float64))
+        return(sparse.hstack([tfidf, onehot, passthrough], format="csr"))
+
+    def decision_function(self, X, features=None):
+        """ Returns: (n_messages x n_categories) scores of all categories with one sparse-dense product """
+        if features is None:
+            features = self.transform(X)
+        return(np.asarray(features @ self.coef) + self.intercept)
+
+    def predict_proba(self, X, features=None):
+        """ Returns: (n_messages x n_categories) probability of the positive class for every category """
+        return(expit(self.decision_function(X, features)))
+
+    def predict(self, X, features=None):
+        """ Returns: (n_messages x n_categories) 0/1 labels (positive when the score exceeds 0, as LogisticRegression) """
+        return((self.decision_function(X, features) > 0).astype(int))
+
+
+def compare_with_pipeline(predictor, model, X):
+    """ check that the predictor reproduces the pipeline it was built from
+    Input: Predictor, fitted pipeline (GridSearchCV or Pipeline), DataFrame with the training input columns
+    Returns: maximum absolute difference of the probabilities, number of differing labels
+    """
+    expected_proba = np.column_stack([p[:, 1] for p in model.predict_proba(X)])
+    expected_labels = model.predict(X)
+    features = predictor.transform(X)
+    proba = predictor.predict_proba(X, features)
+    labels = predictor.predict(X, features)
+    return(float(np.abs(proba - expected_proba).max()) if proba.size else 0.0, int((labels != expected_labels).sum()))
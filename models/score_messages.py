@@ -0,0 +1,257 @@
+""" score_messages
+
+    Offline bulk scoring: streams messages in fixed-size chunks through the trained model and writes the
+    category labels and probabilities incrementally, so archives of any size are scored with bounded memory.
+    - input: CSV file, NDJSON file (.ndjson / .jsonl) or table of a SQLite database (.db / .sqlite)
+      with a "message" column and optionally "id" and "genre" (default "direct")
+    - chunks are scored in parallel worker processes (feature construction + prediction), at most
+      two chunks per worker are in flight and results are written in input order; the model is loaded once
+      before the pool starts and shared by the forked workers (copy on write)
+    - output: CSV, NDJSON or SQLite table with id, genre, one label column per category and one
+      "<category>_probability" column per category
+
+    to run: python models/score_messages.py archive.csv scores.csv --model models/DisasterResponse.pkl
+            python models/score_messages.py data/DisasterResponse.db scores.db --workers 8 --chunksize 20000
+
+Attributes:
+    input file / database, output file / database
+    --model: pickle file created by train_classifier.py (default models/DisasterResponse.pkl next to this script)
+    --table / --output-table: SQLite input table (default DisasterMessages) and output table (default MessageScores)
+    --chunksize: number of messages per chunk (default 10000)
+    --workers: number of worker processes (default: number of cores, 1: score in this process)
+    --predictor: "fused" (default, stacked coefficients, see predictor.py) or "pipeline" (the pickled pipeline)
+    --database: training database, for the category names and message length quantiles of models that do not carry them
+    Genres must be one of direct, news, social (default direct): other values stop the run before they are scored.
+
+Output:
+    Scores written chunk by chunk + progress (messages, messages/sec) per chunk
+"""
+
+# import libraries
+import os
+import sys
+import time
+import sqlite3
+import argparse
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+# models pickled by train_classifier.py as a script refer to __main__.tokenize
+from tokenizer import tokenize
+from inference import load_engine, check_genres
+
+DEFAULT_MODEL = os.path.join(os.path.dirname(os.path.abspath(__file__)), "DisasterResponse.pkl")
+SQLITE_EXTENSIONS = (".db", ".sqlite", ".sqlite3")
+NDJSON_EXTENSIONS = (".ndjson", ".jsonl")
+
+# model of the worker processes (loaded before the pool is forked, or by init_worker)
+_engine = None
+
+
+def file_format(filepath):
+    """ Returns: "sqlite", "ndjson" or "csv" depending on the file extension """
+    extension = os.path.splitext(filepath)[1].lower()
+    if extension in SQLITE_EXTENSIONS:
+        return("sqlite")
+    if extension in NDJSON_EXTENSIONS:
+        return("ndjson")
+    return("csv")
+
+
+def checked_chunk(chunk):
+    """ Returns: chunk with missing genres set to "direct"
+    Raises: ValueError when a genre is unknown to the model
+    """
+    chunk = chunk.assign(genre=chunk["genre"].fillna("direct"))
+    try:
+        check_genres(chunk["genre"])
+    except ValueError as err:
+        raise ValueError("{} (messages with id {} to {})".format(err, chunk["id"].iloc[0], chunk["id"].iloc[-1]))
+    return(chunk)
+
+
+def read_chunks(filepath, chunksize, table="DisasterMessages"):
+    """ stream the messages to score
+    Input: CSV / NDJSON file or SQLite database, number of messages per chunk, table of the database
+    Returns: generator of DataFrames with columns id, message and genre (validated, see checked_chunk)
+    """
+    fmt = file_format(filepath)
+    if fmt == "sqlite":
+        connection = sqlite3.connect("file:{}?mode=ro".format(filepath), uri=True)
+        try:
+            columns = [row[1] for row in connection.execute('PRAGMA table_info("{}")'.format(table))]
+            if "message" not in columns:
+                raise ValueError('table "{}" of {} has no message column'.format(table, filepath))
+            query = 'SELECT {}, message, {} FROM "{}"'.format(
+                "id" if "id" in columns else "rowid", "genre" if "genre" in columns else "'direct'", table)
+            cursor = connection.execute(query)
+            while True:
+                rows = cursor.fetchmany(chunksize)
+                if not rows:
+                    break
+                yield checked_chunk(pd.DataFrame(rows, columns=["id", "message", "genre"]))
+        finally:
+            connection.close()
+        return
+
+    if fmt == "ndjson":
+        reader = pd.read_json(filepath, lines=True, chunksize=chunksize, dtype=False)
+    else:
+        reader = pd.read_csv(filepath, chunksize=chunksize, usecols=lambda c: c in ("id", "message", "genre"))
+    start = 0
+    with reader:
+        for chunk in reader:
+            if "message" not in chunk.columns:
+                raise ValueError("{} has no message column".format(filepath))
+            if "id" not in chunk.columns:
+                chunk["id"] = np.arange(start, start + len(chunk))
+            if "genre" not in chunk.columns:
+                chunk["genre"] = "direct"
+            start += len(chunk)
+            yield checked_chunk(chunk[["id", "message", "genre"]])
+
+
+def init_worker(model_filepath, predictor, database_filepath):
+    global _engine
+    if _engine is None:
+        _engine = load_engine(model_filepath, predictor=predictor, database_filepath=database_filepath)
+
+
+def score_chunk(chunk):
+    """ score a chunk in a worker process
+    Returns: ids, genres, labels, probabilities
+    """
+    labels, probabilities = _engine.classify(chunk["message"].tolist(), chunk["genre"].tolist())
+    return(chunk["id"].to_numpy(), chunk["genre"].to_numpy(), labels.astype(np.int8), probabilities)
+
+
+def scores_frame(ids, genres, labels, probabilities, category_names):
+    """ Returns: DataFrame with id, genre, a label column and a "<category>_probability" column per category """
+    df = pd.DataFrame({"id": ids, "genre": genres})
+    df = pd.concat([df,
+                    pd.DataFrame(labels, columns=category_names),
+                    pd.DataFrame(np.round(probabilities, 6), columns=[c + "_probability" for c in category_names])],
+                   axis=1)
+    return(df)
+
+
+class ScoreWriter:
+    """ append scored chunks to a CSV / NDJSON file or a SQLite table (replaced by the first chunk)
+    Input: output filepath, table for SQLite output
+    """
+
+    def __init__(self, filepath, table="MessageScores"):
+        self.filepath = filepath
+        self.table = table
+        self.format = file_format(filepath)
+        self.n_chunks = 0
+        self._connection = None
+        self._file = None
+
+    def write(self, df):
+        if self.format == "sqlite":
+            if self._connection is None:
+                self._connection = sqlite3.connect(self.filepath)
+                self._connection.execute("PRAGMA journal_mode=WAL")
+                self._connection.execute("PRAGMA synchronous=NORMAL")
+            df.to_sql(self.table, self._connection, if_exists="replace" if self.n_chunks == 0 else "append", index=False)
+            self._connection.commit()
+        else:
+            if self._file is None:
+                self._file = open(self.filepath, "w", newline="" if self.format == "csv" else None, encoding="utf-8")
+            if self.format == "csv":
+                df.to_csv(self._file, header=self.n_chunks == 0, index=False)
+            else:
+                records = df.to_json(orient="records", lines=True, force_ascii=False)
+                # (depending on the pandas version the last record ends with a newline or not)
+                self._file.write(records if not records or records.endswith("\n") else records + "\n")
+            self._file.flush()
+        self.n_chunks += 1
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+        if self._file is not None:
+            self._file.close()
+
+
+def parse_args(argv):
+    """ parse the command line: input, output and the optional settings
+    Returns: argparse.Namespace
+    """
+    parser = argparse.ArgumentParser(
+        description='Score messages in bulk with the trained disaster message classifier.',
+        epilog='Example: python score_messages.py archive.csv scores.csv --model DisasterResponse.pkl --workers 8')
+    parser.add_argument('input_filepath', help='CSV, NDJSON (.ndjson/.jsonl) or SQLite database (.db/.sqlite) with a message column')
+    parser.add_argument('output_filepath', help='CSV, NDJSON or SQLite database to write the scores to')
+    parser.add_argument('--model', default=DEFAULT_MODEL, help='pickle file created by train_classifier.py')
+    parser.add_argument('--table', default='DisasterMessages', help='table of a SQLite input')
+    parser.add_argument('--output-table', default='MessageScores', help='table of a SQLite output (replaced)')
+    parser.add_argument('--chunksize', type=int, default=10000, help='number of messages per chunk')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='number of worker processes (1: no pool)')
+    parser.add_argument('--predictor', choices=['fused', 'pipeline'], default='fused',
+                        help='score with the stacked coefficients (fused) or the pickled pipeline')
+    parser.add_argument('--database', default=None,
+                        help='training database (category names / length quantiles of models that do not carry them)')
+    return(parser.parse_args(argv))
+
+
+def main():
+    """ stream the input in chunks through the model (in parallel) and write the scores chunk by chunk """
+    args = parse_args(sys.argv[1:])
+
+    print('Loading model...\n    MODEL: {}'.format(args.model))
+    # loaded before the pool is created: forked worker processes share the model pages (copy on write)
+    global _engine
+    _engine = load_engine(args.model, predictor=args.predictor, database_filepath=args.database)
+    category_names = _engine.category_names
+    if _engine.length_quantiles is None:
+        print('    message length quantiles unknown (provide --database): "len" is set to 0.2')
+    if args.workers > 1 and multiprocessing.get_start_method() != "fork":
+        # worker processes that are not forked load their own model (init_worker): the copy here is not needed
+        _engine = None
+
+    print('Scoring messages...\n    INPUT: {}\n    OUTPUT: {}\n    WORKERS: {}, CHUNKS: {} messages'
+          .format(args.input_filepath, args.output_filepath, args.workers, args.chunksize))
+    writer = ScoreWriter(args.output_filepath, args.output_table)
+    start = time.perf_counter()
+    n_messages = 0
+
+    def write(result):
+        nonlocal n_messages
+        writer.write(scores_frame(*result, category_names))
+        n_messages += len(result[0])
+        elapsed = time.perf_counter() - start
+        print('    chunk {}: {} messages scored in {:.1f}s ({:.0f} messages/sec)'
+              .format(writer.n_chunks, n_messages, elapsed, n_messages / elapsed))
+
+    try:
+        chunks = read_chunks(args.input_filepath, args.chunksize, args.table)
+        if args.workers <= 1:
+            for chunk in chunks:
+                write(score_chunk(chunk))
+        else:
+            with ProcessPoolExecutor(args.workers, initializer=init_worker,
+                                     initargs=(args.model, args.predictor, args.database)) as executor:
+                # bounded number of chunks in flight, written in input order
+                pending = deque()
+                for chunk in chunks:
+                    pending.append(executor.submit(score_chunk, chunk))
+                    if len(pending) >= 2 * args.workers:
+                        write(pending.popleft().result())
+                while pending:
+                    write(pending.popleft().result())
+    finally:
+        writer.close()
+
+    elapsed = time.perf_counter() - start
+    print('    {} messages scored in {:.1f}s: {:.0f} messages/sec'.format(n_messages, elapsed, n_messages / elapsed if elapsed else 0))
+    print('Scores saved!')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+""" token_cache
+
+    Persistent cache of tokenized messages, stored in the table "MessageTokens" next to "DisasterMessages".
+    Every entry is keyed by the message id and the tokenizer backend ("nltk", "regex": switching backends keeps the
+    tokens of both) and holds a hash of the message content + tokenizer version, so only new or changed messages
+    are tokenized again and retrains on an unchanged corpus skip tokenization.
+
+    Tokens are stored space separated: the TF-IDF vectorizer reads them back with tokenizer.split_tokens.
+
+    The lemma table of the regex tokenizer is kept in the table "LemmaTable" and only extended with the words of
+    new training messages; every extension is a new generation of the table. The regex tokens of a message are
+    tokenized again only when it contains a word that was added to the table after they were cached (tokens
+    without lemma are the word itself), not whenever the table changes.
+
+Attributes:
+    TOKEN_TABLE: name of the cache table
+    LEMMA_TABLE: name of the table with the WordNet lemma of every training word looked up so far
+"""
+
+import hashlib
+import sqlite3
+
+import pandas as pd
+
+from tokenizer import TOKENIZER_VERSION, tokenize_batch, corpus_vocabulary, lemmatize
+
+TOKEN_TABLE = "MessageTokens"
+LEMMA_TABLE = "LemmaTable"
+TOKEN_COLUMNS = ("id", "backend", "hash", "tokens", "generation")
+LEMMA_COLUMNS = ("word", "lemma", "generation")
+
+
+def message_hash(message, version=TOKENIZER_VERSION):
+    """ Returns: hex digest identifying the message content for a tokenizer version """
+    return(hashlib.sha1((version + "\0" + message).encode("utf-8")).hexdigest())
+
+
+def create_table(connection, table, columns, definition):
+    """ create a table of the cache, replacing a table with other columns (written by an earlier version) """
+    existing = tuple(row[1] for row in connection.execute('PRAGMA table_info("{}")'.format(table)))
+    if existing and existing != columns:
+        with connection:
+            connection.execute('DROP TABLE "{}"'.format(table))
+    connection.execute('CREATE TABLE IF NOT EXISTS "{}" ({})'.format(table, definition))
+
+
+def lemma_generation(connection):
+    """ Returns: generation of the lemma table (0 when empty), dict word -> generation of the words with a lemma """
+    create_table(connection, LEMMA_TABLE, LEMMA_COLUMNS,
+                 'word TEXT PRIMARY KEY, lemma TEXT NOT NULL, generation INTEGER NOT NULL')
+    generation = connection.execute('SELECT MAX(generation) FROM "{}"'.format(LEMMA_TABLE)).fetchone()[0] or 0
+    added = dict(connection.execute('SELECT word, generation FROM "{}" WHERE lemma != word'.format(LEMMA_TABLE)))
+    return(generation, added)
+
+
+def load_tokens(database_filepath, messages, preprocess=None, tokenize_fn=tokenize_batch, version=TOKENIZER_VERSION,
+                backend="nltk", lemma_table=False):
+    """ return the tokens for every message, tokenizing (and caching) only the messages that are not cached yet
+    Input:
+    - database_filepath: SQLite database that holds the cache table
+    - messages: Series with the message text, indexed by message id
+    - preprocess: function applied to the text before tokenization (e.g. the vectorizer's preprocessor)
+    - tokenize_fn: function that tokenizes a list of texts
+    - version: version of the tokens produced by tokenize_fn (TOKENIZER_VERSION or RegexTokenizer.version)
+    - backend: tokenizer backend, part of the key of the cached tokens
+    - lemma_table: tokenize_fn looks up the lemmas in LEMMA_TABLE (regex backend): tokens cached before a word of
+      the message was added to the table are tokenized again
+    Returns: Series (same index as messages) with the space separated tokens of every message, number of messages tokenized
+    """
+    hashes = [message_hash(m, version) for m in messages]
+
+    connection = sqlite3.connect(database_filepath)
+    try:
+        create_table(connection, TOKEN_TABLE, TOKEN_COLUMNS,
+                     'id INTEGER NOT NULL, backend TEXT NOT NULL, hash TEXT NOT NULL, tokens TEXT NOT NULL, '
+                     'generation INTEGER NOT NULL, PRIMARY KEY (id, backend)')
+        generation, added = lemma_generation(connection) if lemma_table else (0, {})
+        cached = {row[0]: row[1:] for row in connection.execute(
+            'SELECT id, hash, tokens, generation FROM "{}" WHERE backend = ?'.format(TOKEN_TABLE), (backend,))}
+
+        tokens = []
+        stale = []
+        for position, (message_id, digest) in enumerate(zip(messages.index, hashes)):
+            entry = cached.get(int(message_id))
+            if (entry is not None and entry[0] == digest
+                    and (entry[2] >= generation or all(added.get(t, 0) <= entry[2] for t in entry[1].split()))):
+                tokens.append(entry[1])
+            else:
+                tokens.append(None)
+                stale.append(position)
+
+        if stale:
+            texts = [messages.iloc[p] for p in stale]
+            if preprocess is not None:
+                texts = [preprocess(t) for t in texts]
+            rows = []
+            for position, doc_tokens in zip(stale, tokenize_fn(texts)):
+                tokens[position] = " ".join(doc_tokens)
+                rows.append((int(messages.index[position]), backend, hashes[position], tokens[position], generation))
+            with connection:
+                connection.executemany('INSERT OR REPLACE INTO "{}" (id, backend, hash, tokens, generation) VALUES (?, ?, ?, ?, ?)'
+                                       .format(TOKEN_TABLE), rows)
+    finally:
+        connection.close()
+
+    return(pd.Series(tokens, index=messages.index, name=messages.name), len(stale))
+
+
+def load_lemma_table(database_filepath, texts):
+    """ lemma table of RegexTokenizer, extended with the words of a corpus that have not been looked up yet
+    (words are never changed or removed: the table only grows when the training messages bring new words)
+    Input:
+    - database_filepath: SQLite database that holds the lemma table
+    - texts: iterable of documents (the training messages, preprocessed as for the vectorizer)
+    Returns: dict token -> lemma for the tokens that are not their own lemma (see tokenizer.build_lemma_table),
+    number of words looked up
+    """
+    vocabulary = corpus_vocabulary(texts)
+
+    connection = sqlite3.connect(database_filepath)
+    try:
+        generation, _ = lemma_generation(connection)
+        lemmas = dict(connection.execute('SELECT word, lemma FROM "{}"'.format(LEMMA_TABLE)))
+        rows = [(word, lemmatize(word), generation + 1) for word in sorted(vocabulary.difference(lemmas))]
+        if rows:
+            with connection:
+                connection.executemany('INSERT INTO "{}" (word, lemma, generation) VALUES (?, ?, ?)'.format(LEMMA_TABLE), rows)
+        lemmas.update((word, lemma) for word, lemma, _ in rows)
+    finally:
+        connection.close()
+
+    return({word: lemma for word, lemma in lemmas.items() if lemma != word}, len(rows))
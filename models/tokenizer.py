@@ -0,0 +1,157 @@
+""" tokenizer
+
+    Shared tokenizer for the training pipeline (train_classifier.py) and the web application (app/run.py).
+    Two backends:
+    - "nltk" (tokenize): NLTK word_tokenize (Punkt + Treebank). The NLTK resources (stopwords + punctuation,
+      WordNet lemmatizer) are built once per process and per-token lemmatization is memoized in a bounded LRU cache.
+    - "regex" (RegexTokenizer): words matched by a compiled regex, documents processed as a whole pandas Series,
+      lemmas looked up in a table built with WordNet from the training vocabulary (build_lemma_table; kept in the
+      database between retrains by token_cache.py).
+      The stopwords and the lemma table are part of the (picklable) tokenizer: serving needs no NLTK data.
+    NLTK and pandas are imported on first use: importing this module (e.g. by the web application for
+    unpickling) stays cheap.
+
+Attributes:
+    LEMMA_CACHE_SIZE: maximum number of memoized lemmas (env variable TOKENIZER_LEMMA_CACHE, default 100000)
+    TOKENIZER_VERSION: identifies the token output of tokenize, part of the key of cached tokens (token_cache.py)
+    TOKENIZER_BACKEND: backend used for training (env variable TOKENIZER_BACKEND, "nltk" or "regex", default "nltk")
+"""
+
+import os
+import re
+import json
+import string
+import hashlib
+from functools import lru_cache
+
+LEMMA_CACHE_SIZE = int(os.environ.get("TOKENIZER_LEMMA_CACHE", 100000))
+# change whenever tokenize produces different tokens for the same text, so cached tokens are not reused
+TOKENIZER_VERSION = "nltk-1"
+# same rule for the regex backend (the stopwords are part of RegexTokenizer.version)
+REGEX_TOKENIZER_VERSION = "regex-1"
+TOKENIZER_BACKENDS = ("nltk", "regex")
+TOKENIZER_BACKEND = os.environ.get("TOKENIZER_BACKEND", "nltk")
+# word characters: punctuation never becomes a token
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+@lru_cache(maxsize=None)
+def stop_words():
+    """ Returns: frozenset with the English stopwords and punctuation characters (loaded once) """
+    from nltk.corpus import stopwords
+    return(frozenset(stopwords.words('english') + list(string.punctuation)))
+
+
+@lru_cache(maxsize=None)
+def lemmatizer():
+    """ Returns: the WordNetLemmatizer shared by all calls (created once) """
+    from nltk.stem import WordNetLemmatizer
+    return(WordNetLemmatizer())
+
+
+@lru_cache(maxsize=None)
+def word_tokenizer():
+    """ Returns: nltk.word_tokenize (NLTK imported on the first call) """
+    import nltk
+    return(nltk.word_tokenize)
+
+
+@lru_cache(maxsize=LEMMA_CACHE_SIZE)
+def lemmatize(word):
+    """ lemmatize a single token, memoized as the vocabulary of messages is highly repetitive
+    Input: token
+    Returns: lemma
+    """
+    return(lemmatizer().lemmatize(word))
+
+
+def tokenize(text):
+    """ tokenize, convert text to lowercase, remove stopwords and punctuation and lemmatize
+    Input: text string
+    Returns: list of tokens
+    """
+    stop = stop_words()
+    return([lemmatize(w) for w in word_tokenizer()(text.lower()) if w not in stop])
+
+
+def tokenize_batch(texts):
+    """ tokenize a list of documents
+    Input: iterable of text strings
+    Returns: list with the list of tokens for every document
+    """
+    stop = stop_words()
+    word_tokenize = word_tokenizer()
+    return([[lemmatize(w) for w in word_tokenize(text.lower()) if w not in stop] for text in texts])
+
+
+def split_tokens(text):
+    """ tokenizer for documents that have been tokenized before (space separated tokens, see token_cache.py)
+    Input: text string
+    Returns: list of tokens
+    """
+    return(text.split())
+
+
+def regex_words(texts):
+    """ Returns: list with the lowercase regex matches of every document (vectorized over a pandas Series) """
+    import pandas as pd
+    return(pd.Series(texts, dtype=object).str.lower().str.findall(TOKEN_PATTERN).tolist())
+
+
+def corpus_vocabulary(texts):
+    """ Returns: set with the regex words of a corpus (stopwords removed) """
+    vocabulary = set()
+    for words in regex_words(list(texts)):
+        vocabulary.update(words)
+    return(vocabulary - stop_words())
+
+
+def build_lemma_table(texts):
+    """ WordNet lemmas of the vocabulary of a corpus, for RegexTokenizer
+    Input: iterable of documents (the training messages)
+    Returns: dict token -> lemma for the tokens that are not their own lemma
+    """
+    table = {}
+    for word in sorted(corpus_vocabulary(texts)):
+        lemma = lemmatize(word)
+        if lemma != word:
+            table[word] = lemma
+    return(table)
+
+
+class RegexTokenizer:
+    """ tokenizer of the "regex" backend: lowercase, regex words, stopwords removed, lemmas from a lookup table
+    (tokens missing from the table are kept as they are)
+    Input: dict token -> lemma (see build_lemma_table), stopwords (default: NLTK stopwords + punctuation)
+    """
+
+    def __init__(self, lemmas=None, stop=None):
+        self.lemmas = dict(lemmas or {})
+        self.stop = frozenset(stop if stop is not None else stop_words())
+        digest = hashlib.sha1(json.dumps(sorted(self.stop)).encode("utf-8")).hexdigest()
+        # part of the key of cached tokens (token_cache.py): other stopwords give other tokens (the lemma table only
+        # grows, the token cache tracks the words added to it)
+        self.version = "{}-{}".format(REGEX_TOKENIZER_VERSION, digest[:12])
+
+    def __call__(self, text):
+        lemmas, stop = self.lemmas, self.stop
+        return([lemmas.get(w, w) for w in TOKEN_PATTERN.findall(text.lower()) if w not in stop])
+
+    def tokenize_series(self, texts):
+        """ tokenize a whole Series (or list) of documents
+        Returns: list with the list of tokens for every document
+        """
+        lemmas, stop = self.lemmas, self.stop
+        return([[lemmas.get(w, w) for w in words if w not in stop] for words in regex_words(texts)])
+
+    def to_dict(self):
+        return({"lemmas": self.lemmas, "stop": sorted(self.stop)})
+
+    @classmethod
+    def from_dict(cls, d):
+        return(cls(d["lemmas"], d["stop"]))
+
+
+def cache_info():
+    """ Returns: hits, misses, maxsize and currsize of the lemma cache """
+    return(lemmatize.cache_info())
@@ -1,15 +1,24 @@
 """ train_classifier
 
     Machine Learning Pipeline:
-    - Split the data into a training set and a test set. 
+    - Split the data into a training set and a test set (random 80/20 split, or with --split holdout the messages
+      with an id divisible by 5, the same held-out messages as update_classifier.py).
     - Machine learning pipeline uses NLTK, as well as scikit-learn's Pipeline and GridSearchCV
     - Final model that uses the message column to predict classifications for 36 categories (multi-output classification). 
 
     to run: python models/train_classifier.py data/DisasterResponse.db models/classifier.pkl
+            python models/train_classifier.py data/DisasterResponse.db models/classifier.pkl --n-jobs 32 --cache-dir .cache
 
 Attributes:
     name of database that includes messages + categories
     name of model file (pickle format) to be created
+    --n-jobs: number of worker processes for the CV candidates/folds (default 1, -1: all cores)
+    --cache-dir: directory in which tokenized/TF-IDF transformed folds are cached (default: temporary directory for this run)
+    --no-token-cache: tokenize all messages instead of reusing the tokens cached in the database (table MessageTokens)
+    --tokenizer: "nltk" (NLTK word_tokenize) or "regex" (compiled regex + WordNet lemma table of the training vocabulary,
+      see tokenizer.py), default env variable TOKENIZER_BACKEND or "nltk"
+    --split: "random" (default, 20% test set drawn at random) or "holdout" (test set: messages with an id divisible
+      by 5, for models compared with update_classifier.py)
 
 Input:
     DisasterResponse.db (cleaned and merged messages + categories stored in SQLite database)
@@ -20,13 +29,14 @@ Output:
 
 # import libraries
 import sys
+import time
+import shutil
+import argparse
+import tempfile
+from contextlib import contextmanager
 import pandas as pd
 import numpy as np
-import nltk
-import string
-from nltk.corpus import stopwords
 from sqlalchemy import create_engine
-from nltk.stem import WordNetLemmatizer
 import sqlite3
 from sklearn import model_selection
 from sklearn.model_selection import train_test_split
@@ -37,66 +47,169 @@ from sklearn.metrics import classification_report
 from sklearn.multioutput import MultiOutputClassifier
 from sklearn.compose import ColumnTransformer
 from sklearn.preprocessing import OneHotEncoder
-from sklearn.preprocessing import QuantileTransformer
 import pickle
+from tokenizer import tokenize, split_tokens, tokenize_batch, TOKENIZER_VERSION, TOKENIZER_BACKEND, TOKENIZER_BACKENDS
+from tokenizer import RegexTokenizer, build_lemma_table
+from token_cache import load_tokens, load_lemma_table
+from features import FEATURE_COLUMNS, LengthQuantiles
 
-def load_data(database_filepath):
+# messages with an id divisible by HOLDOUT_MODULO are the held-out messages of update_classifier.py and the test set
+# of train_classifier.py --split holdout: neither model is trained on them, so both are compared on unseen messages
+HOLDOUT_MODULO = 5
+SPLITS = ("random", "holdout")
+
+
+def load_data(database_filepath, where=None, length_quantiles=None, category_names=None):
+    """ load the messages and categories
+    Input:
+    - database_filepath: database with the DisasterMessages table
+    - where: SQL condition on the rows to load (default: all)
+    - length_quantiles: LengthQuantiles of the "len" feature (default: fitted on the loaded messages)
+    - category_names: categories of Y (default: the categories with more than 50 positive values)
+    Returns: X (indexed by message id), Y, category names, LengthQuantiles
+    """
     # load data from the specified database: all records from DisasterMessages table to df DataFrame
     database_url = "sqlite:///"+database_filepath
     engine = create_engine(database_url)
     connection = engine.connect()
     query = "SELECT * FROM DisasterMessages"
+    if where:
+        query += " WHERE " + where
     df = pd.read_sql(query, connection)
     connection.close()
 
     # Load X: "message" field + calculated fields "message_length", "question_mark" and "exclamation mark"
-    qt = QuantileTransformer(n_quantiles=10, random_state=0)
     df["message_length"] = df["message"].str.len()
-    df["len"] = qt.fit_transform(df[["message_length"]])
+    # fitted once: saved with the model so that serving computes "len" as in training
+    if length_quantiles is None:
+        length_quantiles = LengthQuantiles.fit(df["message_length"])
+    df["len"] = length_quantiles.transform(df["message_length"])
     df["question_mark"] = 0
     df["exclamation_mark"] = 0
     df.loc[df['message'].str.contains('\?'),"question_mark"] = 1
     df.loc[df['message'].str.contains('\!'),"exclamation_mark"] = 1
-    X = df[["message","genre","len","question_mark","exclamation_mark"]]
+    X = df.set_index("id")[FEATURE_COLUMNS]
 
     # Load Y: 36 category columns mu
     N_CATEGORIES = 36 #number of category columns
     df_y = df.iloc[:,-N_CATEGORIES-4:-4]
-    df_y_sufficient_data =  df_y.loc[:,(df_y.sum(axis=0) > 50)] #only retain those columns that have more than 50 positive values
+    if category_names is not None:
+        df_y_sufficient_data = df_y.reindex(columns=category_names, fill_value=0)
+    else:
+        df_y_sufficient_data =  df_y.loc[:,(df_y.sum(axis=0) > 50)] #only retain those columns that have more than 50 positive values
     Y = df_y_sufficient_data.values
     N_CATEGORIES = df_y_sufficient_data.shape[1]
 
     category_names = df_y_sufficient_data.columns.tolist()
     
-    return(X, Y, category_names)
+    return(X, Y, category_names, length_quantiles)
+
+@contextmanager
+def timed(stage):
+    """ print the wall clock time spent in a stage of the training process
+    Input: name of the stage
+    """
+    start = time.perf_counter()
+    yield
+    print('    {}: {:.1f}s'.format(stage, time.perf_counter() - start))
+
+
+def holdout_split(X, Y):
+    """ split into training and test set by message id (test set: id divisible by HOLDOUT_MODULO, ~20%)
+    Input: X indexed by message id, Y
+    Returns: X_train, X_test, Y_train, Y_test
+    """
+    test = np.asarray(X.index % HOLDOUT_MODULO == 0)
+    return(X[~test], X[test], Y[~test], Y[test])
+
 
-def tokenize(text):
-    """ tokenize, convert text to lowercase, remove stopwords and punctuation and lemmatize
-    Input: text string
-    Returns: list of tokens
+def split_data(X, Y, split="random"):
+    """ split into training and test set
+    Input: X indexed by message id, Y, "random" (20% test set drawn at random) or "holdout" (see holdout_split)
+    Returns: X_train, X_test, Y_train, Y_test
     """
-    stop = set(stopwords.words('english') + list(string.punctuation))
-    nltk_tokens = nltk.word_tokenize(text.lower())
-    tokens = [w for w in nltk_tokens if not w in stop]
-    lemmatizer = WordNetLemmatizer()
-    tokens = [lemmatizer.lemmatize(w) for w in tokens]
-    return(tokens)
-
-def build_model():
+    if split == "holdout":
+        return(holdout_split(X, Y))
+    return(train_test_split(X, Y, test_size=0.2))
+
+
+def vectorizer_preprocessor():
+    """ Returns: preprocessing the vectorizer applies to a message before calling the tokenizer """
+    return(TfidfVectorizer(strip_accents="unicode").build_preprocessor())
+
+
+def build_tokenizer(backend, messages, database_filepath=None):
+    """ create the tokenizer of a backend
+    Input:
+    - "nltk" or "regex"
+    - training messages (the lemma table of the regex backend covers their vocabulary, not the test messages')
+    - database_filepath: database that keeps the lemma table between runs (see token_cache.load_lemma_table),
+      None: table built from the messages alone
+    Returns: tokenizer function / object
+    """
+    if backend == "regex":
+        preprocess = vectorizer_preprocessor()
+        texts = (preprocess(m) for m in messages)
+        if database_filepath is None:
+            return(RegexTokenizer(build_lemma_table(texts)))
+        lemmas, n_new = load_lemma_table(database_filepath, texts)
+        print('    lemma table: {} entries, {} new words looked up'.format(len(lemmas), n_new))
+        return(RegexTokenizer(lemmas))
+    return(tokenize)
+
+
+def pretokenize(X, database_filepath, tokenizer=tokenize):
+    """ replace the messages by their (cached) tokens so that the vectorizer does not tokenize them again
+    Input: X as returned by load_data (indexed by message id), database with the token cache, tokenizer (see build_tokenizer)
+    Returns: copy of X with the space separated tokens in the "message" column
+    """
+    # the tokens are derived from the text as the vectorizer would pass it to the tokenizer
+    preprocess = vectorizer_preprocessor()
+    if isinstance(tokenizer, RegexTokenizer):
+        # the lemma table of the tokenizer is the one kept in the database (see build_tokenizer)
+        tokens, n_tokenized = load_tokens(database_filepath, X["message"], preprocess=preprocess,
+                                          tokenize_fn=tokenizer.tokenize_series, version=tokenizer.version,
+                                          backend="regex", lemma_table=True)
+    else:
+        tokens, n_tokenized = load_tokens(database_filepath, X["message"], preprocess=preprocess,
+                                          tokenize_fn=tokenize_batch, version=TOKENIZER_VERSION, backend="nltk")
+    print('    tokenized {} of {} messages, {} read from the token cache'.format(n_tokenized, len(X), len(X) - n_tokenized))
+    X = X.copy()
+    X["message"] = tokens
+    return(X)
+
+
+def restore_tokenizer(model, tokenizer=tokenize):
+    """ let the fitted vectorizer of a model trained on pretokenized messages tokenize raw messages again
+    Input: fitted GridSearchCV, tokenizer that produced the tokens
+    """
+    pipeline = model.best_estimator_
+    pipeline.set_params(clmn__tfidf__tokenizer=tokenizer)
+    pipeline.named_steps['clmn'].named_transformers_['tfidf'].tokenizer = tokenizer
+    return
+
+
+def build_model(n_jobs=None, cache_dir=None, tokenizer=tokenize):
     """ define the model:
     Input: "Message", "Genre", "message_length" (quantile transformed), "question_mark", "exclamation_mark"
     - apply tfidf to 'message'
     - apply onehot encoding for 'genre'
     - apply Logistic Regression against each of the categories
+    Parameters:
+    - n_jobs: number of parallel workers for the CV candidates/folds (None: sequential); the categories are fitted
+      sequentially within a worker, so that at most n_jobs processes compete for the cores
+    - cache_dir: directory to cache the fitted ColumnTransformer (tokenization + TF-IDF) so that candidates
+      with the same min_df share the transformed folds (None: no caching)
+    - tokenizer: tokenizer of the vectorizer (split_tokens for pretokenized messages)
     Returns: model with optimized min_df (tfidf) and C (Logistic Regression)
     """
  
-    tfidf_vectorizer = TfidfVectorizer(tokenizer=tokenize, strip_accents="unicode", sublinear_tf=True)
+    tfidf_vectorizer = TfidfVectorizer(tokenizer=tokenizer, strip_accents="unicode", sublinear_tf=True)
     # onehot = OneHotEncoder(drop="first") # remove as this option is not recognized with the version used by Udacity
     onehot = OneHotEncoder()
     clmn = ColumnTransformer([("tfidf", tfidf_vectorizer, "message"),("onehot", onehot, ["genre"])], remainder="passthrough")
     mo = MultiOutputClassifier(LogisticRegression(solver="liblinear"))
-    pipeline = Pipeline([('clmn', clmn), ('mo', mo)])
+    pipeline = Pipeline([('clmn', clmn), ('mo', mo)], memory=cache_dir)
 
    # Apply GridSearchCV to identify the optimal:
    # - minimum of word occurences (for TFIDF)
@@ -105,7 +218,7 @@ def build_model():
         'clmn__tfidf__min_df': [25,50],
         'mo__estimator__C': [5,1]
     }]
-    cv = model_selection.GridSearchCV(pipeline, parameters)
+    cv = model_selection.GridSearchCV(pipeline, parameters, n_jobs=n_jobs)
 
     return(cv)
 
@@ -119,6 +232,7 @@ def evaluate_model(model, X_test, Y_test, category_names):
     - optimal model parameters as identified by GridSearchCV
     - classification result per category (Y_test versus Y_pred) based on weighted average
     - overall classification result (min, max, ... based on describe())
+    Returns: DataFrame with the classification result per category (see category_report)
     """
     # test the model against the test set
     Y_pred = model.predict(X_test)
@@ -130,17 +244,41 @@ def evaluate_model(model, X_test, Y_test, category_names):
             print("\t%s: %r" % (param_name, best_parameters[param_name]))
 
     # print the result for every of the categories + the total based on the weighted average
+    df_result_cv = category_report(Y_test, Y_pred, category_names)
+    print(df_result_cv.describe())
+    return(df_result_cv)
+
+
+def category_report(Y_test, Y_pred, category_names, verbose=True):
+    """ classification result per category (Y_test versus Y_pred) based on the weighted average
+    Input:
+    - Y_test, Y_pred: arrays with one column per category
+    - category_names: list with the category of every column
+    - verbose: print the result of every category
+    Returns: DataFrame with precision, recall, f1-score and support per category (index: category)
+    """
     classification_result_cv = list()
     i = 0
     for category in category_names:
         weighted_avg = classification_report(Y_test[:,i], Y_pred[:,i],zero_division=1,output_dict=True)['weighted avg']
         classification_result_cv.append(weighted_avg)
-        print(category,weighted_avg)
+        if verbose:
+            print(category,weighted_avg)
         i += 1
 
-    df_result_cv = pd.DataFrame(classification_result_cv)
-    print(df_result_cv.describe())
-    return
+    return(pd.DataFrame(classification_result_cv, index=category_names))
+
+
+def print_search_timings(model):
+    """ print the mean fit and score time per GridSearchCV candidate + the time to refit the best candidate
+    Input: fitted GridSearchCV
+    """
+    results = model.cv_results_
+    for params, fit_time, score_time, score in zip(results['params'], results['mean_fit_time'],
+                                                    results['mean_score_time'], results['mean_test_score']):
+        print('    candidate {}: fit {:.1f}s, score {:.1f}s (per fold), mean test score {:.4f}'
+              .format(params, fit_time, score_time, score))
+    print('    refit best candidate: {:.1f}s'.format(model.refit_time_))
 
 
 def save_model(model, model_filepath):
@@ -149,42 +287,93 @@ def save_model(model, model_filepath):
     - model
     - path+filename of pickle file
     """
+    # the transformer cache is only used while fitting (its directory is removed after training): neither the
+    # best pipeline nor the unfitted one (refit, clone of the search) refers to it
+    model.best_estimator_.set_params(memory=None)
+    model.estimator.set_params(memory=None)
     pickle.dump(model, open(model_filepath, 'wb'))
     return
 
 
+def parse_args(argv):
+    """ parse the command line: database, model file and the optional --n-jobs/--cache-dir settings
+    Returns: argparse.Namespace
+    """
+    parser = argparse.ArgumentParser(
+        description='Train the disaster message classifier and save it to a pickle file.',
+        epilog='Example: python train_classifier.py ../data/DisasterResponse.db DisasterResponse.pkl --n-jobs -1')
+    parser.add_argument('database_filepath', help='filepath of the disaster messages database')
+    parser.add_argument('model_filepath', help='filepath of the pickle file to save the model to')
+    parser.add_argument('--n-jobs', type=int, default=None,
+                        help='worker processes for the CV candidates/folds (-1: all cores)')
+    parser.add_argument('--cache-dir', default=None,
+                        help='directory to cache tokenized/TF-IDF transformed folds (default: temporary directory)')
+    parser.add_argument('--no-token-cache', dest='token_cache', action='store_false',
+                        help='tokenize all messages instead of reusing the tokens cached in the database')
+    parser.add_argument('--tokenizer', choices=TOKENIZER_BACKENDS, default=TOKENIZER_BACKEND,
+                        help='tokenizer backend: NLTK word_tokenize or compiled regex + WordNet lemma table')
+    parser.add_argument('--split', choices=SPLITS, default='random',
+                        help='test set drawn at random or the messages held out by update_classifier.py (id divisible by 5)')
+    return(parser.parse_args(argv))
+
+
 def main():
     """ Check that 2 input parameters have been provided and 
     execute the steps of the model creation, evaluation and storing process
     Input Parameters:
     - database containing the messages and categorizations
     - path+filename of the pickle file to be created
+    - optional: --n-jobs (parallel workers), --cache-dir (transformer cache shared by the CV candidates)
     """
-    if len(sys.argv) == 3:
-        database_filepath, model_filepath = sys.argv[1:]
+    args = parse_args(sys.argv[1:])
+    database_filepath, model_filepath = args.database_filepath, args.model_filepath
+    cache_dir = args.cache_dir or tempfile.mkdtemp(prefix='train_classifier_')
+
+    try:
         print('Loading data...\n    DATABASE: {}'.format(database_filepath))
-        X, Y, category_names = load_data(database_filepath)
-        X_train, X_test, Y_train, Y_test = train_test_split(X, Y, test_size=0.2)
+        with timed('load data'):
+            X, Y, category_names, length_quantiles = load_data(database_filepath)
+        X_train, X_test, Y_train, Y_test = split_data(X, Y, args.split)
+        with timed('build tokenizer ({})'.format(args.tokenizer)):
+            # training messages only: the test set is tokenized as unseen messages are when serving
+            tokenizer = build_tokenizer(args.tokenizer, X_train["message"],
+                                        database_filepath if args.token_cache else None)
+        if args.token_cache:
+            with timed('tokenize'):
+                X = pretokenize(X, database_filepath, tokenizer)
+            X_train, X_test = X.loc[X_train.index], X.loc[X_test.index]
         
-        print('Building model...')
-        model = build_model()
+        print('Building model...\n    WORKERS: {}, CACHE: {}'.format(args.n_jobs or 1, cache_dir))
+        model = build_model(n_jobs=args.n_jobs, cache_dir=cache_dir,
+                            tokenizer=split_tokens if args.token_cache else tokenizer)
         
         print('Training model...')
-        model.fit(X_train, Y_train)
+        with timed('grid search (including refit)'):
+            model.fit(X_train, Y_train)
+        print_search_timings(model)
         
         print('Evaluating model...')
-        evaluate_model(model, X_test, Y_test, category_names)
+        with timed('evaluate'):
+            evaluate_model(model, X_test, Y_test, category_names)
+
+        if args.token_cache:
+            # the saved model receives raw messages
+            restore_tokenizer(model, tokenizer)
+        # the predicted categories travel with the model (export_model.py, web application)
+        model.category_names_ = category_names
+        model.length_quantiles_ = length_quantiles
+        # update_classifier.py compares with models that did not train on its held-out messages
+        model.split_ = args.split
 
         print('Saving model...\n    MODEL: {}'.format(model_filepath))
-        save_model(model, model_filepath)
+        with timed('save'):
+            save_model(model, model_filepath)
 
         print('Trained model saved!')
 
-    else:
-        print('Please provide the filepath of the disaster messages database '\
-              'as the first argument and the filepath of the pickle file to '\
-              'save the model to as the second argument. \n\nExample: python '\
-              'train_classifier.py ../data/DisasterResponse.db DisasterResponse.pkl')
+    finally:
+        if args.cache_dir is None:
+            shutil.rmtree(cache_dir, ignore_errors=True)
 
 
 if __name__ == '__main__':
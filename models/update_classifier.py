@@ -0,0 +1,200 @@
+""" update_classifier
+
+    Incremental (online) training path:
+    - stateless feature extraction: HashingVectorizer on 'message' (no vocabulary to refit), onehot 'genre' with fixed genres
+    - one SGDClassifier (logistic loss) per category, updated with partial_fit
+    - only the messages added since the last checkpoint (message id above the last trained id) are read and used for
+      an update; the "len" quantiles fitted on the first run are kept in the checkpoint
+    - the update is compared with the full retrain (train_classifier.py) on the same held-out messages (id divisible
+      by 5), which neither model is trained on (full retrain with --split holdout), to decide when a full retrain is needed
+
+    to run: python models/update_classifier.py data/DisasterResponse.db models/incremental.pkl --full-model models/DisasterResponse.pkl
+
+Attributes:
+    name of database that includes messages + categories
+    name of the incremental model file (pickle format): created on the first run, updated afterwards
+    --full-model: model created by train_classifier.py to compare against
+    --batch-size: number of messages per partial_fit call (default 5000)
+    --max-f1-drop: mean weighted f1 drop versus the full model from which a full retrain is recommended (default 0.01)
+
+Input:
+    DisasterResponse.db (cleaned and merged messages + categories stored in SQLite database)
+
+Output:
+    Updated model + checkpoint (last trained message id, "len" quantiles) exported to a pickle file.
+"""
+
+# import libraries
+import os
+import sys
+import time
+import pickle
+import argparse
+
+import numpy as np
+import pandas as pd
+from sklearn.pipeline import Pipeline
+from sklearn.compose import ColumnTransformer
+from sklearn.preprocessing import OneHotEncoder
+from sklearn.linear_model import SGDClassifier
+from sklearn.multioutput import MultiOutputClassifier
+from sklearn.feature_extraction.text import HashingVectorizer
+
+from tokenizer import tokenize
+from features import GENRES
+from train_classifier import load_data, category_report, HOLDOUT_MODULO
+
+
+def build_incremental_model(n_features=2**20, alpha=1e-5):
+    """ define the incremental model:
+    Input: "Message", "Genre", "len", "question_mark", "exclamation_mark" (as train_classifier.load_data)
+    - apply a (stateless) hashing vectorizer to 'message'
+    - apply onehot encoding for 'genre' (fixed list of genres)
+    - apply a logistic regression trained by stochastic gradient descent against each of the categories
+    Returns: unfitted Pipeline
+    """
+    hashing = HashingVectorizer(tokenizer=tokenize, strip_accents="unicode", alternate_sign=False, n_features=n_features)
+    onehot = OneHotEncoder(categories=[list(GENRES)], handle_unknown="ignore")
+    clmn = ColumnTransformer([("hashing", hashing, "message"), ("onehot", onehot, ["genre"])], remainder="passthrough")
+    mo = MultiOutputClassifier(SGDClassifier(loss="log", alpha=alpha, random_state=0))
+    return(Pipeline([('clmn', clmn), ('mo', mo)]))
+
+
+def load_checkpoint(model_filepath):
+    """ Returns: previously saved incremental model (None when the model file does not exist yet) """
+    if not os.path.exists(model_filepath):
+        return(None)
+    with open(model_filepath, 'rb') as f:
+        return(pickle.load(f))
+
+
+def update_model(model, X, Y, batch_size=5000):
+    """ update the model with partial_fit, batch by batch
+    Input:
+    - model: Pipeline from build_incremental_model (fitted or not)
+    - X, Y: messages to learn from, Y with one column per category in model.category_names_
+    - batch_size: number of messages per partial_fit call
+    """
+    clmn, mo = model.named_steps['clmn'], model.named_steps['mo']
+    if not hasattr(clmn, 'transformers_'):
+        # nothing is learned from the data: hashing is stateless and the genres are fixed
+        clmn.fit(X.iloc[:1])
+    classes = [np.array([0, 1])] * Y.shape[1]
+    for start in range(0, len(X), batch_size):
+        mo.partial_fit(clmn.transform(X.iloc[start:start + batch_size]), Y[start:start + batch_size], classes=classes)
+    return
+
+
+def compare_models(incremental_model, full_model, X_test, Y_test, category_names, max_f1_drop):
+    """ compare the incremental model with the full retrain on the held-out messages
+    (the test set of train_classifier.py --split holdout: full models trained with another split may have seen some)
+    Prints:
+    - weighted f1 per category for both models + the difference
+    - overall result of the incremental model (describe()) and the recommendation (full retrain or not)
+    """
+    report_incremental = category_report(Y_test, incremental_model.predict(X_test), category_names, verbose=False)
+    print(report_incremental.describe())
+    if full_model is None:
+        return
+
+    if getattr(full_model, 'split_', None) != 'holdout':
+        print('    full model not trained with --split holdout: it may have been trained on held-out messages')
+    length_quantiles = getattr(full_model, 'length_quantiles_', None)
+    if length_quantiles is not None:
+        # "len" as the full model was trained with
+        X_test = X_test.assign(len=length_quantiles.transform(X_test['message'].str.len()))
+    Y_pred_full = full_model.predict(X_test)
+    if Y_pred_full.shape[1] != len(category_names):
+        print('    full model predicts {} categories instead of {}: not compared'.format(Y_pred_full.shape[1], len(category_names)))
+        return
+    report_full = category_report(Y_test, Y_pred_full, category_names, verbose=False)
+
+    comparison = pd.DataFrame({
+        'f1 incremental': report_incremental['f1-score'],
+        'f1 full retrain': report_full['f1-score']})
+    comparison['difference'] = comparison['f1 incremental'] - comparison['f1 full retrain']
+    print(comparison.sort_values(by='difference').to_string(float_format='{:.4f}'.format))
+
+    drop = report_full['f1-score'].mean() - report_incremental['f1-score'].mean()
+    print('mean weighted f1: incremental {:.4f}, full retrain {:.4f}'
+          .format(report_incremental['f1-score'].mean(), report_full['f1-score'].mean()))
+    if drop > max_f1_drop:
+        print('Full retrain recommended: mean f1 is {:.4f} below the full retrain (threshold {})'.format(drop, max_f1_drop))
+    else:
+        print('Incremental model within {} of the full retrain: no full retrain needed'.format(max_f1_drop))
+    return
+
+
+def parse_args(argv):
+    """ parse the command line: database, incremental model file and the optional settings
+    Returns: argparse.Namespace
+    """
+    parser = argparse.ArgumentParser(
+        description='Update the incremental disaster message classifier with the messages added since the last checkpoint.',
+        epilog='Example: python update_classifier.py ../data/DisasterResponse.db incremental.pkl --full-model DisasterResponse.pkl')
+    parser.add_argument('database_filepath', help='filepath of the disaster messages database')
+    parser.add_argument('model_filepath', help='filepath of the incremental model (created when it does not exist)')
+    parser.add_argument('--full-model', default=None, help='model created by train_classifier.py to compare against')
+    parser.add_argument('--batch-size', type=int, default=5000, help='number of messages per partial_fit call')
+    parser.add_argument('--max-f1-drop', type=float, default=0.01,
+                        help='mean weighted f1 drop versus the full model from which a full retrain is recommended')
+    return(parser.parse_args(argv))
+
+
+def main():
+    """ load the messages, update the incremental model with the messages added since the last checkpoint,
+    compare it with the full retrain and save it
+    """
+    args = parse_args(sys.argv[1:])
+
+    print('Loading data...\n    DATABASE: {}'.format(args.database_filepath))
+    model = load_checkpoint(args.model_filepath)
+    if model is None:
+        X, Y, category_names, length_quantiles = load_data(args.database_filepath)
+        print('Building model...')
+        model = build_incremental_model()
+        model.category_names_ = category_names
+        model.length_quantiles_ = length_quantiles
+        model.last_id_ = -1
+        model.n_samples_seen_ = 0
+    else:
+        if getattr(model, 'length_quantiles_', None) is None:
+            # checkpoint saved without its "len" quantiles: fitted once on the whole table
+            _, _, _, model.length_quantiles_ = load_data(args.database_filepath)
+        # only the messages added since the checkpoint + the held-out messages, with the "len" quantiles and
+        # the categories of the checkpoint (whatever categories have become (in)sufficient since)
+        X, Y, category_names, _ = load_data(args.database_filepath,
+            where='id > {} OR id % {} = 0'.format(int(model.last_id_), HOLDOUT_MODULO),
+            length_quantiles=model.length_quantiles_, category_names=model.category_names_)
+
+    holdout = np.asarray(X.index % HOLDOUT_MODULO == 0)
+    new = np.asarray(X.index > model.last_id_) & ~holdout
+    order = np.argsort(X.index[new], kind='stable')
+    X_new, Y_new = X[new].iloc[order], Y[new][order]
+
+    print('Updating model...\n    CHECKPOINT: last id {}, {} messages trained so far, {} new messages'
+          .format(model.last_id_, model.n_samples_seen_, len(X_new)))
+    if len(X_new):
+        start = time.perf_counter()
+        update_model(model, X_new, Y_new, batch_size=args.batch_size)
+        elapsed = time.perf_counter() - start
+        model.last_id_ = int(X_new.index.max())
+        model.n_samples_seen_ += len(X_new)
+        print('    partial_fit: {:.1f}s ({:.0f} messages/sec)'.format(elapsed, len(X_new) / elapsed))
+
+    if model.n_samples_seen_ == 0:
+        print('No messages to train on: model not saved')
+        return
+
+    print('Evaluating model...\n    HELD-OUT: {} messages'.format(int(holdout.sum())))
+    full_model = load_checkpoint(args.full_model) if args.full_model else None
+    compare_models(model, full_model, X[holdout], Y[holdout], category_names, args.max_f1_drop)
+
+    print('Saving model...\n    MODEL: {}'.format(args.model_filepath))
+    with open(args.model_filepath, 'wb') as f:
+        pickle.dump(model, f)
+    print('Incremental model saved!')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+""" conftest
+
+    Shared fixtures of the tests: the modules of models/ and app/ are imported as the scripts import them
+    (models/ and app/ on the path), the corpus is synthetic (no database, no NLTK data needed).
+"""
+import os
+import sys
+import random
+
+import numpy as np
+import pandas as pd
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "models"))
+sys.path.insert(0, os.path.join(ROOT, "app"))
+
+from features import GENRES, LengthQuantiles, build_features
+
+# words that make a category likely
+TOPICS = {
+    "water": ["water", "drink", "thirsty", "wells"], "food": ["food", "hungry", "rice", "eat"],
+    "shelter": ["tent", "shelter", "homeless", "roof"], "medical_help": ["doctor", "injured", "medicine", "sick"],
+}
+FILLER = ("we need help please the people in our village are waiting for news from the government since "
+          "yesterday there is no electricity and the children are afraid send information about the situation").split()
+
+
+@pytest.fixture(scope="session")
+def corpus():
+    """ Returns: as train_classifier.load_data: X (indexed by message id), Y (one column per topic), category names,
+    LengthQuantiles
+    """
+    rng = random.Random(0)
+    topics = list(TOPICS)
+    messages, genres, labels = [], [], []
+    for _ in range(400):
+        message_topics = rng.sample(topics, rng.choice([0, 1, 1, 2]))
+        words = [rng.choice(FILLER) for _ in range(rng.randint(3, 30))]
+        words += [rng.choice(TOPICS[t]) for t in message_topics for _ in range(rng.randint(1, 3))]
+        rng.shuffle(words)
+        messages.append(" ".join(words).capitalize() + rng.choice([".", "!", "?", ""]))
+        genres.append(rng.choice(GENRES))
+        labels.append([int(t in message_topics) for t in topics])
+    length_quantiles = LengthQuantiles.fit([len(m) for m in messages])
+    X = build_features(messages, genres, length_quantiles)
+    X.index = np.arange(2, 2 + 3 * len(X), 3)
+    return(X, np.array(labels), topics, length_quantiles)
@@ -0,0 +1,58 @@
+""" test_features
+
+    LengthQuantiles (models/features.py) must give the "len" of QuantileTransformer.transform, which the
+    pipeline was trained with.
+"""
+import numpy as np
+import pytest
+from sklearn.preprocessing import QuantileTransformer
+
+from features import N_QUANTILES, LengthQuantiles, build_features
+
+
+def fitted(lengths):
+    """ Returns: QuantileTransformer fitted as LengthQuantiles.fit does, LengthQuantiles taken over from it """
+    qt = QuantileTransformer(n_quantiles=N_QUANTILES, random_state=0)
+    qt.fit(np.asarray(lengths, dtype=np.float64).reshape(-1, 1))
+    return(qt, LengthQuantiles.from_transformer(qt))
+
+
+def assert_same_transform(qt, length_quantiles, lengths):
+    lengths = np.asarray(lengths, dtype=np.float64)
+    expected = qt.transform(lengths.reshape(-1, 1))[:, 0]
+    np.testing.assert_allclose(length_quantiles.transform(lengths), expected, rtol=0, atol=1e-12)
+
+
+@pytest.mark.parametrize("lengths", [
+    np.random.RandomState(0).lognormal(4.5, 0.8, 1000).round(),
+    # tied quantiles: most messages have one of a few lengths
+    np.repeat([10, 20, 20, 20, 20, 50, 80], 100),
+    np.repeat([5], 50).tolist() + list(range(5, 200)),
+], ids=["lognormal", "tied", "tied-minimum"])
+def test_transform_as_quantile_transformer(lengths):
+    qt, length_quantiles = fitted(lengths)
+    knots = length_quantiles.quantiles
+    assert_same_transform(qt, length_quantiles, [knots.min() - 10, knots.min() - 1e-9, -1, 0])  # below the minimum
+    assert_same_transform(qt, length_quantiles, [knots.max() + 1e-9, knots.max() + 1, 1e6])  # above the maximum
+    assert_same_transform(qt, length_quantiles, knots)  # exact knot values (tied knots included)
+    assert_same_transform(qt, length_quantiles, (knots[:-1] + knots[1:]) / 2)  # between two knots
+    assert_same_transform(qt, length_quantiles, np.arange(knots.min() - 2, knots.max() + 3))
+
+
+def test_fit_and_round_trip():
+    lengths = np.random.RandomState(1).randint(1, 500, 300)
+    qt, expected = fitted(lengths)
+    length_quantiles = LengthQuantiles.from_dict(LengthQuantiles.fit(lengths).to_dict())
+    np.testing.assert_array_equal(length_quantiles.quantiles, expected.quantiles)
+    np.testing.assert_array_equal(length_quantiles.references, expected.references)
+    assert_same_transform(qt, length_quantiles, np.arange(0, 520))
+
+
+def test_build_features():
+    lengths = np.random.RandomState(2).randint(1, 100, 200)
+    qt, length_quantiles = fitted(lengths)
+    X = build_features(["water?", "Help!", "", "x" * 150], ["direct", "news", "social", "direct"], length_quantiles)
+    np.testing.assert_allclose(X["len"], qt.transform(np.array([[6.], [5.], [0.], [150.]]))[:, 0], rtol=0, atol=1e-12)
+    assert X["question_mark"].tolist() == [1, 0, 0, 0]
+    assert X["exclamation_mark"].tolist() == [0, 1, 0, 0]
+    assert X["genre"].tolist() == ["direct", "news", "social", "direct"]
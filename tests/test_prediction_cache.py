@@ -0,0 +1,63 @@
+""" test_prediction_cache
+
+    PredictionCache (app/prediction_cache.py): exact keys, model versions and near-duplicate lookups with a TTL.
+"""
+import numpy as np
+import pytest
+
+import prediction_cache
+from prediction_cache import PredictionCache
+
+WORDS = "water food shelter tent rice medicine doctor blanket truck road bridge".split()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """ monotonic clock of the cache, advanced by the tests """
+    now = [1000.0]
+    monkeypatch.setattr(prediction_cache.time, "monotonic", lambda: now[0])
+    return(now)
+
+
+def store(cache, message, value, genre="direct", model_version=None):
+    """ cache value as the result of message (keys and signatures as lookup computes them) """
+    _, keys, signatures = cache.lookup([message], [genre], model_version)
+    cache.store(keys, signatures, np.array([[value]]), np.array([[value / 10]]), model_version)
+
+
+def cached_value(cache, message, genre="direct", model_version=None):
+    result = cache.lookup([message], [genre], model_version)[0][0]
+    return(None if result is None else int(result[0][0]))
+
+
+def test_exact_key_includes_raw_length():
+    cache = PredictionCache(maxsize=10)
+    store(cache, "Need water", 1)
+    assert cached_value(cache, "need water") == 1
+    # same normalized text, other length ("len" feature): not the same input of the model
+    assert cached_value(cache, "need  water") is None
+    assert cached_value(cache, "need water", genre="news") is None
+
+
+def test_other_model_version_misses():
+    cache = PredictionCache(maxsize=10, model_version="v1")
+    store(cache, "need water", 1, model_version="v1")
+    assert cached_value(cache, "need water", model_version="v1") == 1
+    assert cached_value(cache, "need water", model_version="v2") is None
+    cache.set_model_version("v2")
+    assert cached_value(cache, "need water") is None
+
+
+def test_expired_near_duplicate_falls_back_to_next_candidate(clock):
+    cache = PredictionCache(maxsize=10, ttl=10, tokenizer=str.split, threshold=0.5)
+    query = " ".join(reversed(WORDS[:10]))
+    store(cache, " ".join(WORDS[:10]), 1)  # same tokens as the query
+    clock[0] += 8
+    store(cache, " ".join(WORDS[:9] + WORDS[10:]), 2)  # one word differs
+    assert cached_value(cache, query) == 1
+    # the most similar entry has expired: the other near duplicate is still valid
+    clock[0] += 4
+    assert cached_value(cache, query) == 2
+    assert cache.stats()["expirations"] == 1
+    clock[0] += 10
+    assert cached_value(cache, query) is None
@@ -0,0 +1,63 @@
+""" test_predictor
+
+    The fused predictor (models/predictor.py) must reproduce the pipeline it was built from, also after the
+    round trip through an export directory (export_model.py: .npy arrays + manifest).
+"""
+import numpy as np
+import pytest
+
+from tokenizer import split_tokens
+from predictor import Predictor
+from export_model import export_model
+from train_classifier import build_model
+
+TOLERANCE = 1e-9
+
+
+@pytest.fixture(scope="module")
+def model(corpus):
+    """ Returns: GridSearchCV fitted as train_classifier.py does (small corpus, split_tokens: no NLTK data needed) """
+    X, Y, category_names, length_quantiles = corpus
+    model = build_model(tokenizer=split_tokens)
+    model.set_params(param_grid=[{"clmn__tfidf__min_df": [1, 5], "mo__estimator__C": [5, 1]}])
+    model.fit(X, Y)
+    model.category_names_ = category_names
+    model.length_quantiles_ = length_quantiles
+    return(model)
+
+
+def pipeline_output(model, X):
+    """ Returns: (n_messages x n_categories) probabilities of the positive class, labels """
+    return(np.column_stack([p[:, 1] for p in model.predict_proba(X)]), model.predict(X))
+
+
+def assert_same_output(predictor, model, X):
+    expected_proba, expected_labels = pipeline_output(model, X)
+    np.testing.assert_allclose(predictor.predict_proba(X), expected_proba, rtol=0, atol=TOLERANCE)
+    np.testing.assert_array_equal(predictor.predict(X), expected_labels)
+
+
+def test_from_pipeline(model, corpus):
+    X, _, category_names, _ = corpus
+    predictor = Predictor.from_pipeline(model)
+    assert predictor.categories == category_names
+    assert_same_output(predictor, model, X)
+
+
+def test_export_round_trip(model, corpus, tmp_path):
+    X, _, category_names, _ = corpus
+    export_dir = str(tmp_path / "export")
+    export_model(model, export_dir)
+    for mmap in (True, False):
+        predictor = Predictor.load(export_dir, mmap=mmap)
+        assert predictor.categories == category_names
+        assert predictor.tokenizer is split_tokens
+        assert_same_output(predictor, model, X)
+
+
+def test_unseen_messages(model, corpus):
+    """ words outside of the vocabulary, empty messages and accents are handled as the vectorizer does """
+    X, _, _, _ = corpus
+    X = X.iloc[:4].copy()
+    X["message"] = ["", "Café inondé, need WATER!!", "zzz unknown words only", "   "]
+    assert_same_output(Predictor.from_pipeline(model), model, X)
@@ -0,0 +1,80 @@
+""" test_token_cache
+
+    Cached tokens (models/token_cache.py) are reused across retrains and tokenizer backends, and the regex tokens
+    of a message are refreshed only when a word of it was added to the lemma table.
+"""
+import pandas as pd
+import pytest
+
+import token_cache
+from tokenizer import RegexTokenizer
+from token_cache import load_tokens, load_lemma_table
+
+STOP = ["the", "a", "in"]
+
+
+@pytest.fixture
+def lemmatize(monkeypatch):
+    """ WordNet replaced by plural stripping (no NLTK data needed); the words looked up are recorded """
+    looked_up = []
+
+    def lemmatize(word):
+        looked_up.append(word)
+        return(word[:-1] if word.endswith("s") else word)
+    monkeypatch.setattr(token_cache, "lemmatize", lemmatize)
+    monkeypatch.setattr(token_cache, "corpus_vocabulary",
+                        lambda texts: {w for text in texts for w in text.lower().split()} - set(STOP))
+    return(looked_up)
+
+
+def regex_tokens(database_filepath, messages, training_messages):
+    """ Returns: tokens of the messages with a lemma table extended by training_messages, number tokenized """
+    lemmas, _ = load_lemma_table(database_filepath, training_messages)
+    tokenizer = RegexTokenizer(lemmas, stop=STOP)
+    return(load_tokens(database_filepath, messages, tokenize_fn=tokenizer.tokenize_series, version=tokenizer.version,
+                       backend="regex", lemma_table=True))
+
+
+def test_regex_tokens_survive_retrains(tmp_path, lemmatize):
+    database_filepath = str(tmp_path / "cache.db")
+    messages = pd.Series(["tents in the camp", "water wells", "send doctors"], index=[1, 2, 3])
+    tokens, n_tokenized = regex_tokens(database_filepath, messages, messages.iloc[:2])
+    assert n_tokenized == 3
+    # "doctors" is not a training word yet: kept as it is
+    assert tokens.tolist() == ["tent camp", "water well", "send doctors"]
+
+    # retrain on the same messages: nothing is looked up or tokenized again
+    del lemmatize[:]
+    tokens, n_tokenized = regex_tokens(database_filepath, messages, messages.iloc[:2])
+    assert n_tokenized == 0 and lemmatize == []
+
+    # a new training message brings "doctors" and "fires": only the message with "doctors" is tokenized again
+    messages[4] = "fires downtown"
+    tokens, n_tokenized = regex_tokens(database_filepath, messages, messages)
+    assert sorted(lemmatize) == ["doctors", "downtown", "fires", "send"]
+    assert n_tokenized == 2
+    assert tokens.tolist() == ["tent camp", "water well", "send doctor", "fire downtown"]
+
+
+def test_backends_are_cached_separately(tmp_path, lemmatize):
+    database_filepath = str(tmp_path / "cache.db")
+    messages = pd.Series(["tents in the camp", "water wells"], index=[1, 2])
+
+    def nltk_tokens():
+        return(load_tokens(database_filepath, messages, tokenize_fn=lambda texts: [t.upper().split() for t in texts],
+                           backend="nltk"))
+    assert nltk_tokens()[1] == 2
+    assert regex_tokens(database_filepath, messages, messages)[1] == 2
+    # switching back and forth reuses the tokens of both backends
+    tokens, n_tokenized = nltk_tokens()
+    assert n_tokenized == 0 and tokens.tolist() == ["TENTS IN THE CAMP", "WATER WELLS"]
+    assert regex_tokens(database_filepath, messages, messages)[1] == 0
+
+
+def test_changed_message_is_tokenized_again(tmp_path, lemmatize):
+    database_filepath = str(tmp_path / "cache.db")
+    messages = pd.Series(["tents in the camp", "water wells"], index=[1, 2])
+    regex_tokens(database_filepath, messages, messages)
+    messages[2] = "more water wells"
+    tokens, n_tokenized = regex_tokens(database_filepath, messages, messages)
+    assert n_tokenized == 1 and tokens[2] == "more water well"